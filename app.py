@@ -1,10 +1,10 @@
 import os
+import hmac
 import json
 import uuid
 import time
-import pandas as pd
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for
 from dotenv import load_dotenv
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_bcrypt import Bcrypt
@@ -12,12 +12,29 @@ from google import genai
 from google.genai import types
 
 # IMPORTAMOS EL MÓDULO DE LÓGICA
-from insights import clean_dataframe, apply_global_filters, process_component_data
+from insights import accumulate_components, process_partials
+from datasets import append_offset, get_dataframe, file_signature, memory_reports, is_streaming, iter_chunks, prefetch, SAMPLE_ROWS, load_profile, save_profile, dataframe_cache
+from datasets import is_workbook, excel_sheets, write_excel_parquet, load_sheet_index, save_sheet_index
+from cube import build_cube, extend_cube, save_cube, load_cube, delete_cube, can_answer, query_cube, save_state, load_state
+from serialization import SafeJSONProvider, dumps, json_safe, finalize_json, columnar_components, to_columnar, wants_columnar
+from filters import get_filter_index
+from spatial import get_spatial_index, query_chunks, clip_bbox
+from jobs import jobs, JobLimitError, FINISHED
+from layouts import LayoutCache, layout_key, adapt_layout, CACHE_ENABLED
+from dashboards import DashboardStore, PAGE_SIZE
+from users import UserRepository
+from uploads import UploadStore, is_blob
+from profiling import profile_file, summary_lines
+from engines import get_engine, prepare_engine
+from metrics import registry, span, init_app as init_metrics, SHARED_METRICS
 
 load_dotenv()
 
 # --- CONFIGURACIÓN BÁSICA ---
 app = Flask(__name__)
+app.json = SafeJSONProvider(app)  # NaN/inf y tipos numpy se resuelven al serializar
+init_metrics(app)  # Latencia por ruta, peticiones en curso y Server-Timing (ver metrics.py)
+app.after_request(finalize_json)  # ETag/304 y compresión de las respuestas JSON
 app.secret_key = os.getenv("SECRET_KEY", "dev_secret_key_super_segura")
 bcrypt = Bcrypt(app)
 login_manager = LoginManager()
@@ -25,22 +42,52 @@ login_manager.init_app(app)
 login_manager.login_view = 'auth_page'
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_DIR = os.path.join(BASE_DIR, 'data')
+# DATA_DIR / UPLOAD_FOLDER se pueden redirigir por entorno (benchmarks, despliegues)
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(BASE_DIR, 'data'))
 USERS_FILE = os.path.join(DATA_DIR, 'users.json')
-UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'uploads')
+UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", os.path.join(BASE_DIR, 'static', 'uploads'))
 DASHBOARD_DIR = os.path.join(DATA_DIR, 'dashboards')
 
 for d in [DATA_DIR, UPLOAD_FOLDER, DASHBOARD_DIR]:
     os.makedirs(d, exist_ok=True)
 
-if not os.path.exists(USERS_FILE):
-    with open(USERS_FILE, 'w') as f: json.dump({}, f)
+# Uploads por contenido (static/uploads/blobs) con referencias por usuario/dashboard
+upload_store = UploadStore(UPLOAD_FOLDER, os.path.join(DATA_DIR, 'uploads.db'))
+
+# Estado de los trabajos también en disco: con varios workers el sondeo puede caer en otro proceso
+jobs.share_state(os.path.join(DATA_DIR, 'jobs'), encode=dumps)
+
+# Métricas sumadas entre workers: el scrape de /metrics puede caer en cualquiera (ver metrics.py)
+if SHARED_METRICS: registry.share(os.path.join(DATA_DIR, 'metrics'))
+
+# Usuarios en memoria (se recargan si users.json cambia en disco)
+user_repo = UserRepository(USERS_FILE)
+
+# Índice SQLite de metadatos; los JSON existentes se indexan al arrancar
+dashboard_store = DashboardStore(DASHBOARD_DIR, os.path.join(DATA_DIR, 'dashboards.db'))
+dashboard_store.migrate()
 
 # --- CONFIGURACIÓN GEMINI AI ---
 MODEL_NAME = "gemini-2.5-flash" 
 api_key = os.getenv("GEMINI_API_KEY")
 client = genai.Client(api_key=api_key) if api_key else None
 
+# Layouts ya generados para el mismo esquema + instrucción (ver layouts.py)
+layout_cache = LayoutCache(os.path.join(DATA_DIR, 'layout_cache.json'))
+
+def _runtime_metrics():
+    """Aciertos de las cachés y trabajos de generación, leídos en cada scrape de /metrics"""
+    for name, cache in (('dataframe', dataframe_cache), ('layout', layout_cache)):
+        stats = cache.stats()
+        for field in ('entries', 'hits', 'misses'):
+            yield f"cache_{field}", {"cache": name}, stats[field]
+    for status, count in jobs.counts().items():
+        yield "generation_jobs", {"status": status}, count
+
+registry.register_collector(_runtime_metrics)
+# La proporción se calcula sobre los aciertos y fallos ya sumados entre workers
+registry.register_ratio('cache_hit_ratio', 'cache_hits', 'cache_misses')
+
 # --- PROMPT MAESTRO ACTUALIZADO ---
 SYSTEM_PROMPT = """
 Eres un Director de Business Intelligence experto.
@@ -54,6 +101,7 @@ Genera un JSON con la siguiente estructura EXACTA de componentes (en este orden)
 3. **GRÁFICO DE BARRAS:** Para comparar categorías principales (Top productos, Ventas por Vendedor, etc).
 4. **GRÁFICO CIRCULAR (PIE):** Para mostrar distribución o proporción (Share de mercado, Estado de pedidos).
 5. **MAPA (Solo si aplica):** SI Y SOLO SI detectas columnas de Latitud y Longitud, añade un quinto componente tipo "map". Si no hay coordenadas claras, NO lo incluyas.
+6. **SERIE TEMPORAL (Solo si aplica):** SI detectas una columna de fecha (tipo datetime64 en el resumen), añade un componente tipo "timeseries" con la evolución de la métrica principal. "x" es la columna de fecha; "operation" es "count", "sum" o "mean"; "granularity" es "day", "week", "month" o "auto" (recomendado). Si no hay fechas, NO lo incluyas.
 
 REGLAS DE ORO PARA TÍTULOS:
 - Usa lenguaje de negocio, NO nombres de columnas (ej: NO USAR "sum_ventas", USAR "Ventas Totales").
@@ -99,6 +147,12 @@ ESTRUCTURA JSON DE RESPUESTA:
       "type": "map",
       "title": "Ubicación de Clientes",
       "config": { "lat": "latitude", "lon": "longitude", "label": "store_name" }
+    },
+    {
+      "id": "ts1",
+      "type": "timeseries",
+      "title": "Evolución de Ventas (Unidades)",
+      "config": { "x": "order_date", "y": "quantity", "operation": "sum", "granularity": "auto" }
     }
   ]
 }
@@ -111,31 +165,24 @@ class User(UserMixin):
         self.email = email
         self.password_hash = password_hash
 
+def _to_user(found):
+    if not found: return None
+    uid, data = found
+    return User(uid, data['email'], data['password'])
+
 @login_manager.user_loader
 def load_user(user_id):
-    try:
-        with open(USERS_FILE, 'r') as f: users = json.load(f)
-        if user_id in users:
-            u = users[user_id]
-            return User(user_id, u['email'], u['password'])
-    except: pass
-    return None
+    return _to_user(user_repo.get(user_id))
 
 def save_new_user(email, password):
-    with open(USERS_FILE, 'r') as f: users = json.load(f)
-    for uid, data in users.items():
-        if data['email'] == email: return User(uid, data['email'], data['password'])
-    uid = str(uuid.uuid4())
+    user = get_user_by_email(email)
+    if user: return user
     pw = bcrypt.generate_password_hash(password).decode('utf-8')
-    users[uid] = {'email': email, 'password': pw}
-    with open(USERS_FILE, 'w') as f: json.dump(users, f)
-    return User(uid, email, pw)
+    found, _ = user_repo.create(email, pw)
+    return _to_user(found)
 
 def get_user_by_email(email):
-    with open(USERS_FILE, 'r') as f: users = json.load(f)
-    for uid, data in users.items():
-        if data['email'] == email: return User(uid, data['email'], data['password'])
-    return None
+    return _to_user(user_repo.get_by_email(email))
 
 # --- RUTAS PRINCIPALES ---
 
@@ -157,8 +204,7 @@ def dashboard():
 @app.route("/view/<dash_id>")
 @login_required
 def view_dashboard(dash_id):
-    path = os.path.join(DASHBOARD_DIR, current_user.id, f"{dash_id}.json")
-    if not os.path.exists(path): return "Dashboard no encontrado", 404
+    if not dashboard_store.exists(current_user.id, dash_id): return "Dashboard no encontrado", 404
     return render_template("share.html", dash_id=dash_id)
 
 # --- API AUTH ---
@@ -193,38 +239,96 @@ def upload_and_analyze():
     if 'file' not in request.files: return jsonify({"error": "Falta archivo"}), 400
     file = request.files['file']
     
-    user_path = os.path.join(UPLOAD_FOLDER, current_user.id)
-    os.makedirs(user_path, exist_ok=True)
     # Guardamos nombre original para contexto
     original_name = file.filename
-    filename = f"{uuid.uuid4().hex[:8]}_{original_name}"
-    filepath = os.path.join(user_path, filename)
-    file.save(filepath)
+    # Se guarda por hash de contenido: un fichero repetido reutiliza blob y artefactos
+    rel_path = upload_store.save(current_user.id, file.stream, original_name)
+    if is_workbook(rel_path): return submit_workbook(current_user.id, rel_path, original_name, request.form.get('sheet'))
 
-    try:
-        if filename.endswith('.csv'): df = pd.read_csv(filepath, engine='python')
-        else: df = pd.read_excel(filepath)
-        df.columns = df.columns.str.strip()
-        
-        df = clean_dataframe(df)
-        
-        summary = [f"Archivo: {original_name}", f"Registros: {len(df)}"]
-        for col in df.columns:
-            dtype = str(df[col].dtype)
-            sample = [str(x)[:40] for x in df[col].dropna().head(3).tolist()]
-            summary.append(f"- '{col}' ({dtype}): Ejemplo: {sample}")
-            
-        return jsonify({
-            "summary": "\n".join(summary),
-            "file_path": os.path.join(current_user.id, filename),
-            "original_name": original_name # Enviamos nombre limpio al front
-        })
+    try: return jsonify(analyze_upload(current_user.id, rel_path, original_name, request.form.get('sheet')))
     except Exception as e:
         return jsonify({"error": f"Error leyendo archivo: {str(e)}"}), 500
 
+@app.route("/api/uploads/sheet", methods=["POST"])
+@login_required
+def select_sheet():
+    """Cambia la hoja de un Excel ya subido sin volver a subirlo"""
+    data = request.json or {}
+    source = data.get('source_path') or ''
+    if not is_blob(source) or not is_workbook(source) or not upload_store.owns(current_user.id, source):
+        return jsonify({"error": "Archivo perdido"}), 404
+    if not os.path.exists(os.path.join(UPLOAD_FOLDER, source)): return jsonify({"error": "Archivo perdido"}), 404
+    return submit_workbook(current_user.id, source, data.get('original_name') or os.path.basename(source), data.get('sheet'))
+
+def submit_workbook(user_id, rel_path, original_name, sheet):
+    """Los Excel se convierten y analizan como trabajo (ver /api/jobs): la conversión de una hoja grande
+    no ocupa el hilo de la petición. El resultado del trabajo es la respuesta de analyze_upload"""
+    try: job = jobs.submit(user_id, analyze_upload, user_id, rel_path, original_name, sheet)
+    except JobLimitError as e: return jsonify({"error": str(e)}), 429
+    return jsonify(job), 202
+
+def excel_dataset(user_id, rel_path, sheet=None):
+    """Convierte (una sola vez) la hoja del libro a un blob Parquet y lo registra para el usuario.
+    Devuelve (ruta del Parquet, hojas del libro, hoja usada). Corre dentro de un trabajo"""
+    path = os.path.join(UPLOAD_FOLDER, rel_path)
+    index = load_sheet_index(path) or {"sheets": excel_sheets(path), "converted": {}}
+    if not index['sheets']: raise ValueError("El libro no tiene hojas de datos")
+    sheet = sheet or index['sheets'][0]
+    if sheet not in index['sheets']: raise ValueError(f"Hoja no encontrada: {sheet}")
+
+    converted = index['converted'].get(sheet)
+    if converted and upload_store.register(user_id, converted): return converted, index['sheets'], sheet
+
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with span('excel_convert'): write_excel_parquet(path, sheet, tmp)
+        with open(tmp, 'rb') as f: converted = upload_store.save(user_id, f, 'sheet.parquet')
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+    index['converted'][sheet] = converted
+    save_sheet_index(path, index)
+    return converted, index['sheets'], sheet
+
+def analyze_upload(user_id, rel_path, original_name, sheet=None):
+    """Resumen para el LLM (perfil cacheado por contenido). Los .xlsx se analizan sobre su hoja convertida"""
+    source_path, sheets = rel_path, None
+    if is_workbook(rel_path): rel_path, sheets, sheet = excel_dataset(user_id, rel_path, sheet)
+    filepath = os.path.join(UPLOAD_FOLDER, rel_path)
+
+    # Perfil acotado en tiempo (muestra + estadísticas en streaming), cacheado por contenido
+    profile = load_profile(filepath)
+    if profile is None:
+        with span('profile'): info = profile_file(filepath)
+        profile = {"rows": info['rows'], "exact": info['exact'], "lines": summary_lines(info), "memory": info['memory']}
+        save_profile(filepath, profile)
+    # La carga completa (caché columnar y de memoria) sigue en segundo plano para generar y filtrar
+    if not is_streaming(filepath): prefetch(filepath)
+    # Los datasets grandes se filtran con el motor SQL: su Parquet limpio también se prepara ya
+    prepare_engine(filepath)
+    
+    summary = [f"Archivo: {original_name}"]
+    if sheets and len(sheets) > 1: summary.append(f"Hoja: {sheet}")
+    rows = profile['rows'] if profile.get('exact', True) else f"~{profile['rows']} (estimado)"
+    summary += [f"Registros: {rows}"] + profile['lines']
+
+    result = {
+        "summary": "\n".join(summary),
+        "file_path": rel_path,
+        "original_name": original_name, # Enviamos nombre limpio al front
+    }
+    # Informe de memoria por columna: el de la carga completa si ya terminó; si no, el de la muestra
+    # del perfil escalado al total (el exacto sale también en el resultado de la generación)
+    memory = memory_reports.get(filepath)
+    if memory: result.update(memory=memory, memory_estimated=False)
+    else: result.update(memory=profile.get('memory', []), memory_estimated=True)
+    # Excel: el front ofrece elegir hoja (se convierte desde source_path)
+    if sheets is not None: result.update(source_path=source_path, sheets=sheets, sheet=sheet)
+    return result
+
 @app.route("/generate_dashboard", methods=["POST"])
 @login_required
 def generate_dashboard():
+    """Encola la generación y responde al momento con el id del trabajo (ver /api/jobs)"""
     if not client: return jsonify({"error": "Error Servidor: Falta GEMINI_API_KEY"}), 500
 
     data = request.json
@@ -235,22 +339,45 @@ def generate_dashboard():
     filename_context = data.get('original_name', os.path.basename(full_path).split('_', 1)[-1])
 
     if not os.path.exists(full_path): return jsonify({"error": "Archivo perdido"}), 404
-
-    try:
-        if full_path.endswith('.csv'): df = pd.read_csv(full_path, engine='python')
-        else: df = pd.read_excel(full_path)
-        df.columns = df.columns.str.strip()
-
-        # Construimos el Prompt enriquecido
-        prompt = (
-            f"NOMBRE DEL ARCHIVO: {filename_context}\n"
-            f"RESUMEN DE COLUMNAS Y DATOS:\n{data.get('summary')}\n"
-            f"INTENCIÓN DEL USUARIO: {data.get('instruction')}\n"
-            "Recuerda: 2 KPIs, 1 Barra, 1 Pie y Mapa (si hay coords)."
-        )
-        
-        response = None
-        max_retries = 3
+    if is_blob(data.get('file_path')) and not upload_store.owns(current_user.id, data.get('file_path')):
+        return jsonify({"error": "Archivo perdido"}), 404
+
+    try: job = jobs.submit(current_user.id, build_dashboard, current_user.id, data, full_path, filename_context)
+    except JobLimitError as e: return jsonify({"error": str(e)}), 429
+    return jsonify(job), 202
+
+def build_dashboard(user_id, data, full_path, filename_context):
+    """Trabajo de generación: LLM + cálculo de componentes + guardado. Corre en el pool de jobs,
+    fuera de la petición (por eso recibe user_id y no usa current_user)"""
+    # Ficheros grandes: nada de cargarlos enteros, se agregan por trozos
+    streaming = is_streaming(full_path)
+    df = None if streaming else get_dataframe(full_path)
+
+    # Mismo esquema + instrucción + prompt: el layout se reutiliza sin llamar al LLM
+    # ("use_cache": false en la petición fuerza una generación nueva)
+    schema_df = df
+    if streaming:
+        chunks = iter_chunks(full_path, chunk_rows=SAMPLE_ROWS)
+        schema_df = next(chunks, None)
+        chunks.close()
+    cache_key = layout_key(schema_df, data.get('instruction'), SYSTEM_PROMPT, MODEL_NAME) if schema_df is not None else None
+    use_cache = CACHE_ENABLED and cache_key is not None and data.get('use_cache', True) is not False
+    config_json = adapt_layout(layout_cache.get(cache_key) or {}, schema_df.columns) if use_cache else None
+    if config_json and config_json.get('components'):
+        print(f"Layout reutilizado de la caché ({cache_key[:12]})")
+        return save_dashboard(user_id, data, full_path, filename_context, df, streaming, config_json)
+
+    # Construimos el Prompt enriquecido
+    prompt = (
+        f"NOMBRE DEL ARCHIVO: {filename_context}\n"
+        f"RESUMEN DE COLUMNAS Y DATOS:\n{data.get('summary')}\n"
+        f"INTENCIÓN DEL USUARIO: {data.get('instruction')}\n"
+        "Recuerda: 2 KPIs, 1 Barra, 1 Pie, Mapa (si hay coords) y Serie temporal (si hay fechas)."
+    )
+    
+    response = None
+    max_retries = 3
+    with span('gemini'):  # Incluye reintentos y esperas
         for attempt in range(max_retries):
             try:
                 response = client.models.generate_content(
@@ -264,109 +391,289 @@ def generate_dashboard():
                 )
                 break 
             except Exception as e:
+                registry.inc('gemini_errors_total')
                 if attempt == max_retries - 1: raise e
                 time.sleep(1.5 ** attempt)
 
-        config_json = json.loads(response.text)
-
-        processed_components = []
-        for comp in config_json.get('components', []):
-            comp_data = process_component_data(df, comp)
-            if comp_data:
-                comp['data'] = comp_data
-                processed_components.append(comp)
-
-        final_config = {
-            "title": config_json.get('title', f"Dashboard: {filename_context}"),
-            "components": processed_components
-        }
-
-        dash_id = str(uuid.uuid4())
-        user_dash_dir = os.path.join(DASHBOARD_DIR, current_user.id)
-        os.makedirs(user_dash_dir, exist_ok=True)
-        
-        with open(os.path.join(user_dash_dir, f"{dash_id}.json"), 'w') as f:
-            json.dump({
-                "id": dash_id,
-                "created_at": datetime.now().isoformat(),
-                "config": final_config,
-                "file_path": data.get('file_path')
-            }, f)
-
-        return jsonify(final_config)
+    config_json = json.loads(response.text)
+    if cache_key and CACHE_ENABLED: layout_cache.put(cache_key, config_json)
+    return save_dashboard(user_id, data, full_path, filename_context, df, streaming, config_json)
+
+def save_dashboard(user_id, data, full_path, filename_context, df, streaming, config_json):
+    """Calcula los datos de cada componente del layout y guarda el dashboard (y su cubo)"""
+    processed_components = []
+    components = config_json.get('components', [])
+    # Parciales fusionables: dan los datos de cada componente y se guardan para el refresco incremental
+    state = accumulate_components(iter_chunks(full_path) if streaming else [df], components)
+    components_data = process_partials(state, components)
+    for comp, comp_data in zip(components, components_data):
+        if comp_data:
+            comp['data'] = comp_data
+            processed_components.append(comp)
+
+    final_config = {
+        "title": config_json.get('title', f"Dashboard: {filename_context}"),
+        "components": processed_components
+    }
+
+    dash_id = str(uuid.uuid4())
+    base = dashboard_store.base_path(user_id, dash_id)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+
+    # Cubo pre-agregado para que los filtros no tengan que recorrer las filas
+    cube_meta = None
+    if not streaming:
+        try:
+            cube_meta, cube, points, clusters = build_cube(df, processed_components)
+            cube_meta['source'] = list(file_signature(full_path))
+            save_cube(base, cube, points, clusters)
+        except Exception as e:
+            print(f"Aviso: dashboard {dash_id} sin cubo: {e}")
+            cube_meta = None
+    save_state(base, state, file_signature(full_path))
+    
+    dashboard_store.save(user_id, json_safe({
+        "id": dash_id,
+        "created_at": datetime.now().isoformat(),
+        "config": final_config,
+        "file_path": data.get('file_path'),
+        "cube": cube_meta
+    }))
+    if is_blob(data.get('file_path')): upload_store.attach(user_id, data.get('file_path'), dash_id)
+
+    return {"dashboard_id": dash_id, "config": final_config, "memory": memory_reports.get(full_path, [])}
+
+# --- REFRESCO DEL FICHERO DE ORIGEN ---
+
+@app.route("/api/dashboards/<dash_id>/refresh", methods=["POST"])
+@login_required
+def refresh_source(dash_id):
+    """Nueva versión del fichero de un dashboard (multipart 'file', y 'sheet' si es un Excel).
+    Encola el refresco de todos los dashboards del usuario sobre ese fichero, sin pasar por el LLM"""
+    dash_data = dashboard_store.load(current_user.id, dash_id)
+    if dash_data is None: return jsonify({"error": "No existe"}), 404
+    if 'file' not in request.files: return jsonify({"error": "Falta archivo"}), 400
+    file = request.files['file']
+    rel_path = upload_store.save(current_user.id, file.stream, file.filename)
+
+    old_path = dash_data['file_path']
+    dash_ids = dashboard_store.ids_for_file(current_user.id, old_path)
+    try: job = jobs.submit(current_user.id, refresh_dashboards, current_user.id, dash_ids, old_path, rel_path, request.form.get('sheet'))
+    except JobLimitError as e: return jsonify({"error": str(e)}), 429
+    return jsonify(job), 202
+
+def refresh_dashboards(user_id, dash_ids, old_rel, new_rel, sheet=None):
+    """Trabajo de refresco. Si la versión nueva es la anterior con filas añadidas al final (CSV),
+    los parciales guardados de cada dashboard se amplían solo con esas filas; si cambió algo
+    anterior (o no hay parciales), se recalcula entero. Las filas nuevas se leen una vez para todos.
+    Un Excel nuevo se convierte aquí (su hoja, a Parquet) y no en la petición"""
+    if is_workbook(new_rel): new_rel = excel_dataset(user_id, new_rel, sheet)[0]
+    old_path, new_path = os.path.join(UPLOAD_FOLDER, old_rel), os.path.join(UPLOAD_FOLDER, new_rel)
+    offset = append_offset(old_path, new_path) if os.path.exists(old_path) else None
+    old_source = file_signature(old_path) if offset is not None else None
+    streaming = is_streaming(new_path)
+    delta = None
+
+    refreshed = []
+    for dash_id in dash_ids:
+        dash = dashboard_store.load(user_id, dash_id)
+        if dash is None: continue
+        base = dashboard_store.base_path(user_id, dash_id)
+        components = dash['config']['components']
+
+        state = load_state(base, old_source) if offset is not None else None
+        if state is not None:
+            if delta is None:
+                with span('refresh_delta'): delta = list(iter_chunks(new_path, offset=offset))
+            state.extend(delta)
+            mode = 'incremental'
+        else:
+            state = accumulate_components(iter_chunks(new_path) if streaming else [get_dataframe(new_path)], components)
+            mode = 'full'
+        for comp, comp_data in zip(components, process_partials(state, components)):
+            if comp_data is not None: comp['data'] = comp_data
+
+        dash['cube'] = None if streaming else refreshed_cube(dash, base, components, new_path, delta if mode == 'incremental' else None, old_source)
+        save_state(base, state, file_signature(new_path))
+        dash.update(file_path=new_rel, refreshed_at=datetime.now().isoformat())
+        dashboard_store.save(user_id, json_safe(dash))
+        if is_blob(new_rel): upload_store.attach(user_id, new_rel, dash_id)
+        refreshed.append({"dashboard_id": dash_id, "mode": mode})
+
+    if refreshed and is_blob(old_rel) and old_rel != new_rel: upload_store.gc()  # La versión anterior, si ya nadie la usa
+    return {
+        "file_path": new_rel,
+        "appended_rows": sum(len(chunk) for chunk in delta) if delta is not None else None,
+        "dashboards": refreshed
+    }
 
+def refreshed_cube(dash, base, components, full_path, delta, old_source):
+    """Cubo para la versión nueva: el guardado más las filas añadidas si se puede, si no reconstruido"""
+    meta = dash.get('cube')
+    try:
+        tables = None
+        if delta is not None and meta and meta.get('source') == list(old_source):
+            tables = extend_cube(meta, *load_cube(base), delta, components)
+        if tables is None: meta, *tables = build_cube(get_dataframe(full_path), components)
+        cube, points, clusters = tables
+        save_cube(base, cube, points, clusters)
+        return dict(meta, source=list(file_signature(full_path)), has_points=points is not None)
     except Exception as e:
-        print(f"Error GenAI: {e}")
-        return jsonify({"error": str(e)}), 500
+        print(f"Aviso: dashboard {dash['id']} sin cubo: {e}")
+        return None
+
+# --- ESTADO DE LOS TRABAJOS (polling y SSE) ---
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+@login_required
+def job_status(job_id):
+    job = jobs.get(job_id, current_user.id)
+    if job is None: return jsonify({"error": "Trabajo no encontrado"}), 404
+    return jsonify(job)
+
+@app.route("/api/jobs/<job_id>/events", methods=["GET"])
+@login_required
+def job_events(job_id):
+    """Server-Sent Events acotados: el estado actual y, si no ha terminado, el siguiente cambio (o un
+    latido a los 15 s); luego se cierra y EventSource reconecta. Con hilos gthread un stream abierto
+    durante toda la generación ocuparía un hilo de petición: el front usa polling de /api/jobs/<id>"""
+    user_id = current_user.id  # El generador se ejecuta fuera del contexto de la petición
+    job = jobs.get(job_id, user_id)
+    if job is None: return jsonify({"error": "Trabajo no encontrado"}), 404
+
+    def stream(job):
+        yield f"retry: 1500\ndata: {app.json.dumps(job)}\n\n"
+        if job['status'] in FINISHED: return
+        job = jobs.wait(job_id, user_id, job['version'], timeout=15)
+        if job is not None: yield f"data: {app.json.dumps(job)}\n\n"
+
+    return Response(stream(job), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # --- RUTAS GESTIÓN Y FILTROS ---
 
 @app.route("/api/dashboards", methods=["GET"])
 @login_required
 def list_dashboards():
-    user_dir = os.path.join(DASHBOARD_DIR, current_user.id)
-    if not os.path.exists(user_dir): return jsonify([])
-    
-    items = []
-    for f in os.listdir(user_dir):
-        if f.endswith('.json'):
-            try:
-                with open(os.path.join(user_dir, f)) as file:
-                    d = json.load(file)
-                    items.append({
-                        "id": d['id'], 
-                        "title": d.get('config', {}).get('title', 'Sin Título'), 
-                        "created_at": d.get('created_at')
-                    })
-            except: pass
-    items.sort(key=lambda x: x['created_at'], reverse=True)
-    return jsonify(items)
+    """Historial paginado (?limit=&offset=) desde el índice; el total va en X-Total-Count"""
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "limit/offset no válidos"}), 400
+    items, total = dashboard_store.list(current_user.id, limit, offset)
+    response = jsonify(items)
+    response.headers['X-Total-Count'] = str(total)
+    return response
 
 @app.route("/api/dashboards/<dash_id>", methods=["GET"])
 @login_required
 def get_dashboard(dash_id):
-    path = os.path.join(DASHBOARD_DIR, current_user.id, f"{dash_id}.json")
-    if not os.path.exists(path): return jsonify({"error": "No existe"}), 404
-    with open(path) as f: dash_data = json.load(f)
-    return jsonify(dash_data['config'])
+    dash_data = dashboard_store.load(current_user.id, dash_id)
+    if dash_data is None: return jsonify({"error": "No existe"}), 404
+    config = dash_data['config']
+    if wants_columnar(): config = dict(config, components=columnar_components(config['components']))
+    return jsonify(config)
 
 @app.route("/api/dashboards/<dash_id>", methods=["DELETE"])
 @login_required
 def delete_dashboard(dash_id):
-    path = os.path.join(DASHBOARD_DIR, current_user.id, f"{dash_id}.json")
-    if os.path.exists(path):
-        os.remove(path)
+    if dashboard_store.delete(current_user.id, dash_id):
+        delete_cube(dashboard_store.base_path(current_user.id, dash_id))
+        # El upload se borra cuando ya no lo referencia ningún dashboard
+        upload_store.release(current_user.id, dash_id)
         return jsonify({"message": "Borrado"})
     return jsonify({"error": "No encontrado"}), 404
 
+def cube_results(dash_id, dash_data, full_path, filters):
+    """Componentes resueltos desde el cubo del dashboard ({indice: datos}); vacío si no aplica"""
+    cube_meta = dash_data.get('cube')
+    if not cube_meta or not can_answer(cube_meta, filters): return {}
+    if not os.path.exists(full_path) or list(file_signature(full_path)) != cube_meta.get('source'): return {}
+    try:
+        cube, points, clusters = load_cube(dashboard_store.base_path(current_user.id, dash_id))
+    except Exception as e:
+        print(f"Aviso: cubo ilegible para {dash_id}: {e}")
+        return {}
+    return query_cube(cube_meta, cube, points, clusters, filters, dash_data['config']['components'])
+
 @app.route("/api/dashboards/<dash_id>/filter", methods=["POST"])
 @login_required
 def filter_dashboard(dash_id):
     filters = request.json.get('filters', {})
     
-    path = os.path.join(DASHBOARD_DIR, current_user.id, f"{dash_id}.json")
-    if not os.path.exists(path): return jsonify({"error": "Error carga"}), 404
-    
-    with open(path) as f: dash_data = json.load(f)
+    dash_data = dashboard_store.load(current_user.id, dash_id)
+    if dash_data is None: return jsonify({"error": "Error carga"}), 404
     
     full_path = os.path.join(UPLOAD_FOLDER, dash_data['file_path'])
-    if full_path.endswith('.csv'): df = pd.read_csv(full_path, engine='python')
-    else: df = pd.read_excel(full_path)
-    df.columns = df.columns.str.strip()
+    components = dash_data['config']['components']
+    
+    # 1. Lo que se pueda, desde el cubo pre-agregado
+    results = cube_results(dash_id, dash_data, full_path, filters)
     
-    df_filtered = apply_global_filters(df, filters)
+    # 2. El resto (dimensiones de alta cardinalidad, cubo obsoleto...) con el motor del dataset (engines.py)
+    pending = [i for i in range(len(components)) if i not in results]
+    if pending:
+        pending_components = [components[i] for i in pending]
+        pending_data = get_engine(full_path).components(full_path, pending_components, filters)
+        results.update(zip(pending, pending_data))
     
     updated_components = []
-    for comp in dash_data['config']['components']:
-        new_data = process_component_data(df_filtered, comp)
+    for i, comp in enumerate(components):
+        new_data = results.get(i)
         if new_data:
             comp['data'] = new_data
             updated_components.append(comp)
             
+    if wants_columnar(): updated_components = columnar_components(updated_components)
     return jsonify({
         "components": updated_components,
         "active_filters": filters
     })
 
+@app.route("/api/dashboards/<dash_id>/map/<comp_id>", methods=["POST"])
+@login_required
+def map_viewport(dash_id, comp_id):
+    """Puntos o clusters del mapa para la vista actual (bbox + zoom) con los filtros activos"""
+    body = request.json or {}
+    filters = body.get('filters', {})
+    try:
+        bbox = clip_bbox(body.get('bbox'))
+        zoom = float(body.get('zoom', 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "bbox/zoom no válidos"}), 400
+
+    dash_data = dashboard_store.load(current_user.id, dash_id)
+    if dash_data is None: return jsonify({"error": "Error carga"}), 404
+
+    comp = next((c for c in dash_data['config']['components'] if c.get('type') == 'map' and str(c.get('id')) == comp_id), None)
+    if comp is None: return jsonify({"error": "Mapa no encontrado"}), 404
+    config = comp.get('config', {})
+    lat, lon, label = config.get('lat'), config.get('lon'), config.get('label')
+
+    full_path = os.path.join(UPLOAD_FOLDER, dash_data['file_path'])
+    if not os.path.exists(full_path): return jsonify({"error": "Archivo perdido"}), 404
+
+    if is_streaming(full_path):
+        cols = [lat, lon] + ([label] if label else [])
+        data = query_chunks(get_engine(full_path).chunks(full_path, filters, cols, bbox), cols, bbox, zoom)
+    else:
+        df = get_dataframe(full_path)
+        if lat not in df.columns or lon not in df.columns: return jsonify({"data": []})
+        cols = [lat, lon] + ([label] if label and label in df.columns else [])
+        selection = get_filter_index(df).select(filters) if filters else None
+        data = get_spatial_index(df, lat, lon).query(df, cols, bbox, zoom, selection)
+    return jsonify({"data": to_columnar(data) if wants_columnar() else data})
+
+# --- MÉTRICAS (formato Prometheus) ---
+@app.route("/metrics")
+def metrics_endpoint():
+    # Sin login para el scraper, pero con "Authorization: Bearer <METRICS_TOKEN>". Sin token
+    # configurado solo se sirve en modo debug: las rutas y latencias no se publican por defecto
+    token = os.getenv("METRICS_TOKEN")
+    if not token:
+        if not app.debug: return Response("METRICS_TOKEN no configurado\n", status=403, mimetype='text/plain')
+    elif not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {token}".encode()): return Response(status=401)
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == "__main__":
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,247 @@
+"""Benchmark extremo a extremo: subida, generación y filtrado cruzado a través de Flask.
+
+Genera CSV sintéticos con la forma de los datasets municipales (barri, districte,
+residu, capacitat, any, fecha, peso, LAT/LONG), los sube con el cliente de test,
+genera el dashboard con un Gemini simulado que devuelve siempre el mismo layout
+y lanza filtros variados. Cada tamaño corre en un proceso aparte (RSS pico
+independiente) con DATA_DIR/UPLOAD_FOLDER en un directorio temporal.
+
+Por fase: p50/p95/media en ms, throughput (peticiones/s) y RSS pico del proceso.
+Los resultados se guardan en JSON (--out) y se pueden comparar con otro (--compare):
+sale con código 1 si algún p50 empeora más que --tolerance.
+
+Uso:
+  python benchmarks/bench_app.py --rows 10000 100000 1000000 --out benchmarks/baseline.json
+  python benchmarks/bench_app.py --rows 10000 100000 --compare benchmarks/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+try: import resource
+except ImportError: resource = None  # Windows: sin RSS pico
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BARRIS = [f"Barri {i}" for i in range(40)]
+DISTRICTES = [f"Districte {i}" for i in range(10)]
+RESIDUS = ['Vidre', 'Paper', 'Envasos', 'Orgànica', 'Rebuig']
+
+LAYOUT = {"title": "Contenidors", "components": [
+    {"id": "kpi1", "type": "kpi", "title": "Contenidors", "config": {"operation": "count", "column": "id"}},
+    {"id": "kpi2", "type": "kpi", "title": "Kg recollits", "config": {"operation": "sum", "column": "pes_kg"}},
+    {"id": "chart1", "type": "chart", "chart_type": "bar", "title": "Kg por barri", "config": {"x": "nom_barri", "y": "pes_kg", "operation": "sum", "limit": 10}},
+    {"id": "chart2", "type": "chart", "chart_type": "pie", "title": "Por residu", "config": {"x": "residu", "y": "id", "operation": "count"}},
+    {"id": "map1", "type": "map", "title": "Ubicación", "config": {"lat": "LAT", "lon": "LONG", "label": "nom_barri"}}
+]}
+
+
+def synthetic(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    barri = rng.integers(0, len(BARRIS), rows)
+    return pd.DataFrame({
+        'id': np.arange(rows),
+        'nom_barri': np.array(BARRIS)[barri],
+        'districte': np.array(DISTRICTES)[barri % len(DISTRICTES)],
+        'residu': rng.choice(RESIDUS, rows),
+        'capacitat': rng.choice([800, 1100, 2400, 3200], rows),
+        'any': rng.integers(2011, 2025, rows),
+        'data': (pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 1826, rows), unit='D')).strftime('%Y-%m-%d'),
+        'pes_kg': rng.gamma(2.0, 40.0, rows).round(1),
+        'LAT': 41.30 + rng.random(rows) * 0.05,
+        'LONG': 1.99 + rng.random(rows) * 0.08
+    })
+
+
+def filter_sets(n):
+    """n filtros distintos (igualdad, combinados, IN + rango) para que ninguna respuesta se repita"""
+    out = []
+    for i in range(n):
+        kind = i % 3
+        if kind == 0: out.append({'nom_barri': BARRIS[i % len(BARRIS)]})
+        elif kind == 1: out.append({'residu': RESIDUS[i % len(RESIDUS)], 'districte': DISTRICTES[i % len(DISTRICTES)]})
+        else: out.append({'nom_barri': BARRIS[i % 20:i % 20 + 5], 'any': {'min': 2011 + i % 8, 'max': 2016 + i % 8}})
+    return out
+
+
+def peak_rss_mb():
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)  # bytes en macOS, KB en Linux
+
+
+def summarize(samples):
+    ms = np.array(samples) * 1000
+    return {
+        "n": len(samples),
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+        "mean_ms": round(float(ms.mean()), 2),
+        "throughput_rps": round(len(samples) / float(np.sum(samples)), 2)
+    }
+
+
+# --- UN TAMAÑO (proceso hijo) ---
+
+def run_size(rows, args, workdir):
+    os.environ['DATA_DIR'] = os.path.join(workdir, 'data')
+    os.environ['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    os.environ['LAYOUT_CACHE'] = '0'  # Cada generación pasa por el "LLM"
+    os.environ.setdefault('GEMINI_API_KEY', 'bench')
+    sys.path.insert(0, ROOT)
+    import app as appmod
+
+    class _Response:
+        text = json.dumps(LAYOUT)
+
+    class _Models:
+        def generate_content(self, **kwargs): return _Response()
+
+    class _Client:
+        models = _Models()
+
+    appmod.client = _Client()
+    client = appmod.app.test_client()
+    with appmod.app.app_context(): appmod.save_new_user('bench@local', 'bench')
+    assert client.post('/api/login', json={'email': 'bench@local', 'password': 'bench'}).status_code == 200
+
+    csv_path = os.path.join(workdir, f"contenidors_{rows}.csv")
+    t = time.perf_counter()
+    synthetic(rows, args.seed).to_csv(csv_path, index=False)
+    print(f"[{rows}] CSV sintético ({os.path.getsize(csv_path) / 1e6:.0f} MB) en {time.perf_counter() - t:.1f}s", file=sys.stderr)
+
+    def upload():
+        with open(csv_path, 'rb') as f:
+            r = client.post('/upload_and_analyze', data={'file': (f, 'contenidors.csv')}, content_type='multipart/form-data')
+        assert r.status_code == 200, r.data[:200]
+        return r.get_json()
+
+    def generate(up):
+        r = client.post('/generate_dashboard', json={
+            'file_path': up['file_path'], 'summary': up['summary'], 'instruction': 'bench', 'original_name': up['original_name']
+        })
+        assert r.status_code == 202, r.data[:200]
+        job_id = r.get_json()['id']
+        while True:
+            job = client.get(f"/api/jobs/{job_id}").get_json()
+            if job['status'] == 'done': return job['result']['dashboard_id']
+            if job['status'] == 'error': raise RuntimeError(job['error'])
+            time.sleep(0.005)
+
+    def timed(fn, *a):
+        t = time.perf_counter()
+        result = fn(*a)
+        return time.perf_counter() - t, result
+
+    result = {}
+    elapsed, up = timed(upload)  # En frío: parseo, tipado, caché Parquet y perfil
+    result['upload_cold'] = summarize([elapsed])
+    result['upload_cold']['rows_per_s'] = round(rows / elapsed)
+    # En caliente: mismo contenido -> mismo blob, perfil y DataFrame ya cacheados
+    result['upload_warm'] = summarize([timed(upload)[0] for _ in range(args.repeat)])
+
+    samples, dash_id = [], None
+    for _ in range(args.generate):
+        elapsed, dash_id = timed(generate, up)
+        samples.append(elapsed)
+    result['generate'] = summarize(samples)
+
+    def apply_filter(filters):
+        r = client.post(f"/api/dashboards/{dash_id}/filter", json={'filters': filters})
+        assert r.status_code == 200, r.data[:200]
+
+    result['filter'] = summarize([timed(apply_filter, f)[0] for f in filter_sets(args.filters)])
+    result['get'] = summarize([timed(client.get, f"/api/dashboards/{dash_id}")[0] for _ in range(args.repeat)])
+    result['streaming'] = appmod.is_streaming(os.path.join(appmod.UPLOAD_FOLDER, up['file_path']))
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+# --- ORQUESTACIÓN ---
+
+def environment():
+    try: commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError: commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+
+def compare(current, baseline, tolerance):
+    """Imprime la variación de p50 por fase; devuelve True si alguna empeora más que tolerance"""
+    regressed = False
+    print(f"\n{'filas':>10} {'fase':>12} {'base p50':>10} {'ahora p50':>10} {'Δ':>8}")
+    for rows, phases in current['results'].items():
+        base = baseline.get('results', {}).get(rows)
+        if not base: continue
+        for phase, stats in phases.items():
+            if not isinstance(stats, dict) or phase not in base: continue
+            before, now = base[phase]['p50_ms'], stats['p50_ms']
+            delta = (now - before) / before if before else 0.0
+            flag = ' !' if delta > tolerance else ''
+            regressed |= bool(flag)
+            print(f"{rows:>10} {phase:>12} {before:>10.2f} {now:>10.2f} {delta:>+7.0%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=5, help='subidas en caliente y lecturas del dashboard')
+    parser.add_argument('--generate', type=int, default=3, help='generaciones por tamaño')
+    parser.add_argument('--filters', type=int, default=30, help='peticiones de filtro por tamaño')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='JSON de resultados (p.ej. benchmarks/baseline.json)')
+    parser.add_argument('--compare', help='JSON de una ejecución anterior con el que comparar')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='empeoramiento de p50 tolerado (0.10 = 10%%)')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        with tempfile.TemporaryDirectory(prefix='bench_app_') as workdir:
+            result = run_size(args.worker, args, workdir)
+        with open(args.result_file, 'w') as f: json.dump(result, f)
+        return
+
+    report = {"environment": environment(), "params": {
+        "repeat": args.repeat, "generate": args.generate, "filters": args.filters, "seed": args.seed
+    }, "results": {}}
+    print(f"{'filas':>10} {'fase':>12} {'p50 ms':>10} {'p95 ms':>10} {'req/s':>8} {'RSS MB':>8}")
+    for rows in args.rows:
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f: result_file = f.name
+        try:
+            cmd = [sys.executable, os.path.abspath(__file__), '--worker', str(rows), '--result-file', result_file,
+                   '--repeat', str(args.repeat), '--generate', str(args.generate), '--filters', str(args.filters), '--seed', str(args.seed)]
+            # La salida de la app (prints de diagnóstico) no se mezcla con la tabla
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+            with open(result_file) as f: result = json.load(f)
+        finally: os.remove(result_file)
+        report['results'][str(rows)] = result
+        for phase, stats in result.items():
+            if not isinstance(stats, dict): continue
+            print(f"{rows:>10} {phase:>12} {stats['p50_ms']:>10.2f} {stats['p95_ms']:>10.2f} {stats['throughput_rps']:>8.1f} {result['peak_rss_mb'] or '-':>8}")
+
+    if args.out:
+        with open(args.out, 'w') as f: json.dump(report, f, indent=2)
+        print(f"\nResultados en {args.out}")
+    if args.compare:
+        with open(args.compare) as f: baseline = json.load(f)
+        if compare(report, baseline, args.tolerance): sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
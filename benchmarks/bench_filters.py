@@ -0,0 +1,79 @@
+"""Benchmark del motor de filtros: tiempo por filtro frente a nº de filas y filtros activos.
+
+Compara el escaneo clásico (astype(str) == str(val) por filtro) con el índice
+por columna de filters.py, en frío (incluye construir el índice) y en caliente.
+
+Uso: python benchmarks/bench_filters.py --rows 10000 100000 1000000 --repeat 5
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from filters import FilterIndex  # noqa: E402
+
+BARRIS = [f"Barri {i}" for i in range(40)]
+RESIDUS = ['Vidre', 'Paper', 'Envasos', 'Orgànica', 'Rebuig']
+
+
+def synthetic(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'nom_barri': rng.choice(BARRIS, rows),
+        'residu': rng.choice(RESIDUS, rows),
+        'capacitat': rng.choice([800, 1100, 2400, 3200], rows),
+        'any': rng.integers(2011, 2025, rows),
+        'LAT': 41.30 + rng.random(rows) * 0.02,
+        'LONG': 1.99 + rng.random(rows) * 0.03
+    })
+
+
+FILTER_SETS = [
+    {'nom_barri': 'Barri 3'},
+    {'nom_barri': 'Barri 3', 'residu': 'Vidre'},
+    {'nom_barri': 'Barri 3', 'residu': 'Vidre', 'capacitat': '2400'},
+]
+
+
+def legacy(df, filters):
+    out = df.copy()
+    for col, val in filters.items():
+        out = out[out[col].astype(str) == str(val)]
+    return out
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'filas':>10} {'filtros':>7} {'escaneo ms':>11} {'índice frío ms':>15} {'índice ms':>10} {'x':>6}")
+    for rows in args.rows:
+        df = synthetic(rows)
+        for filters in FILTER_SETS:
+            scan = timed(lambda: legacy(df, filters), args.repeat)
+            cold = timed(lambda: df.iloc[FilterIndex(df).select(filters)], 1)
+            index = FilterIndex(df)
+            index.select(filters)
+            warm = timed(lambda: df.iloc[index.select(filters)], args.repeat)
+            assert legacy(df, filters).index.equals(df.iloc[index.select(filters)].index)
+            print(f"{rows:>10} {len(filters):>7} {scan:>11.2f} {cold:>15.2f} {warm:>10.2f} {scan / warm:>6.1f}")
+        multi = {'nom_barri': BARRIS[:5], 'any': {'min': 2015, 'max': 2018}}
+        print(f"{rows:>10} {'IN+rango':>7} {'-':>11} {'-':>15} {timed(lambda: df.iloc[index.select(multi)], args.repeat):>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Paridad y tiempos de los motores de agregación (engines.py): pandas frente a SQL.
+
+Sobre un CSV sintético (bench_app.synthetic con nulos, booleanos y fechas) evalúa
+los mismos componentes con varios filtros en los dos motores, en memoria y en
+modo streaming, y compara las respuestas serializadas (números con tolerancia relativa
+de 1e-9: el orden de las sumas cambia entre motores, y en JSON 0 y 0.0 son lo mismo). También compara los trozos del mapa por vista.
+Sale con código 1 si alguna respuesta difiere.
+
+Uso: python benchmarks/check_engines.py --rows 200000 1000000
+"""
+import os
+import sys
+import math
+import time
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datasets  # noqa: E402
+from engines import PandasEngine, SQLEngine, duckdb  # noqa: E402
+from serialization import dumps  # noqa: E402
+from spatial import query_chunks  # noqa: E402
+from bench_app import synthetic, BARRIS, RESIDUS  # noqa: E402
+
+try: import orjson as jsonlib
+except ImportError: import json as jsonlib
+
+COMPONENTS = [
+    {"id": "k1", "type": "kpi", "title": "Filas", "config": {"operation": "count"}},
+    {"id": "k2", "type": "kpi", "title": "Kg", "config": {"operation": "sum", "column": "pes_kg"}},
+    {"id": "k3", "type": "kpi", "title": "Media", "config": {"operation": "mean", "column": "pes_kg"}},
+    {"id": "k4", "type": "kpi", "title": "Máx", "config": {"operation": "max", "column": "capacitat"}},
+    {"id": "k5", "type": "kpi", "title": "Mín", "config": {"operation": "min", "column": "pes_kg"}},
+    {"id": "k6", "type": "kpi", "title": "Suma", "config": {"operation": "sum", "column": "capacitat"}},
+    {"id": "c1", "type": "chart", "chart_type": "bar", "title": "Kg", "config": {"x": "nom_barri", "y": "pes_kg", "operation": "sum", "limit": 10}},
+    {"id": "c2", "type": "chart", "chart_type": "pie", "title": "Residu", "config": {"x": "residu", "operation": "count"}},
+    {"id": "c3", "type": "chart", "chart_type": "bar", "title": "Media", "config": {"x": "any", "y": "pes_kg", "operation": "mean"}},
+    {"id": "c4", "type": "chart", "chart_type": "pie", "title": "Barri", "config": {"x": "nom_barri", "operation": "count"}},
+    {"id": "c5", "type": "chart", "chart_type": "bar", "title": "Activo", "config": {"x": "actiu", "y": "capacitat", "operation": "sum"}},
+    {"id": "c6", "type": "chart", "chart_type": "bar", "title": "Alta cardinalidad", "config": {"x": "id", "operation": "count", "limit": 5}},
+    {"id": "t1", "type": "timeseries", "title": "Por día", "config": {"x": "data", "operation": "count"}},
+    {"id": "t2", "type": "timeseries", "title": "Kg", "config": {"x": "data", "y": "pes_kg", "operation": "sum", "granularity": "month"}},
+    {"id": "t3", "type": "timeseries", "title": "Media", "config": {"x": "data", "y": "pes_kg", "operation": "mean", "granularity": "week"}},
+    {"id": "m1", "type": "map", "title": "Mapa", "config": {"lat": "LAT", "lon": "LONG", "label": "nom_barri"}},
+    {"id": "x1", "type": "chart", "title": "Sin columna", "config": {"x": "no_existe", "operation": "count"}}
+]
+
+FILTERS = [
+    {},
+    {'nom_barri': BARRIS[3]},
+    {'nom_barri': BARRIS[3], 'residu': RESIDUS[1]},
+    {'nom_barri': BARRIS[:5], 'any': {'min': 2013, 'max': 2018}},
+    {'capacitat': '2400'},
+    {'capacitat': 2400, 'actiu': 'True'},
+    {'capacitat': '02400'},
+    {'pes_kg': {'min': 50}},
+    {'pes_kg': '80.5', 'LAT': {'max': 41.33}},
+    {'data': {'from': '2021-01-01', 'to': '2021-06-30'}},
+    {'data': '2021-03-04T00:00:00'},
+    {'residu': []},
+    {'no_existe': 'x', 'residu': RESIDUS[0]},
+    {'nom_barri': 'Barri inexistente'}
+]
+
+BBOXES = [[-180, -85, 180, 85], [1.99, 41.30, 2.01, 41.31]]
+
+
+def dataset(rows, seed):
+    df = synthetic(rows, seed)
+    rng = np.random.default_rng(seed + 1)
+    df.loc[rng.random(rows) < 0.05, 'pes_kg'] = np.nan
+    df.loc[rng.random(rows) < 0.02, 'nom_barri'] = None
+    df['actiu'] = rng.random(rows) < 0.7
+    return df
+
+
+def same(a, b):
+    """Igualdad de respuestas JSON con los números comparados con tolerancia relativa"""
+    if isinstance(a, dict): return isinstance(b, dict) and a.keys() == b.keys() and all(same(a[k], b[k]) for k in a)
+    if isinstance(a, list): return isinstance(b, list) and len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    # Como en JavaScript, 0 y 0.0 son el mismo número
+    number = (int, float)
+    if isinstance(a, number) and isinstance(b, number) and not isinstance(a, bool) and not isinstance(b, bool):
+        return math.isclose(a, b, rel_tol=1e-9)
+    return type(a) is type(b) and a == b
+
+
+def payload(data):
+    return jsonlib.loads(dumps(data))
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def check(path, label):
+    pandas_engine, sql_engine = PandasEngine(), SQLEngine()
+    if not datasets.write_clean_parquet(path):
+        print(f"{label}: sin Parquet limpio")
+        return 1
+    failures, times = 0, {'pandas': 0.0, 'sql': 0.0}
+    for filters in FILTERS:
+        expected, t_pandas = timed(pandas_engine.components, path, COMPONENTS, filters)
+        got, t_sql = timed(sql_engine.components, path, COMPONENTS, filters)
+        times['pandas'] += t_pandas
+        times['sql'] += t_sql
+        for comp, a, b in zip(COMPONENTS, expected, got):
+            if not same(payload(a), payload(b)):
+                failures += 1
+                print(f"  DIFERENCIA {label} {comp['id']} filtros={filters}\n    pandas: {str(payload(a))[:300]}\n    sql:    {str(payload(b))[:300]}")
+        for bbox in BBOXES:
+            cols = ['LAT', 'LONG', 'nom_barri']
+            a = query_chunks(datasets.iter_chunks(path, filters), cols, bbox, 14)
+            b = query_chunks(sql_engine.chunks(path, filters, cols, bbox), cols, bbox, 14)
+            if not same(payload(a), payload(b)):
+                failures += 1
+                print(f"  DIFERENCIA {label} mapa bbox={bbox} filtros={filters}")
+    n = len(FILTERS)
+    print(f"{label}: {n} filtros x {len(COMPONENTS)} componentes | pandas {times['pandas'] / n:.1f} ms/petición | "
+          f"sql {times['sql'] / n:.1f} ms/petición | {'OK' if not failures else f'{failures} diferencias'}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[200_000])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if duckdb is None:
+        print("duckdb no está instalado: no hay motor SQL que comparar")
+        return 1
+
+    failures = 0
+    threshold = datasets.STREAMING_THRESHOLD
+    with tempfile.TemporaryDirectory() as workdir:
+        for rows in args.rows:
+            path = os.path.join(workdir, f"synthetic_{rows}.csv")
+            dataset(rows, args.seed).to_csv(path, index=False)
+            try:
+                datasets.STREAMING_THRESHOLD = float('inf')
+                failures += check(path, f"{rows} filas, en memoria")
+                datasets.STREAMING_THRESHOLD = 0
+                failures += check(path, f"{rows} filas, streaming")
+            finally: datasets.STREAMING_THRESHOLD = threshold
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""Paridad del lector de Excel en streaming (datasets.read_excel_sheet) con pd.read_excel.
+
+Lee cada hoja de los .xlsx subidos (o de los ficheros indicados) con los dos
+lectores y compara columnas, tipos y valores. También la escribe con
+write_excel_parquet (en lotes pequeños, para cruzar sus límites) y compara lo que
+se relee. Sale con código 1 si alguna difiere.
+
+Uso: python benchmarks/check_excel.py [ficheros.xlsx ...]
+"""
+import os
+import sys
+import glob
+import time
+import tempfile
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from datasets import read_excel_sheet, write_excel_parquet, excel_sheets  # noqa: E402
+
+
+def compare(path, sheet):
+    """Lista de diferencias entre pd.read_excel y read_excel_sheet (vacía si coinciden)"""
+    start = time.perf_counter()
+    expected = pd.read_excel(path, sheet_name=sheet)
+    t_pandas = time.perf_counter() - start
+    start = time.perf_counter()
+    got = read_excel_sheet(path, sheet)
+    t_stream = time.perf_counter() - start
+    if list(expected.columns) != list(got.columns): return [f"columnas {list(expected.columns)} != {list(got.columns)}"], t_pandas, t_stream
+    diffs = [f"'{c}': {expected[c].dtype} != {got[c].dtype}" for c in expected.columns if str(expected[c].dtype) != str(got[c].dtype)]
+    if not diffs:
+        try: pd.testing.assert_frame_equal(expected, got)
+        except AssertionError as e: diffs.append(str(e).splitlines()[0])
+    if not diffs: diffs = compare_parquet(path, sheet, expected)
+    return diffs, t_pandas, t_stream
+
+
+def compare_parquet(path, sheet, expected, batch_rows=1000):
+    """Diferencias entre pd.read_excel y el Parquet de write_excel_parquet. Las columnas mixtas
+    se guardan como texto, así que se comparan como texto"""
+    with tempfile.TemporaryDirectory() as tmp:
+        target = os.path.join(tmp, 'sheet.parquet')
+        write_excel_parquet(path, sheet, target, batch_rows=batch_rows)
+        got = pd.read_parquet(target)
+    expected = expected.copy()
+    for c in expected.columns:
+        if expected[c].dtype != object: continue
+        if got[c].dtype != object: expected[c] = expected[c].where(expected[c].isna(), expected[c].astype(str)).astype(got[c].dtype)
+        else: expected[c], got[c] = expected[c].astype(str), got[c].where(got[c].notna(), float('nan')).astype(str)
+    try: pd.testing.assert_frame_equal(expected, got)
+    except AssertionError as e: return ["parquet: " + str(e).splitlines()[0]]
+    return []
+
+
+def main():
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join(ROOT, 'static', 'uploads', '*', '*.xlsx')))
+    failures = 0
+    for path in paths:
+        for sheet in excel_sheets(path):
+            diffs, t_pandas, t_stream = compare(path, sheet)
+            failures += bool(diffs)
+            status = 'OK' if not diffs else 'DIFERENCIA: ' + '; '.join(diffs)
+            print(f"{os.path.basename(path)} [{sheet}]: read_excel {t_pandas * 1000:.0f} ms | streaming {t_stream * 1000:.0f} ms | {status}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
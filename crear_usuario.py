@@ -1,14 +1,15 @@
-import json
-import uuid
 import os
 from flask import Flask
 from flask_bcrypt import Bcrypt
 
+from users import UserRepository
+
 # Configuración mínima para usar Bcrypt
 app = Flask(__name__)
 bcrypt = Bcrypt(app)
 
-DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+# Mismo directorio de datos que app.py (DATA_DIR permite llevarlo fuera del código)
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
 USERS_FILE = os.path.join(DATA_DIR, 'users.json')
 
 if not os.path.exists(DATA_DIR):
@@ -19,26 +20,20 @@ def create_admin():
     email = input("Email: ")
     password = input("Contraseña: ")
 
-    if not os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'w') as f: json.dump({}, f)
-
-    with open(USERS_FILE, 'r') as f: 
-        users = json.load(f)
+    # Mismo repositorio que la app: escritura atómica y con lock
+    repo = UserRepository(USERS_FILE)
 
     # Verificar si existe
-    for uid, data in users.items():
-        if data['email'] == email:
-            print("¡Error! Ese email ya existe.")
-            return
+    if repo.get_by_email(email):
+        print("¡Error! Ese email ya existe.")
+        return
 
     # Crear usuario
-    uid = str(uuid.uuid4())
     pw_hash = bcrypt.generate_password_hash(password).decode('utf-8')
-    
-    users[uid] = {'email': email, 'password': pw_hash}
-    
-    with open(USERS_FILE, 'w') as f: 
-        json.dump(users, f)
+    _, created = repo.create(email, pw_hash)
+    if not created:
+        print("¡Error! Ese email ya existe.")
+        return
     
     print(f"✅ Usuario {email} creado exitosamente.")
 
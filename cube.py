@@ -0,0 +1,275 @@
+import os
+import uuid
+import pickle
+import pandas as pd
+
+from insights import apply_global_filters, finalize_chart, to_number
+from datasets import cached_frame, write_parquet
+from spatial import PointAggregator, numeric_points, mercator, cell_keys, MAX_POINTS, OVERVIEW_LEVEL
+
+# --- CUBO DE PRE-AGREGACIÓN PARA CROSS-FILTER ---
+# Al crear el dashboard se agrupa el dataset por las dimensiones filtrables
+# (las 'x' de los gráficos) guardando parciales sum/min/max por medida y el
+# número de filas por celda. Los filtros de igualdad se resuelven entonces
+# sobre el cubo (miles de celdas) en vez de sobre las filas originales.
+
+MAX_DIM_CARDINALITY = 1000  # Dimensiones con más valores distintos van por filas
+MAX_CUBE_CELLS = 100_000
+MAX_CUBE_POINTS = 50_000  # Puntos de mapa precalculados (primeros N por celda)
+MAX_CUBE_CLUSTERS = 200_000  # Parciales de cluster (celda del cubo x celda de la rejilla)
+
+ROWS_COL = '__rows'
+ROW_ID_COL = '__row'
+CELL_COL = '__cell'
+CLUSTER_COLS = {'__count': 'count', '__lat': 'lat', '__lon': 'lon'}
+KPI_OPS = ('sum', 'mean', 'max', 'min')
+
+
+def _measure_cols(m):
+    return f"{m}__sum", f"{m}__min", f"{m}__max"
+
+
+def _plan(df, components):
+    """Decide dimensiones (x de gráficos de baja cardinalidad) y medidas (KPIs e y de gráficos)"""
+    dims, measures = [], []
+    for comp in components:
+        config = comp.get('config', {})
+        if comp.get('type') == 'chart':
+            x, y = config.get('x'), config.get('y')
+            if x in df.columns and x not in dims: dims.append(x)
+            if config.get('operation', 'count') != 'count' and y in df.columns and y not in measures: measures.append(y)
+        elif comp.get('type') == 'kpi':
+            col = config.get('column')
+            if config.get('operation', 'count') in KPI_OPS and col in df.columns and col not in measures: measures.append(col)
+
+    cardinality = {d: df[d].nunique(dropna=False) for d in dims}
+    dims = sorted([d for d in dims if cardinality[d] <= MAX_DIM_CARDINALITY], key=lambda d: cardinality[d])
+    # Si la combinación es demasiado grande, soltamos las dimensiones de mayor cardinalidad
+    while dims and len(df[dims].drop_duplicates()) > MAX_CUBE_CELLS:
+        dims.pop()
+    return dims, measures
+
+
+def _aggregate(df, dims, measures):
+    """Celdas del cubo de df y la agregación de cada columna (para poder fusionar cubos)"""
+    frame = pd.DataFrame({d: df[d] for d in dims}, index=df.index)
+    frame[ROWS_COL] = 1
+    aggs = {ROWS_COL: 'sum'}
+    for m in measures:
+        s_col, min_col, max_col = _measure_cols(m)
+        # Misma semántica que process_component_data: no numéricos cuentan como 0
+        values = to_number(df[m])
+        frame[s_col], frame[min_col], frame[max_col] = values, values, values
+        aggs.update({s_col: 'sum', min_col: 'min', max_col: 'max'})
+
+    if dims: cube = frame.groupby(dims, dropna=False, observed=True, sort=False).agg(aggs).reset_index()
+    else: cube = frame[list(aggs)].agg(aggs).to_frame().T
+    return cube, aggs
+
+
+def _map_config(components):
+    for comp in components:
+        if comp.get('type') == 'map': return comp.get('config', {})
+    return None
+
+
+def build_cube(df, components):
+    """Construye el cubo para los componentes del dashboard. Devuelve (meta, cubo, puntos, clusters)"""
+    dims, measures = _plan(df, components)
+    cube, _ = _aggregate(df, dims, measures)
+
+    points = clusters = None
+    config = _map_config(components)
+    if config is not None: points, clusters = _build_points(df, dims, config)
+
+    meta = {
+        "dims": dims,
+        "measures": measures,
+        "columns": list(df.columns),
+        "has_points": points is not None,
+        "cluster_level": OVERVIEW_LEVEL
+    }
+    return meta, cube, points, clusters
+
+
+def _build_points(df, dims, config, row_offset=0):
+    """Primeros MAX_POINTS puntos válidos de cada celda (basta para reproducir el head() filtrado)
+    y parciales de cluster por celda del cubo y de la rejilla general (spatial.overview).
+    row_offset: posición en el dataset completo de la primera fila de df (filas añadidas)"""
+    lat, lon, label = config.get('lat'), config.get('lon'), config.get('label')
+    if lat not in df.columns or lon not in df.columns: return None, None
+    cols = [lat, lon] + ([label] if label and label in df.columns else [])
+    valid = numeric_points(df, cols, lat, lon)
+    frame = valid.assign(**{d: df[d] for d in dims if d not in cols}, **{ROW_ID_COL: row_offset + df.index.get_indexer(valid.index)})
+    if dims: points = frame.groupby(dims, dropna=False, observed=True, sort=False).head(MAX_POINTS)
+    else: points = frame.head(MAX_POINTS)
+    if len(points) > MAX_CUBE_POINTS: return None, None
+
+    mx, my = mercator(valid[lat].to_numpy(float), valid[lon].to_numpy(float))
+    parts = pd.DataFrame({d: frame[d] for d in dims}, index=frame.index).assign(**{
+        CELL_COL: cell_keys(mx, my, OVERVIEW_LEVEL), '__count': 1, '__lat': valid[lat], '__lon': valid[lon]
+    })
+    clusters = parts.groupby(dims + [CELL_COL], dropna=False, observed=True, sort=False).sum().reset_index()
+    if len(clusters) > MAX_CUBE_CLUSTERS: return None, None
+    return points.reset_index(drop=True), clusters
+
+
+def extend_cube(meta, cube, points, clusters, chunks, components):
+    """Cubo (y puntos/clusters) ampliado con las filas nuevas (lista de trozos), con las mismas
+    dimensiones y medidas. None si ya hay demasiadas celdas (hay que reconstruirlo con otras
+    dimensiones); si lo que no cabe son los puntos, como en build_cube, el mapa va por filas"""
+    if not chunks: return cube, points, clusters
+    df = pd.concat(chunks, ignore_index=True)
+    dims, measures = meta['dims'], meta['measures']
+    if any(c not in df.columns for c in dims + measures): return None
+    row_offset = int(cube[ROWS_COL].sum())
+    part, aggs = _aggregate(df, dims, measures)
+    merged = pd.concat([cube, part], ignore_index=True)
+    # Las celdas antiguas conservan su orden y las nuevas van detrás, como al agrupar el fichero entero
+    if dims: merged = merged.groupby(dims, dropna=False, observed=True, sort=False).agg(aggs).reset_index()
+    else: merged = merged[list(aggs)].agg(aggs).to_frame().T
+    if len(merged) > MAX_CUBE_CELLS: return None
+
+    if not meta.get('has_points') or points is None or clusters is None: return merged, None, None
+    new_points, new_clusters = _build_points(df, dims, _map_config(components) or {}, row_offset)
+    if new_points is None: return merged, None, None
+    points = pd.concat([points, new_points], ignore_index=True)
+    if dims: points = points.groupby(dims, dropna=False, observed=True, sort=False).head(MAX_POINTS)
+    else: points = points.head(MAX_POINTS)
+    clusters = pd.concat([clusters, new_clusters], ignore_index=True)
+    clusters = clusters.groupby(dims + [CELL_COL], dropna=False, observed=True, sort=False).sum().reset_index()
+    if len(points) > MAX_CUBE_POINTS or len(clusters) > MAX_CUBE_CLUSTERS: return merged, None, None
+    return merged, points.reset_index(drop=True), clusters
+
+
+# --- PERSISTENCIA ---
+
+def cube_paths(base):
+    return base + '.cube.parquet', base + '.points.parquet', base + '.clusters.parquet'
+
+
+def save_cube(base, cube, points, clusters):
+    cube_file, points_file, clusters_file = cube_paths(base)
+    write_parquet(cube, cube_file)
+    for frame, path in ((points, points_file), (clusters, clusters_file)):
+        if frame is not None: write_parquet(frame, path)
+        elif os.path.exists(path): os.remove(path)  # De una versión anterior del cubo
+
+
+def load_cube(base):
+    cube_file, points_file, clusters_file = cube_paths(base)
+    cube = cached_frame(cube_file, pd.read_parquet)
+    points = cached_frame(points_file, pd.read_parquet) if os.path.exists(points_file) else None
+    clusters = cached_frame(clusters_file, pd.read_parquet) if os.path.exists(clusters_file) else None
+    return cube, points, clusters
+
+
+def delete_cube(base):
+    for path in cube_paths(base) + (base + STATE_SUFFIX,):
+        if os.path.exists(path): os.remove(path)
+
+
+# --- PARCIALES PARA EL REFRESCO INCREMENTAL ---
+# Estado de insights.accumulate_components (sumas, conteos por grupo, parciales
+# diarios, puntos...) del fichero con el que se calculó el dashboard. Son objetos
+# pandas y de spatial, así que van en pickle: solo los escribe y lee el servidor.
+
+STATE_SUFFIX = '.state.pkl'
+
+
+def save_state(base, state, source):
+    """source: firma del fichero de origen (datasets.file_signature)"""
+    path = base + STATE_SUFFIX
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with open(tmp, 'wb') as f: pickle.dump({"source": list(source), "state": state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError as e: print(f"Aviso: no se pudieron guardar los parciales de {os.path.basename(base)}: {e}")
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+
+def load_state(base, source):
+    """Parciales guardados si se calcularon sobre ese fichero (misma firma), si no None"""
+    try:
+        with open(base + STATE_SUFFIX, 'rb') as f: data = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError): return None
+    return data['state'] if data.get('source') == list(source) else None
+
+
+# --- CONSULTA ---
+
+def can_answer(meta, filters):
+    """El cubo responde si todos los filtros caen en dimensiones (o en columnas inexistentes, que se ignoran)"""
+    return all(col in meta['dims'] or col not in meta['columns'] for col in (filters or {}))
+
+
+def query_component(meta, cube, points, clusters, component):
+    """Datos del componente calculados desde el cubo ya filtrado, o None si hace falta ir a las filas"""
+    c_type = component.get('type')
+    config = component.get('config', {})
+    columns, measures = meta['columns'], meta['measures']
+
+    if c_type == 'kpi':
+        op = config.get('operation', 'count')
+        col = config.get('column')
+        val = 0
+        if op == 'count': val = int(cube[ROWS_COL].sum())
+        elif col and col in columns:
+            if op in KPI_OPS and col not in measures: return None
+            s_col, min_col, max_col = _measure_cols(col)
+            if op == 'sum': val = cube[s_col].sum()
+            elif op == 'mean': val = cube[s_col].sum() / cube[ROWS_COL].sum()
+            elif op == 'max': val = cube[max_col].max()
+            elif op == 'min': val = cube[min_col].min()
+        return {"value": val, "label": component.get('title')}
+
+    elif c_type == 'map':
+        lat, lon, label = config.get('lat'), config.get('lon'), config.get('label')
+        if lat not in columns or lon not in columns: return []
+        if points is None or clusters is None or meta.get('cluster_level') != OVERVIEW_LEVEL: return None
+        cols = [lat, lon] + ([label] if label and label in columns else [])
+        if any(c not in points.columns for c in cols): return None
+        # Mismo resultado que spatial.overview sobre las filas filtradas
+        agg = PointAggregator(cols, lat, lon)
+        agg.add_points(points.sort_values(ROW_ID_COL).head(MAX_POINTS)[cols])
+        partials = clusters.groupby(CELL_COL, sort=False)[list(CLUSTER_COLS)].sum().rename(columns=CLUSTER_COLS)
+        agg.add_partials(partials)
+        return agg.result()
+
+    elif c_type == 'chart':
+        x, y = config.get('x'), config.get('y')
+        op = config.get('operation', 'count')
+        if not x or x not in columns: return []
+        if x not in meta['dims']: return None
+        cells = cube[cube[x].notna()]
+        if op == 'count':
+            # sort=False: empates en orden de aparición, igual que el camino por filas
+            df_res = cells.groupby(x, observed=True, sort=False)[ROWS_COL].sum().reset_index()
+        elif y and y in columns:
+            if y not in measures: return None
+            grouped = cells.groupby(x, observed=True)
+            s_col = _measure_cols(y)[0]
+            if op == 'mean': df_res = (grouped[s_col].sum() / grouped[ROWS_COL].sum()).reset_index()
+            else: df_res = grouped[s_col].sum().reset_index()
+        else:
+            return []
+        df_res.columns = [x, 'value']
+        return finalize_chart(df_res, x, component.get('chart_type'), config.get('limit', 20))
+
+    return None
+
+
+def query_cube(meta, cube, points, clusters, filters, components):
+    """Resuelve los componentes desde el cubo. Devuelve {indice: datos} de los que pudo calcular"""
+    cube = apply_global_filters(cube, filters)
+    if points is not None: points = apply_global_filters(points, filters)
+    if clusters is not None: clusters = apply_global_filters(clusters, filters)
+    results = {}
+    for i, comp in enumerate(components):
+        try: data = query_component(meta, cube, points, clusters, comp)
+        except Exception as e:
+            print(f"Error cubo en componente {comp.get('id')}: {e}")
+            data = None
+        if data is not None: results[i] = data
+    return results
@@ -0,0 +1,127 @@
+import os
+import json
+import uuid
+import sqlite3
+from contextlib import closing
+
+# --- ALMACÉN DE DASHBOARDS ---
+# Cada dashboard sigue en data/dashboards/<user>/<id>.json (config + datos de
+# los componentes), pero sus metadatos (título, fecha, fichero de origen)
+# viven en un índice SQLite: el historial se lista con una consulta por
+# (user_id, created_at) sin abrir ningún JSON.
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dashboards (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    title TEXT,
+    created_at TEXT,
+    file_path TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_dashboards_user_created ON dashboards (user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_dashboards_user_file ON dashboards (user_id, file_path);
+"""
+
+
+class DashboardStore:
+    """Documentos JSON por dashboard + índice de metadatos en SQLite"""
+
+    def __init__(self, root, db_path):
+        self.root = root
+        self.db_path = db_path
+        os.makedirs(root, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")  # Lecturas concurrentes con un escritor
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def base_path(self, user_id, dash_id):
+        """Ruta sin extensión: <base>.json y ficheros asociados (cubo...)"""
+        return os.path.join(self.root, user_id, dash_id)
+
+    def _upsert(self, conn, user_id, dash):
+        conn.execute(
+            "INSERT OR REPLACE INTO dashboards (id, user_id, title, created_at, file_path) VALUES (?, ?, ?, ?, ?)",
+            (dash['id'], user_id, dash.get('config', {}).get('title', 'Sin Título'), dash.get('created_at'), dash.get('file_path'))
+        )
+
+    def save(self, user_id, dash):
+        """Escritura atómica del JSON (tmp + rename) y después alta/actualización en el índice"""
+        path = self.base_path(user_id, dash['id']) + '.json'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open(tmp, 'w') as f: json.dump(dash, f)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+        with closing(self._connect()) as conn, conn:
+            self._upsert(conn, user_id, dash)
+
+    def exists(self, user_id, dash_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT 1 FROM dashboards WHERE id = ? AND user_id = ?", (dash_id, user_id)).fetchone()
+        return row is not None
+
+    def load(self, user_id, dash_id):
+        """Dashboard completo, o None si no está en el índice del usuario o el fichero falta"""
+        if not self.exists(user_id, dash_id): return None
+        try:
+            with open(self.base_path(user_id, dash_id) + '.json') as f: return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Aviso: dashboard {dash_id} ilegible: {e}")
+            return None
+
+    def delete(self, user_id, dash_id):
+        with closing(self._connect()) as conn, conn:
+            deleted = conn.execute("DELETE FROM dashboards WHERE id = ? AND user_id = ?", (dash_id, user_id)).rowcount
+        if not deleted: return False
+        path = self.base_path(user_id, dash_id) + '.json'
+        if os.path.exists(path): os.remove(path)
+        return True
+
+    def list(self, user_id, limit=PAGE_SIZE, offset=0):
+        """Página de metadatos (más recientes primero) y total de dashboards del usuario"""
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, title, created_at FROM dashboards WHERE user_id = ? ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (user_id, limit, max(0, int(offset)))
+            ).fetchall()
+            total = conn.execute("SELECT COUNT(*) FROM dashboards WHERE user_id = ?", (user_id,)).fetchone()[0]
+        return [dict(r) for r in rows], total
+
+    def ids_for_file(self, user_id, file_path):
+        """Dashboards del usuario calculados sobre ese fichero (para refrescarlos juntos)"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT id FROM dashboards WHERE user_id = ? AND file_path = ? ORDER BY created_at", (user_id, file_path)).fetchall()
+        return [r[0] for r in rows]
+
+    def migrate(self):
+        """Indexa los JSON de data/dashboards/<user>/ que aún no están en el índice"""
+        with closing(self._connect()) as conn:
+            known = {r[0] for r in conn.execute("SELECT id FROM dashboards")}
+        added = 0
+        for user_id in os.listdir(self.root):
+            user_dir = os.path.join(self.root, user_id)
+            if not os.path.isdir(user_dir): continue
+            for name in os.listdir(user_dir):
+                if not name.endswith('.json') or name[:-5] in known: continue
+                try:
+                    with open(os.path.join(user_dir, name)) as f: dash = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"Aviso: no se pudo migrar {user_id}/{name}: {e}")
+                    continue
+                dash['id'] = name[:-5]  # El nombre del fichero manda
+                with closing(self._connect()) as conn, conn:
+                    self._upsert(conn, user_id, dash)
+                added += 1
+        if added: print(f"Índice de dashboards: {added} migrados")
+        return added
@@ -0,0 +1,692 @@
+import os
+import json
+import datetime
+import uuid
+import pickle
+import hashlib
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import openpyxl
+
+from insights import clean_dataframe, apply_global_filters
+from metrics import span
+
+# --- CACHÉ COLUMNAR DE DATASETS ---
+# Cada upload se parsea una sola vez y se guarda en Parquet junto al fichero
+# original (<upload>.parquet). El sidecar <upload>.meta.json guarda mtime,
+# tamaño y hash del original para saber cuándo la caché está obsoleta.
+
+CACHE_SUFFIX = '.parquet'
+META_SUFFIX = '.meta.json'
+HASH_BLOCK = 1024 * 1024
+
+
+def cache_path(path):
+    return path + CACHE_SUFFIX
+
+
+def meta_path(path):
+    return path + META_SUFFIX
+
+
+def file_hash(path):
+    """SHA-256 del fichero leyendo por bloques"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_source(path):
+    """Parsea el fichero original (CSV, Excel o una hoja ya convertida a Parquet)"""
+    if path.endswith('.csv'):
+        try: df = pd.read_csv(path, low_memory=False)
+        except (pd.errors.ParserError, UnicodeDecodeError):
+            # Ficheros irregulares: el motor Python es más tolerante
+            df = pd.read_csv(path, engine='python', encoding_errors='replace')
+    elif path.endswith(CACHE_SUFFIX): df = pd.read_parquet(path)
+    elif is_workbook(path): df = read_excel_sheet(path)
+    else: df = pd.read_excel(path)  # .xls (formato binario antiguo)
+    df.columns = df.columns.astype(str).str.strip()
+    return df
+
+
+# --- EXCEL EN STREAMING ---
+# Los .xlsx se leen con openpyxl en modo read_only: las filas se recorren en
+# streaming sin montar el árbol XML del libro, que es lo que dispara la memoria
+# de pd.read_excel. Cada hoja elegida se convierte una sola vez a Parquet y ese
+# Parquet pasa a ser el dataset (ver app.excel_dataset): el libro no se vuelve
+# a abrir. <libro>.sheets.json recuerda las hojas y sus conversiones.
+
+WORKBOOK_EXTENSIONS = ('.xlsx', '.xlsm')
+SHEETS_SUFFIX = '.sheets.json'
+EXCEL_BATCH_ROWS = 50_000  # Filas por lote al convertir una hoja a Parquet
+NUMERIC_CHECK_BATCH = 4096  # Textos que se acumulan antes de comprobar con pd.to_numeric si son números
+
+
+def is_workbook(path):
+    return path.lower().endswith(WORKBOOK_EXTENSIONS)
+
+
+def excel_sheets(path):
+    """Nombres de las hojas de datos del libro (sin leer sus celdas)"""
+    wb = openpyxl.load_workbook(path, read_only=True)
+    try: return [ws.title for ws in wb.worksheets]
+    finally: wb.close()
+
+
+def _header_names(header, width):
+    """Cabecera como la de pd.read_excel: vacías -> 'Unnamed: i', repetidas -> 'x.1', 'x.2'..."""
+    names, seen = [], {}
+    for i in range(width):
+        value = header[i] if i < len(header) else None
+        name = f"Unnamed: {i}" if value is None or str(value).strip() == '' else str(value).strip()
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else: seen[name] = 0
+        names.append(name)
+    return names
+
+
+class _ColumnScan:
+    """Lo que se sabe de una columna tras la primera pasada: nulos, tipos de valor vistos y si
+    todos sus valores son numéricos (según pd.to_numeric, sobre lotes de textos pendientes)"""
+
+    def __init__(self):
+        self.nulls = 0
+        self.kinds = set()
+        self.numeric = True
+        self.integral = True
+        self.sample = None  # Un valor de tipo no estándar (hora, duración...) para su tipo Arrow
+        self._pending = []
+
+    def add(self, value):
+        if value is None:
+            self.nulls += 1
+            return
+        if isinstance(value, bool): kind = 'bool'
+        elif isinstance(value, (int, float)):
+            kind = 'num'
+            if isinstance(value, float): self.integral = False
+        elif isinstance(value, str):
+            kind = 'str'
+            if self.numeric:
+                self._pending.append(value)
+                if len(self._pending) >= NUMERIC_CHECK_BATCH: self._check()
+        elif isinstance(value, datetime.datetime): kind = 'datetime'
+        else:
+            kind = type(value).__name__
+            self.sample = value
+        self.kinds.add(kind)
+
+    def _check(self):
+        parsed = pd.to_numeric(pd.Series(self._pending, dtype=object), errors='coerce')
+        if parsed.isna().any(): self.numeric = False
+        elif parsed.dtype.kind not in 'iu': self.integral = False
+        self._pending = []
+
+    def plan(self):
+        """(tipo, tipo Arrow) final, con las reglas del parser de pd.read_excel: numérica si todos los
+        valores lo son (los booleanos cuentan como 0/1 salvo en columnas solo booleanas y completas),
+        int64 solo sin nulos; texto, fechas u object (nulos como NaN) en otro caso"""
+        if self._pending: self._check()
+        if not self.kinds: return 'float', pa.float64()  # Sin ningún valor, como en read_excel
+        if self.kinds == {'bool'} and not self.nulls: return 'bool', pa.bool_()
+        if self.kinds <= {'num', 'str', 'bool'} and ('str' not in self.kinds or self.numeric):
+            return ('int', pa.int64()) if self.integral and not self.nulls else ('float', pa.float64())
+        if self.kinds == {'str'}: return 'str', pa.large_string()
+        if self.kinds == {'datetime'}: return 'datetime', pa.timestamp('us')
+        if len(self.kinds) == 1 and self.sample is not None:
+            try: return 'object', pa.array([self.sample]).type
+            except (pa.ArrowInvalid, pa.ArrowTypeError): pass
+        return 'mixed', pa.large_string()  # Tipos mezclados: en Parquet, como texto
+
+
+def _scan_sheet(path, sheet, spool, batch_rows):
+    """Única lectura del libro (la hoja indicada o la primera): vuelca las filas a spool en lotes
+    (pickle) mientras reúne lo que decide el tipo de cada columna. Devuelve (filas con datos,
+    columnas [(nombre, tipo, tipo Arrow)])"""
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = (wb[sheet] if sheet else wb.worksheets[0]).iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        scans = [_ColumnScan() for _ in header]
+        batch, count, last = [], 0, 0
+        for row in rows:
+            count += 1
+            while len(scans) < len(row):
+                scans.append(_ColumnScan())
+                scans[-1].nulls = count - 1  # Columna que aparece ahora: vacía en las filas anteriores
+            empty = True
+            for scan, value in zip(scans, row):
+                scan.add(value)
+                if value is not None: empty = False
+            for scan in scans[len(row):]: scan.add(None)
+            if not empty: last = count
+            batch.append(row)
+            if len(batch) == batch_rows:
+                pickle.dump(batch, spool, pickle.HIGHEST_PROTOCOL)
+                batch = []
+        if batch: pickle.dump(batch, spool, pickle.HIGHEST_PROTOCOL)
+    finally: wb.close()
+    # Las filas vacías del final (formato aplicado a celdas sin datos) no son registros; tampoco
+    # cuentan en los nulos de las columnas
+    for scan in scans: scan.nulls -= count - last
+    # Columnas de relleno del final: sin cabecera y sin ningún valor (las intermedias se conservan, como en read_excel)
+    keep = len(scans)
+    while keep and (keep > len(header) or header[keep - 1] is None) and not scans[keep - 1].kinds: keep -= 1
+    names = _header_names(header, keep)
+    return last, [(name, *scan.plan()) for name, scan in zip(names, scans)]
+
+
+def _typed_batch(rows, columns):
+    """DataFrame del lote con los tipos decididos al leer la hoja entera (iguales en todos los lotes)"""
+    width = len(columns)
+    df = pd.DataFrame([tuple(row[:width]) + (None,) * (width - len(row)) for row in rows], columns=range(width), dtype=object)
+    for i, (name, kind, _) in enumerate(columns):
+        s = df[i]
+        if kind == 'int': df[i] = pd.to_numeric(s).astype('int64')
+        elif kind == 'float': df[i] = pd.to_numeric(s, errors='coerce').astype('float64')
+        elif kind == 'bool': df[i] = s.astype(bool)
+        elif kind == 'str': df[i] = s.astype('str')
+        elif kind == 'datetime': df[i] = pd.to_datetime(s).astype('datetime64[us]')
+        else: df[i] = s.where(s.notna(), np.nan)
+    df.columns = [name for name, _, _ in columns]
+    return df
+
+
+def _sheet_batches(spool, total, columns):
+    """Lotes tipados de las total primeras filas de datos, releídos del spool"""
+    spool.seek(0)
+    seen = 0
+    while seen < total:
+        batch = pickle.load(spool)[:total - seen]
+        seen += len(batch)
+        yield _typed_batch(batch, columns)
+    if not total: yield _typed_batch([], columns)
+
+
+def read_excel_sheet(path, sheet=None, batch_rows=EXCEL_BATCH_ROWS):
+    """Hoja del libro (la primera si no se indica) como DataFrame, con los tipos de pd.read_excel"""
+    with tempfile.TemporaryFile() as spool:
+        total, columns = _scan_sheet(path, sheet, spool, batch_rows)
+        frames = list(_sheet_batches(spool, total, columns))
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+
+def write_excel_parquet(path, sheet, target, batch_rows=EXCEL_BATCH_ROWS):
+    """Convierte la hoja a Parquet por lotes de filas (ParquetWriter): la memoria la marca el lote,
+    no la hoja. Los tipos de cada columna dependen de todos sus valores, así que las filas pasan
+    primero por un spool en disco y se escriben después, ya tipadas"""
+    with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(target))) as spool:
+        total, columns = _scan_sheet(path, sheet, spool, batch_rows)
+        schema = pa.schema([(name, arrow_type) for name, _, arrow_type in columns])
+        mixed = [name for name, kind, _ in columns if kind == 'mixed']
+
+        def writer(tmp):
+            with pq.ParquetWriter(tmp, schema) as out:
+                for df in _sheet_batches(spool, total, columns):
+                    for name in mixed: df[name] = df[name].where(df[name].isna(), df[name].astype(str))
+                    out.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+        _write_atomic(target, writer)
+
+
+def _arrow_safe(df):
+    """Columnas object con tipos mezclados no se pueden escribir en Parquet: las pasamos a texto"""
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def _read_meta(path):
+    try:
+        with open(meta_path(path)) as f: return json.load(f)
+    except (OSError, ValueError): return None
+
+
+def _write_atomic(target, writer):
+    tmp = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        writer(tmp)
+        os.replace(tmp, target)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+
+def _write_meta(path, meta):
+    def writer(tmp):
+        with open(tmp, 'w') as f: json.dump(meta, f)
+    _write_atomic(meta_path(path), writer)
+
+
+def write_parquet(df, target):
+    """Escritura atómica a Parquet, degradando a texto las columnas object con tipos mezclados"""
+    try: _write_atomic(target, lambda tmp: df.to_parquet(tmp, index=False))
+    except (TypeError, ValueError):
+        # ArrowTypeError / ArrowInvalid: tipos mezclados en columnas object
+        _write_atomic(target, lambda tmp: _arrow_safe(df).to_parquet(tmp, index=False))
+
+
+def ingest(path):
+    """Parsea el original y regenera la caché Parquet. Devuelve el DataFrame"""
+    st = os.stat(path)
+    df = read_source(path)
+    try:
+        write_parquet(df, cache_path(path))
+        _write_meta(path, {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha256": file_hash(path)})
+    except Exception as e:
+        # La caché es una optimización: si falla, seguimos con el DataFrame parseado
+        print(f"Aviso: no se pudo cachear {path}: {e}")
+    return df
+
+
+def is_cache_fresh(path):
+    """Valida la caché por mtime/tamaño y, si el mtime cambió, por hash del contenido"""
+    meta = _read_meta(path)
+    if not meta or not os.path.exists(cache_path(path)): return False
+    st = os.stat(path)
+    if st.st_size != meta.get('size'): return False
+    if st.st_mtime_ns == meta.get('mtime_ns'): return True
+    # Mismo tamaño pero mtime distinto (copias, touch...): decide el hash
+    if file_hash(path) != meta.get('sha256'): return False
+    meta['mtime_ns'] = st.st_mtime_ns
+    try: _write_meta(path, meta)
+    except OSError: pass
+    return True
+
+
+def load_dataset(path):
+    """Devuelve el dataset desde la caché columnar, reingestando si está obsoleta"""
+    if path.endswith(CACHE_SUFFIX): return read_source(path)  # Ya es columnar (hoja de Excel convertida)
+    if is_cache_fresh(path):
+        try: return pd.read_parquet(cache_path(path))
+        except Exception as e: print(f"Aviso: caché corrupta {cache_path(path)}: {e}")
+    return ingest(path)
+
+
+# --- CACHÉ EN MEMORIA (LRU) ---
+
+class DataFrameCache:
+    """Caché LRU de DataFrames limpios, acotada por bytes y segura entre hilos.
+
+    Los DataFrames cacheados se comparten entre peticiones: nadie debe mutarlos.
+    on_drop(key) se llama cuando una clave sale de la caché (expulsada, obsoleta o invalidada).
+    """
+
+    def __init__(self, max_bytes, on_drop=None):
+        self.max_bytes = max_bytes
+        self.on_drop = on_drop
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()  # key -> (signature, df, nbytes)
+        self._lock = threading.Lock()
+        # Solo viven mientras algún hilo los usa: no se acumula uno por cada fichero cargado
+        self._key_locks = weakref.WeakValueDictionary()
+
+    def get(self, key, signature, count=True):
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[0] == signature:
+                self._items.move_to_end(key)
+                if count: self.hits += 1
+                return item[1]
+            if item: self._drop(key)
+            if count: self.misses += 1
+            return None
+
+    def put(self, key, signature, df):
+        nbytes = int(df.memory_usage(deep=True).sum())
+        with self._lock:
+            # Reemplazo de la misma clave: no es una salida (no se avisa a on_drop)
+            if key in self._items: self._drop(key, notify=False)
+            if nbytes > self.max_bytes:
+                if self.on_drop: self.on_drop(key)
+                return
+            self._items[key] = (signature, df, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                self._drop(next(iter(self._items)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._items: self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._items): self._drop(key)
+
+    def key_lock(self, key):
+        """Lock por clave para que peticiones simultáneas no carguen el mismo fichero dos veces"""
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None: lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / total if total else 0.0
+            }
+
+    def _drop(self, key, notify=True):
+        _, _, nbytes = self._items.pop(key)
+        self.current_bytes -= nbytes
+        if notify and self.on_drop: self.on_drop(key)
+
+
+# Informe de memoria por columna (antes/después del tipado) del último cargado de cada upload.
+# Vive lo mismo que su DataFrame en la caché
+memory_reports = {}
+
+dataframe_cache = DataFrameCache(int(float(os.getenv("DATAFRAME_CACHE_MB", "512")) * 1024 * 1024),
+                                 on_drop=lambda key: memory_reports.pop(key, None))
+
+
+def file_signature(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def cached_frame(path, loader):
+    """Carga path con loader pasando por la caché en memoria (invalidada por mtime/tamaño)"""
+    signature = file_signature(path)
+    df = dataframe_cache.get(path, signature)
+    if df is not None: return df
+    with dataframe_cache.key_lock(path):
+        # Otro hilo pudo cargarlo mientras esperábamos el lock
+        df = dataframe_cache.get(path, signature, count=False)
+        if df is not None: return df
+        df = loader(path)
+        dataframe_cache.put(path, signature, df)
+        return df
+
+
+def _load_clean(path):
+    report = []
+    with span('load_file'): df = load_dataset(path)
+    with span('clean_dataframe'): df = clean_dataframe(df, report)
+    memory_reports[path] = report
+    before = sum(r['bytes_before'] for r in report)
+    after = sum(r['bytes_after'] for r in report)
+    print(f"Dataset {os.path.basename(path)}: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB tras tipado")
+    return df
+
+
+# --- DATASETS COMPARTIDOS ENTRE WORKERS (Arrow mapeado en memoria) ---
+# Con SHARED_DATASETS=1 (lo activa wsgi.py) el DataFrame ya limpio se vuelca a
+# <upload>.arrow (Arrow IPC sin comprimir) y cada worker lo abre con mmap: las
+# columnas numéricas, de texto y de fechas apuntan a las páginas del fichero,
+# que el sistema comparte entre procesos. to_pandas copia las columnas numpy con
+# máscara de nulos, así que los NaN de los float y los NaT de las fechas se
+# escriben como valores (las fechas, como su vista int64). Más workers no
+# multiplican la RAM de esas columnas; los códigos de las categóricas, los
+# booleanos (Arrow los empaqueta en bits) y los índices son privados.
+
+SHARED_DATASETS = os.getenv("SHARED_DATASETS", "0") == "1"
+ARROW_SUFFIX = '.arrow'
+
+
+def _shared_array(col):
+    """Array sin máscara de nulos para floats y fechas (NaN/NaT como valores), o None si no aplica"""
+    if not isinstance(col.dtype, np.dtype): return None
+    if col.dtype.kind == 'f': return pa.array(col.to_numpy(), from_pandas=False)
+    # NaT es el mínimo de int64: el timestamp lo guarda como un valor más y pandas lo vuelve a leer como NaT
+    if col.dtype.kind == 'M': return pa.array(col.to_numpy().view('int64')).view(pa.timestamp(np.datetime_data(col.dtype)[0]))
+    return None
+
+
+def _write_arrow(df, target, signature):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i in range(df.shape[1]):
+        array = _shared_array(df.iloc[:, i])
+        if array is not None: table = table.set_column(i, table.schema.field(i).with_type(array.type), array)
+    # Un solo lote: el texto que viene del Parquet está troceado y partiría todas las columnas en
+    # varios lotes, que to_pandas tendría que concatenar en memoria privada de cada worker
+    table = table.combine_chunks()
+    # La firma del original (mtime/tamaño) va en el esquema: un .arrow de otra versión no se usa
+    metadata = dict(table.schema.metadata or {}, source=json.dumps(list(signature)))
+    table = table.replace_schema_metadata(metadata)
+    def writer(tmp):
+        with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as ipc: ipc.write_table(table)
+    _write_atomic(target, writer)
+
+
+def _map_arrow(target, signature):
+    """DataFrame sobre el mmap del fichero (sin copiar los buffers), o None si falta o está obsoleto"""
+    try:
+        table = pa.ipc.open_file(pa.memory_map(target, 'r')).read_all()
+    except (OSError, pa.ArrowInvalid): return None
+    if (table.schema.metadata or {}).get(b'source') != json.dumps(list(signature)).encode(): return None
+    return table.to_pandas(split_blocks=True, self_destruct=False)
+
+
+def _load_shared(path):
+    signature = file_signature(path)
+    df = _map_arrow(path + ARROW_SUFFIX, signature)
+    if df is not None: return df
+    # Primer worker que lo necesita: limpia, vuelca y sirve también él desde el mapeo
+    df = _load_clean(path)
+    try: _write_arrow(df, path + ARROW_SUFFIX, signature)
+    except Exception as e:
+        print(f"Aviso: no se pudo compartir {path}: {e}")
+        return df
+    mapped = _map_arrow(path + ARROW_SUFFIX, signature)
+    return df if mapped is None else mapped
+
+
+def get_dataframe(path):
+    """DataFrame limpio del upload, servido desde memoria si el fichero no ha cambiado"""
+    return cached_frame(path, _load_shared if SHARED_DATASETS else _load_clean)
+
+
+# Carga completa en segundo plano tras el perfil rápido del upload: cuando llega
+# la generación, get_dataframe la encuentra hecha (o espera al mismo key_lock)
+_prefetch_pool = ThreadPoolExecutor(max_workers=int(os.getenv("PREFETCH_WORKERS", "1")), thread_name_prefix='prefetch')
+
+
+def _prefetch(path):
+    try: get_dataframe(path)
+    except Exception as e: print(f"Aviso: carga en segundo plano de {path} fallida: {e}")
+
+
+def prefetch(path):
+    if dataframe_cache.get(path, file_signature(path), count=False) is None: _prefetch_pool.submit(_prefetch, path)
+
+
+# --- MODO STREAMING (ficheros mayores que la RAM) ---
+# Los CSV por encima del umbral no se cargan enteros: se leen por trozos y las
+# agregaciones se fusionan (insights.process_components_chunked).
+
+STREAMING_THRESHOLD = int(float(os.getenv("STREAMING_THRESHOLD_MB", "500")) * 1024 * 1024)
+CHUNK_ROWS = int(os.getenv("STREAMING_CHUNK_ROWS", "200000"))
+SAMPLE_ROWS = 1000
+
+
+def is_streaming(path):
+    return path.lower().endswith('.csv') and os.path.getsize(path) > STREAMING_THRESHOLD
+
+
+def iter_chunks(path, filters=None, chunk_rows=None, offset=None):
+    """Trozos limpios (y filtrados) del CSV; nunca hay más de uno en memoria.
+    offset: byte desde el que leer (filas añadidas, ver append_offset); la cabecera sale del principio"""
+    if offset is None:
+        reader = pd.read_csv(path, chunksize=chunk_rows or CHUNK_ROWS, low_memory=False, encoding_errors='replace')
+        yield from _clean_chunks(reader, filters)
+        return
+    if offset >= os.path.getsize(path): return
+    columns = pd.read_csv(path, nrows=0, encoding_errors='replace').columns
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        reader = pd.read_csv(f, header=None, names=columns, chunksize=chunk_rows or CHUNK_ROWS, low_memory=False, encoding_errors='replace')
+        yield from _clean_chunks(reader, filters)
+
+
+def _clean_chunks(reader, filters):
+    with reader:
+        for chunk in reader:
+            chunk.columns = chunk.columns.astype(str).str.strip()
+            chunk = clean_dataframe(chunk)
+            if filters: chunk = apply_global_filters(chunk, filters)
+            yield chunk
+
+
+def append_offset(old_path, new_path):
+    """Si el CSV new_path es old_path con filas añadidas al final, byte donde empieza la primera
+    fila nueva (el tamaño de old_path si no hay ninguna). None si cambió algo anterior"""
+    if not (old_path.lower().endswith('.csv') and new_path.lower().endswith('.csv')): return None
+    old_size = os.path.getsize(old_path)
+    if old_size == 0 or os.path.getsize(new_path) < old_size: return None
+    last = b''
+    with open(old_path, 'rb') as old, open(new_path, 'rb') as new:
+        for block in iter(lambda: old.read(HASH_BLOCK), b''):
+            if new.read(len(block)) != block: return None
+            last = block
+        if last.endswith((b'\n', b'\r')): return old_size
+        # Sin salto de línea final: la última fila antigua tiene que acabar justo ahí
+        tail = new.read(2)
+        if not tail: return old_size
+        if tail == b'\r\n': return old_size + 2
+        if tail[:1] in (b'\n', b'\r'): return old_size + 1
+        return None
+
+
+# --- PERFIL DEL RESUMEN (reutilizable entre uploads del mismo contenido) ---
+
+PROFILE_SUFFIX = '.profile.json'
+
+
+def _load_sidecar(path, suffix):
+    """JSON asociado al fichero si se generó sobre su versión actual (mtime/tamaño), si no None"""
+    try:
+        with open(path + suffix) as f: data = json.load(f)
+    except (OSError, ValueError): return None
+    return data if data.get('source') == list(file_signature(path)) else None
+
+
+def _save_sidecar(path, suffix, data):
+    data = dict(data, source=list(file_signature(path)))
+    def writer(tmp):
+        with open(tmp, 'w') as f: json.dump(data, f)
+    try: _write_atomic(path + suffix, writer)
+    except OSError as e: print(f"Aviso: no se pudo guardar {os.path.basename(path + suffix)}: {e}")
+
+
+def load_profile(path):
+    """Perfil guardado del fichero (filas + líneas de columnas) si sigue vigente, si no None"""
+    return _load_sidecar(path, PROFILE_SUFFIX)
+
+
+def save_profile(path, profile):
+    _save_sidecar(path, PROFILE_SUFFIX, profile)
+
+
+def load_sheet_index(path):
+    """{"sheets": [...], "converted": {hoja: ruta relativa del Parquet}} del libro, o None"""
+    return _load_sidecar(path, SHEETS_SUFFIX)
+
+
+def save_sheet_index(path, index):
+    _save_sidecar(path, SHEETS_SUFFIX, index)
+
+
+# --- PARQUET LIMPIO PARA EL MOTOR SQL ---
+# <upload>.clean.parquet: el dataset ya tipado (clean_dataframe) en Parquet con
+# grupos de filas pequeños, para que DuckDB lo recorra en paralelo sin cargarlo
+# (engines.SQLEngine). En los metadatos del esquema van la firma del original y
+# las columnas de tipos mezclados pasadas a texto (el motor SQL no las agrega).
+# Los CSV en modo streaming se vuelcan trozo a trozo con el esquema del primero;
+# si un trozo no encaja (p.ej. enteros que pasan a decimales) no hay fichero.
+
+CLEAN_SUFFIX = '.clean.parquet'
+CLEAN_ROW_GROUP = 100_000
+
+
+def clean_path(path):
+    return path + CLEAN_SUFFIX
+
+
+def is_clean_fresh(path):
+    try: metadata = pq.read_schema(clean_path(path)).metadata or {}
+    except (OSError, pa.ArrowInvalid): return False
+    return metadata.get(b'source') == json.dumps(list(file_signature(path))).encode()
+
+
+def clean_schema(path):
+    """(esquema Arrow, columnas pasadas a texto) del Parquet limpio"""
+    schema = pq.read_schema(clean_path(path))
+    return schema, json.loads((schema.metadata or {}).get(b'stringified', b'[]'))
+
+
+def _clean_table(df, metadata):
+    """Tabla Arrow del trozo: categorías como texto y enteros a int64 (tipos estables entre trozos)"""
+    df = df.copy()
+    for col in df.columns:
+        s = df[col]
+        if isinstance(s.dtype, pd.CategoricalDtype): df[col] = s.astype(s.cat.categories.dtype)
+        elif pd.api.types.is_integer_dtype(s) and not pd.api.types.is_bool_dtype(s): df[col] = s.astype('int64')
+    stringified = [col for col in df.columns if df[col].dtype == object]
+    table = pa.Table.from_pandas(_arrow_safe(df), preserve_index=False)
+    return table.replace_schema_metadata(dict(metadata, stringified=json.dumps(stringified)))
+
+
+def _stable_cast(table, schema):
+    """Trozo con el esquema del primero. Solo se convierten columnas enteramente nulas en este
+    trozo y fechas en otra unidad; cualquier otro cambio de tipo aborta el volcado"""
+    stringified = set(json.loads(table.schema.metadata[b'stringified']))
+    if not stringified <= set(json.loads(schema.metadata[b'stringified'])): raise ValueError("tipos mezclados en un trozo")
+    if table.schema.equals(schema): return table
+    for field, expected in zip(table.schema, schema):
+        if field.name != expected.name: raise ValueError("columnas distintas entre trozos")
+        if field.type == expected.type or pa.types.is_null(field.type): continue
+        if pa.types.is_timestamp(field.type) and pa.types.is_timestamp(expected.type) and field.type.tz == expected.type.tz: continue
+        raise ValueError(f"columna '{expected.name}': {field.type} en vez de {expected.type}")
+    return table.cast(schema)
+
+
+def write_clean_parquet(path):
+    """Genera <upload>.clean.parquet. Devuelve False si el dataset no se puede volcar con un esquema fijo"""
+    metadata = {'source': json.dumps(list(file_signature(path)))}
+
+    def writer(tmp):
+        if not is_streaming(path):
+            pq.write_table(_clean_table(get_dataframe(path), metadata), tmp, row_group_size=CLEAN_ROW_GROUP)
+            return
+        out = schema = None
+        try:
+            for chunk in iter_chunks(path):
+                table = _clean_table(chunk, metadata)
+                if out is None:
+                    schema = table.schema
+                    out = pq.ParquetWriter(tmp, schema)
+                elif len(table.schema) != len(schema): raise ValueError("columnas distintas entre trozos")
+                out.write_table(_stable_cast(table, schema), row_group_size=CLEAN_ROW_GROUP)
+        finally:
+            if out is not None: out.close()
+
+    try:
+        with span('write_clean_parquet'): _write_atomic(clean_path(path), writer)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, ValueError) as e:
+        print(f"Aviso: {os.path.basename(path)} sin Parquet limpio (tipos no estables): {e}")
+        return False
+    return True
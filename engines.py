@@ -0,0 +1,362 @@
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import pyarrow as pa
+
+from insights import apply_global_filters, process_components, process_components_chunked, process_partials
+from insights import chart_plan, timeseries_plan
+from datasets import get_dataframe, is_streaming, iter_chunks, file_signature, clean_path, clean_schema, is_clean_fresh, write_clean_parquet, CHUNK_ROWS
+from spatial import PointAggregator, numeric_points
+from timeseries import ROWS
+from metrics import span
+
+try: import duckdb
+except ImportError: duckdb = None
+
+# --- MOTORES DE AGREGACIÓN ---
+# Los filtros y componentes de un dashboard se resuelven con un motor por dataset:
+#   PandasEngine: el DataFrame en memoria con los índices de filters.py, o los
+#                 trozos del CSV en modo streaming (lo de siempre).
+#   SQLEngine:    las mismas especificaciones como SQL en DuckDB sobre el Parquet
+#                 limpio (datasets.write_clean_parquet): filtros en el WHERE y
+#                 agrupaciones en el GROUP BY, ejecutados en paralelo y con
+#                 volcado a disco si no caben en memoria. Nunca carga el dataset.
+# El motor se elige por tamaño: los datasets del modo streaming (o, si se define,
+# los mayores de SQL_ENGINE_THRESHOLD_MB) van por SQL en cuanto su Parquet limpio
+# está listo (se genera en segundo plano); con el DataFrame ya en memoria y sus
+# índices, pandas responde antes. Lo que no tiene traducción exacta a SQL (p.ej.
+# igualdad contra fechas en un formato distinto del ISO, medidas sobre columnas de
+# texto) se resuelve entero con pandas: ambos motores devuelven lo mismo
+# (benchmarks/check_engines.py).
+
+AGG_ENGINE = os.getenv("AGG_ENGINE", "auto")  # auto | pandas | sql
+SQL_ENGINE_THRESHOLD_MB = os.getenv("SQL_ENGINE_THRESHOLD_MB")  # Sin definir: el umbral del modo streaming
+SQL_ENGINE_THRESHOLD = float(SQL_ENGINE_THRESHOLD_MB) * 1024 * 1024 if SQL_ENGINE_THRESHOLD_MB else None
+SQL_MEMORY_LIMIT = os.getenv("SQL_MEMORY_LIMIT")  # p.ej. "2GB"; por defecto el de DuckDB (80% de la RAM)
+SQL_TEMP_DIR = os.getenv("SQL_TEMP_DIR", os.path.join(tempfile.gettempdir(), 'dashboards-sql'))
+SQL_THREADS = os.getenv("SQL_THREADS")
+
+NUMERIC = ('int', 'float')
+ROW_NUMBER = 'file_row_number'  # Columna virtual de read_parquet: orden original de las filas
+KPI_OPS = ('sum', 'mean', 'max', 'min')
+INT_RE = re.compile(r'-?\d+')
+
+
+class Unsupported(Exception):
+    """Filtro o componente sin traducción exacta a SQL: la petición se resuelve con pandas"""
+
+
+class PandasEngine:
+    """Motor en memoria (o por trozos si el CSV supera STREAMING_THRESHOLD)"""
+    name = 'pandas'
+
+    def components(self, path, components, filters):
+        if is_streaming(path): return process_components_chunked(iter_chunks(path, filters), components)
+        return process_components(apply_global_filters(get_dataframe(path), filters), components)
+
+    def chunks(self, path, filters, columns, bbox=None):
+        """Trozos filtrados con las columnas pedidas (las que existan)"""
+        for chunk in iter_chunks(path, filters):
+            yield chunk[[c for c in columns if c in chunk.columns]]
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _kind(t):
+    if pa.types.is_dictionary(t): t = t.value_type
+    if pa.types.is_boolean(t): return 'bool'
+    if pa.types.is_integer(t): return 'int'
+    if pa.types.is_floating(t): return 'float'
+    if pa.types.is_string(t) or pa.types.is_large_string(t): return 'str'
+    if pa.types.is_timestamp(t) and t.tz is None: return 'ts'
+    return None  # Sin equivalente exacto (fechas con zona, binarios, anidados...)
+
+
+def _timestamp(value):
+    """Extremo de un rango de fechas como en filters.py (None si no hay); sin nanosegundos"""
+    if value in (None, ''): return None
+    try: ts = pd.Timestamp(value).tz_localize(None)
+    except (TypeError, ValueError) as e: raise Unsupported(f"fecha '{value}'") from e
+    if ts is pd.NaT or ts.nanosecond: raise Unsupported(f"fecha '{value}'")
+    return ts.to_pydatetime()
+
+
+def _number(value):
+    if value in (None, ''): return None
+    try: return float(value)
+    except (TypeError, ValueError) as e: raise Unsupported(f"número '{value}'") from e
+
+
+_NO_MATCH = object()
+
+
+def _literal(kind, value):
+    """Valor SQL que equivale a la igualdad por str(valor) de filters.ColumnIndex (_NO_MATCH si ninguno)"""
+    s = str(value)
+    if kind == 'str': return s
+    if kind == 'int': return int(s) if INT_RE.fullmatch(s) and str(int(s)) == s else _NO_MATCH
+    if kind == 'float':
+        try: f = float(s)
+        except ValueError: return _NO_MATCH
+        return f if repr(f) == s and f == f else _NO_MATCH
+    if kind == 'bool': return {'True': True, 'False': False}.get(s, _NO_MATCH)
+    # Fechas: pandas compara con str() (formato según los datos) y con isoformat(); solo el ISO es exacto
+    try: ts = pd.Timestamp(s)
+    except (TypeError, ValueError): return _NO_MATCH
+    if ts is pd.NaT or ts.tz is not None or ts.nanosecond or ts.isoformat() != s: raise Unsupported(f"fecha '{s}'")
+    return ts.to_pydatetime()
+
+
+def _where(kinds, filters):
+    """(condición, parámetros) de los filtros, con la semántica de filters.FilterIndex.select"""
+    clauses, params = [], []
+    for col, spec in (filters or {}).items():
+        if col not in kinds: continue  # Como en pandas: filtros de columnas que no existen se ignoran
+        kind, c = kinds[col], _quote(col)
+        if kind is None: raise Unsupported(f"columna '{col}'")
+        if isinstance(spec, dict):
+            if 'from' in spec or 'to' in spec:
+                if kind != 'ts': raise Unsupported(f"rango de fechas sobre '{col}'")
+                low, high = _timestamp(spec.get('from')), _timestamp(spec.get('to'))
+            else:
+                if kind not in NUMERIC: raise Unsupported(f"rango numérico sobre '{col}'")
+                low, high = _number(spec.get('min')), _number(spec.get('max'))
+            clauses.append(f"{c} IS NOT NULL")
+            if low is not None: clauses.append(f"{c} >= ?"); params.append(low)
+            if high is not None: clauses.append(f"{c} <= ?"); params.append(high)
+            continue
+        values = spec if isinstance(spec, (list, tuple, set)) else [spec]
+        literals = [v for v in (_literal(kind, v) for v in values) if v is not _NO_MATCH]
+        if not literals: clauses.append("FALSE")
+        else:
+            clauses.append(f"{c} IN ({', '.join('?' * len(literals))})")
+            params += literals
+    return ' AND '.join(clauses) or 'TRUE', params
+
+
+def _require(kinds, col, allowed, what):
+    if col in kinds and kinds[col] not in allowed: raise Unsupported(f"{what} sobre '{col}'")
+
+
+def _check(kinds, components):
+    """Comprueba que los componentes se pueden calcular en SQL con los mismos resultados que en pandas"""
+    known = ('str', 'int', 'float', 'bool', 'ts')
+    for comp in components:
+        config = comp.get('config', {})
+        c_type, op = comp.get('type'), config.get('operation', 'count')
+        if c_type == 'kpi' and op in KPI_OPS: _require(kinds, config.get('column'), NUMERIC, op)
+        elif c_type == 'chart' and config.get('x') in kinds:
+            _require(kinds, config.get('x'), known, 'agrupación')
+            if op != 'count': _require(kinds, config.get('y'), NUMERIC, op)
+        elif c_type == 'timeseries' and config.get('x') in kinds:
+            _require(kinds, config.get('x'), ('ts',), 'serie temporal')
+            if op != 'count': _require(kinds, config.get('y'), NUMERIC, op)
+        elif c_type == 'map':
+            for key in ('lat', 'lon', 'label'): _require(kinds, config.get(key), known, 'mapa')
+
+
+class _SQLBatch:
+    """Interfaz de insights._Batch resuelta con consultas sobre el Parquet limpio y los filtros
+    en el WHERE. Los KPIs salen de una única pasada; los gráficos, de un GROUP BY por x."""
+
+    def __init__(self, engine, path, kinds, where, params, components):
+        self.columns = pd.Index(list(kinds))
+        self.plan = chart_plan(self.columns, components)
+        self.ts_plan = timeseries_plan(self.columns, components)
+        self._engine = engine
+        self._path = path
+        self._kinds = kinds
+        self._where, self._params = where, params
+        self._measures = []  # Columnas de los KPIs con sum/mean/max/min
+        for comp in components:
+            config = comp.get('config', {})
+            col = config.get('column')
+            if comp.get('type') == 'kpi' and config.get('operation', 'count') in KPI_OPS and col in kinds and col not in self._measures:
+                self._measures.append(col)
+        self._kpis = None
+        self._groups = {}
+        self._series = {}
+
+    def _execute(self, select, where='', group=''):
+        sql = f"SELECT {select} FROM read_parquet(?, file_row_number = true) WHERE ({self._where}){where}{group}"
+        return self._engine.cursor().execute(sql, [clean_path(self._path)] + self._params)
+
+    def _value(self, col):
+        return f"COALESCE({_quote(col)}, 0)"  # Como to_number: nulos cuentan como 0
+
+    def _sum(self, col):
+        total = f"SUM({self._value(col)})"
+        return f"CAST({total} AS BIGINT)" if self._kinds[col] == 'int' else total
+
+    def _kpi_values(self):
+        if self._kpis is None:
+            exprs = ["COUNT(*)"]
+            for col in self._measures:
+                exprs += [f"COALESCE({self._sum(col)}, 0)", f"AVG({self._value(col)})", f"MAX({self._value(col)})", f"MIN({self._value(col)})"]
+            row = self._execute(', '.join(exprs)).fetchone()
+            self._kpis = {'__count': row[0]}
+            for i, col in enumerate(self._measures):
+                self._kpis[col] = dict(zip(KPI_OPS, row[1 + 4 * i:5 + 4 * i]))
+        return self._kpis
+
+    @property
+    def rows(self):
+        return self._kpi_values()['__count']
+
+    def reduce(self, col, op):
+        return self._kpi_values().get(col, {}).get(op, 0)
+
+    def groups(self, x):
+        if x not in self._groups:
+            p = self.plan[x]
+            key = _quote(x)
+            exprs = [f"{key} AS k", "COUNT(*) AS n", f"MIN({ROW_NUMBER}) AS first"]
+            exprs += [f"{self._sum(y)} AS m{i}" for i, y in enumerate(p['measures'])]
+            df = self._execute(', '.join(exprs), f" AND {key} IS NOT NULL", f" GROUP BY {key}").df()
+            index = pd.Index(df['k'], name=x)
+            res = {}
+            # Conteos por orden de aparición y medidas por clave, como el groupby de _Batch
+            if p['count']: res['count'] = pd.Series(df['n'].to_numpy(), index=index).iloc[df['first'].to_numpy().argsort(kind='stable')]
+            if p['measures']:
+                frame = pd.DataFrame({y: df[f"m{i}"].to_numpy() for i, y in enumerate(p['measures'])}, index=index)
+                res['sum'] = frame.sort_index()
+                if p['size']: res['size'] = pd.Series(df['n'].to_numpy(), index=index).sort_index()
+            self._groups[x] = res
+        return self._groups[x]
+
+    def timeseries(self, x):
+        if x not in self._series:
+            measures = self.ts_plan.get(x, [])
+            key = _quote(x)
+            exprs = [f"CAST({key} AS DATE) AS day", "COUNT(*) AS n"] + [f"{self._sum(y)} AS m{i}" for i, y in enumerate(measures)]
+            df = self._execute(', '.join(exprs), f" AND {key} IS NOT NULL", " GROUP BY day").df()
+            frame = pd.DataFrame({y: df[f"m{i}"].to_numpy() for i, y in enumerate(measures)}, index=pd.DatetimeIndex(df['day']))
+            frame[ROWS] = df['n'].to_numpy()
+            self._series[x] = frame
+        return self._series[x]
+
+    def is_date(self, col):
+        return self._kinds.get(col) == 'ts'
+
+    def points(self, cols, lat, lon):
+        agg = PointAggregator(cols, lat, lon)
+        for chunk in self._engine.scan(self._path, self._where, self._params, cols):
+            agg.add(numeric_points(chunk, cols, lat, lon))
+        return agg.result()
+
+
+class SQLEngine:
+    """Motor DuckDB: una conexión en memoria compartida y un cursor por hilo"""
+    name = 'sql'
+
+    def __init__(self, memory_limit=SQL_MEMORY_LIMIT, temp_dir=SQL_TEMP_DIR, threads=SQL_THREADS):
+        config = {'temp_directory': temp_dir}
+        if memory_limit: config['memory_limit'] = memory_limit
+        if threads: config['threads'] = int(threads)
+        self._con = duckdb.connect(':memory:', config=config)
+        self._local = threading.local()
+        self._fallback = PandasEngine()
+
+    def cursor(self):
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None: cursor = self._local.cursor = self._con.cursor()
+        return cursor
+
+    def _kinds(self, path):
+        schema, stringified = clean_schema(path)
+        if ROW_NUMBER in schema.names: raise Unsupported(f"columna '{ROW_NUMBER}'")
+        return {f.name: None if f.name in stringified else _kind(f.type) for f in schema}
+
+    def components(self, path, components, filters):
+        try:
+            kinds = self._kinds(path)
+            where, params = _where(kinds, filters)
+            _check(kinds, components)
+        except Unsupported as e:
+            print(f"Aviso: {os.path.basename(path)} por pandas ({e})")
+            return self._fallback.components(path, components, filters)
+        with span('sql_components'):
+            return process_partials(_SQLBatch(self, path, kinds, where, params, components), components)
+
+    def scan(self, path, where, params, columns):
+        """Filas que cumplen where (en su orden original) por lotes de CHUNK_ROWS"""
+        select = ', '.join(_quote(c) for c in columns)
+        # El resultado por lotes no respeta el orden del fichero: se ordena por fila (con volcado a disco si hace falta)
+        sql = f"SELECT {select} FROM read_parquet(?, file_row_number = true) WHERE {where} ORDER BY {ROW_NUMBER}"
+        reader = self.cursor().execute(sql, [clean_path(path)] + params).fetch_record_batch(CHUNK_ROWS)
+        for batch in reader: yield batch.to_pandas()
+
+    def chunks(self, path, filters, columns, bbox=None):
+        """Como PandasEngine.chunks; bbox = [oeste, sur, este, norte] se aplica ya en la consulta"""
+        try:
+            kinds = self._kinds(path)
+            where, params = _where(kinds, filters)
+            for col in columns: _require(kinds, col, ('str', 'int', 'float', 'bool', 'ts'), 'mapa')
+        except Unsupported as e:
+            print(f"Aviso: {os.path.basename(path)} por pandas ({e})")
+            yield from self._fallback.chunks(path, filters, columns)
+            return
+        columns = [c for c in columns if c in kinds]
+        if bbox is not None and len(columns) >= 2 and all(kinds[c] in NUMERIC for c in columns[:2]):
+            west, south, east, north = bbox
+            where += f" AND {_quote(columns[0])} BETWEEN ? AND ? AND {_quote(columns[1])} BETWEEN ? AND ?"
+            params = params + [float(south), float(north), float(west), float(east)]
+        with span('sql_scan'): yield from self.scan(path, where, params, columns)
+
+
+# --- ELECCIÓN DEL MOTOR POR DATASET ---
+
+pandas_engine = PandasEngine()
+_sql_engine = None
+_lock = threading.Lock()
+_pending = set()  # (ruta, firma) con el Parquet limpio en preparación
+_failed = set()  # (ruta, firma) que no se pueden volcar: no se reintentan
+_prepare_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sql-prepare')
+
+
+def _sql():
+    global _sql_engine
+    with _lock:
+        if _sql_engine is None: _sql_engine = SQLEngine()
+        return _sql_engine
+
+
+def wants_sql(path):
+    if duckdb is None or AGG_ENGINE == 'pandas': return False
+    if AGG_ENGINE == 'sql': return True
+    if SQL_ENGINE_THRESHOLD is None: return is_streaming(path)
+    return os.path.getsize(path) > SQL_ENGINE_THRESHOLD
+
+
+def get_engine(path):
+    """Motor para el dataset: SQL si es grande (o AGG_ENGINE=sql) y su Parquet limpio está al día.
+    Si aún no lo está, se encola su preparación y esta petición va por pandas"""
+    if not wants_sql(path): return pandas_engine
+    if is_clean_fresh(path): return _sql()
+    prepare_engine(path)
+    return pandas_engine
+
+
+def _prepare(path, key):
+    try: ok = write_clean_parquet(path)
+    except Exception as e:
+        print(f"Aviso: Parquet limpio de {path} fallido: {e}")
+        ok = False
+    with _lock:
+        _pending.discard(key)
+        if not ok: _failed.add(key)
+
+
+def prepare_engine(path):
+    """Genera en segundo plano el Parquet limpio de los datasets que irán por SQL"""
+    if not wants_sql(path) or is_clean_fresh(path): return
+    key = (path, file_signature(path))
+    with _lock:
+        if key in _pending or key in _failed: return
+        _pending.add(key)
+    _prepare_pool.submit(_prepare, path, key)
@@ -0,0 +1,154 @@
+import threading
+import weakref
+import numpy as np
+import pandas as pd
+
+# --- MOTOR DE FILTROS INDEXADO ---
+# Cada columna filtrable se codifica una sola vez (diccionario valor -> código)
+# y se guarda un índice invertido código -> posiciones de fila. Un filtro se
+# resuelve buscando códigos en el diccionario (pocos valores) y cruzando las
+# listas de posiciones, sin volver a materializar la columna como texto.
+#
+# Formatos de filtro admitidos (por columna):
+#   "valor"                          igualdad (compatible con el front actual)
+#   ["v1", "v2"]                     pertenencia (IN)
+#   {"min": 10, "max": 20}           rango numérico (inclusive, extremos opcionales)
+#   {"from": "2024-01-01", "to": ..} rango de fechas (inclusive, extremos opcionales)
+
+
+class ColumnIndex:
+    """Índice invertido de una columna: diccionario de valores + posiciones por código"""
+
+    def __init__(self, series):
+        codes, uniques = pd.factorize(series)
+        # Igual que el filtro clásico: se compara la representación str(valor)
+        self.keys = {}
+        for code, key in enumerate(pd.Index(uniques).astype(str)):
+            self.keys.setdefault(key, []).append(code)
+        if pd.api.types.is_datetime64_any_dtype(uniques):
+            # El front recibe las fechas en ISO 8601 (serialization.json_safe)
+            for code, ts in enumerate(uniques):
+                if ts is not pd.NaT: self.keys.setdefault(ts.isoformat(), []).append(code)
+        order = np.argsort(codes, kind='stable')
+        # Los nulos (código -1) quedan al principio y nunca se seleccionan
+        self.bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        self.order = order
+
+    def positions(self, values):
+        """Posiciones de fila (ordenadas) cuyo valor está en values"""
+        codes = [c for v in values for c in self.keys.get(str(v), ())]
+        if not codes: return np.empty(0, dtype=np.intp)
+        if len(codes) == 1: return self.order[self.bounds[codes[0]]:self.bounds[codes[0] + 1]]
+        parts = [self.order[self.bounds[c]:self.bounds[c + 1]] for c in codes]
+        return np.sort(np.concatenate(parts))
+
+
+class SortedIndex:
+    """Valores ordenados (numéricos o fechas) para resolver rangos con búsqueda binaria"""
+
+    def __init__(self, values):
+        values = np.asarray(values)
+        valid = np.flatnonzero(~pd.isna(values))
+        order = valid[np.argsort(values[valid], kind='stable')]
+        self.order = order
+        self.sorted = values[order]
+
+    def positions(self, low=None, high=None):
+        start = 0 if low is None else np.searchsorted(self.sorted, low, side='left')
+        end = len(self.sorted) if high is None else np.searchsorted(self.sorted, high, side='right')
+        return np.sort(self.order[start:end])
+
+
+class FilterIndex:
+    """Índices perezosos (por columna y tipo de filtro) de un DataFrame"""
+
+    def __init__(self, df):
+        self._df_ref = weakref.ref(df)
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, col):
+        key = (kind, col)
+        idx = self._indexes.get(key)
+        if idx is not None: return idx
+        # El índice de rangos de fechas parte de la columna ya parseada (fuera del lock: no es reentrante)
+        dates = self.dates(col) if kind == 'date' else None
+        with self._lock:
+            idx = self._indexes.get(key)
+            if idx is None:
+                series = self._df_ref()[col]
+                if kind == 'eq': idx = ColumnIndex(series)
+                elif kind == 'num': idx = SortedIndex(pd.to_numeric(series, errors='coerce').to_numpy(dtype='float64'))
+                elif kind == 'dates': idx = _to_datetime(series)
+                else: idx = SortedIndex(dates.to_numpy(dtype='datetime64[ns]'))
+                self._indexes[key] = idx
+            return idx
+
+    def dates(self, col):
+        """Columna como datetime64, parseada una vez por DataFrame (la comparten los filtros de
+        rango de fechas y las series temporales)"""
+        return self._get('dates', col)
+
+    def positions(self, col, spec):
+        if isinstance(spec, dict):
+            if 'from' in spec or 'to' in spec:
+                low, high = _parse_date(spec.get('from')), _parse_date(spec.get('to'))
+                return self._get('date', col).positions(low, high)
+            low, high = _parse_number(spec.get('min')), _parse_number(spec.get('max'))
+            return self._get('num', col).positions(low, high)
+        values = spec if isinstance(spec, (list, tuple, set)) else [spec]
+        return self._get('eq', col).positions(values)
+
+    def select(self, filters):
+        """Posiciones de fila que cumplen todos los filtros (None si no hay filtros aplicables)"""
+        df = self._df_ref()
+        selection = None
+        for col, spec in filters.items():
+            if col not in df.columns: continue
+            rows = self.positions(col, spec)
+            # Intersección de listas ordenadas y sin duplicados
+            selection = rows if selection is None else np.intersect1d(selection, rows, assume_unique=True)
+            if len(selection) == 0: break
+        return selection
+
+
+def _to_datetime(series):
+    if pd.api.types.is_datetime64_any_dtype(series): return series.dt.tz_localize(None) if series.dt.tz else series
+    # Solo se parsea texto: un número (p.ej. un año) no es una fecha, no ns desde 1970
+    if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+        return pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+    return pd.to_datetime(series, errors='coerce', format='mixed', dayfirst=True)
+
+
+def _parse_date(value):
+    if value in (None, ''): return None
+    return np.datetime64(pd.Timestamp(value).tz_localize(None), 'ns')
+
+
+def _parse_number(value):
+    if value in (None, ''): return None
+    return float(value)
+
+
+# Un índice por DataFrame vivo (los DataFrames de la caché se reutilizan entre peticiones)
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_filter_index(df):
+    key = id(df)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None or index._df_ref() is not df:
+            index = FilterIndex(df)
+            _indexes[key] = index
+            weakref.finalize(df, _indexes.pop, key, None)
+        return index
+
+
+def filter_rows(df, filters):
+    """Aplica los filtros usando el índice del DataFrame. Devuelve una vista filtrada"""
+    if not filters: return df
+    selection = get_filter_index(df).select(filters)
+    if selection is None: return df
+    return df.iloc[selection]
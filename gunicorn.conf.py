@@ -0,0 +1,41 @@
+import os
+
+# --- SERVIDOR DE PRODUCCIÓN (gunicorn -c gunicorn.conf.py wsgi:application) ---
+# Procesos x hilos: los filtros son CPU (pandas suelta el GIL en buena parte),
+# la generación espera al LLM en el pool de jobs. Con los datasets mapeados
+# (wsgi.py) añadir workers sube el throughput de filtros sin multiplicar la RAM.
+
+bind = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+workers = int(os.getenv("WEB_WORKERS", min(4, os.cpu_count() or 1)))
+threads = int(os.getenv("WEB_THREADS", "4"))
+worker_class = "gthread"
+
+# La app (pandas, pyarrow, índices...) se importa una vez en el master y los
+# workers la heredan por fork: arranque más rápido y páginas de código compartidas
+preload_app = True
+
+timeout = 120  # Subidas grandes; la generación ya no bloquea la petición
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+
+# Métricas compartidas (metrics.py): cada worker vuelca las suyas a data/metrics/<pid>.json
+METRICS_DIR = os.path.join(os.getenv("DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')), 'metrics')
+
+
+def on_starting(server):
+    # Los totales empiezan de cero con cada arranque del servidor
+    from metrics import clear_shared
+    clear_shared(METRICS_DIR)
+
+
+def worker_exit(server, worker):
+    # Último volcado del worker antes de salir (en el propio worker)
+    from metrics import registry
+    registry.flush()
+
+
+def child_exit(server, worker):
+    # En el master: los contadores del worker muerto se conservan, sus gauges no
+    from metrics import mark_dead
+    mark_dead(METRICS_DIR, worker.pid)
@@ -1,101 +1,397 @@
 import pandas as pd
 import numpy as np
 
-def clean_dataframe(df):
-    """Limpia valores infinitos y nulos básicos"""
-    df = df.replace([np.inf, -np.inf], np.nan)
-    return df.where(pd.notnull(df), None)
+from filters import filter_rows, get_filter_index
+from spatial import PointAggregator, numeric_points, overview
+from metrics import span
+from timeseries import ROWS, day_partials, build_series
+
+COORD_NAMES = {'lat', 'latitude', 'latitud', 'lon', 'lng', 'long', 'longitude', 'longitud'}
+CATEGORY_MAX_RATIO = 0.5  # Texto con <= 50% de valores distintos -> category
+DATE_SAMPLE = 200
+ISO_DATE_RE = r'^\d{4}-\d{1,2}-\d{1,2}([ T]\d{1,2}:\d{2}(:\d{2})?)?'
+DMY_DATE_RE = r'^\d{1,2}[/-]\d{1,2}[/-]\d{2,4}([ T]\d{1,2}:\d{2}(:\d{2})?)?$'
+
+def _is_text(series):
+    return series.dtype == object or pd.api.types.is_string_dtype(series.dtype)
+
+def _as_dates(series):
+    """Parsea columnas de texto con pinta de fecha; None si no lo son"""
+    sample = series.dropna().head(DATE_SAMPLE).astype(str)
+    if sample.empty: return None
+    if sample.str.match(ISO_DATE_RE).mean() >= 0.9: parsed = pd.to_datetime(series, errors='coerce', format='ISO8601')
+    elif sample.str.match(DMY_DATE_RE).mean() >= 0.9: parsed = pd.to_datetime(series, errors='coerce', format='mixed', dayfirst=True)
+    else: return None
+    return parsed if parsed.notna().sum() >= 0.9 * series.notna().sum() else None
+
+def is_date_like(series):
+    """Columna válida como eje temporal: fechas reales o texto con pinta de fecha (ISO o día/mes/año).
+    Los números (p.ej. un año) no: to_datetime los leería como nanosegundos desde 1970"""
+    if pd.api.types.is_datetime64_any_dtype(series): return True
+    if isinstance(series.dtype, pd.CategoricalDtype): series = series.astype(object)
+    if not _is_text(series): return False
+    sample = series.dropna().head(DATE_SAMPLE).astype(str)
+    if sample.empty: return False
+    return sample.str.match(ISO_DATE_RE).mean() >= 0.9 or sample.str.match(DMY_DATE_RE).mean() >= 0.9
+
+def _as_coordinates(series):
+    """Coordenadas guardadas como texto (también con coma decimal) -> float64"""
+    parsed = pd.to_numeric(series.astype(str).str.replace(',', '.', regex=False).str.strip(), errors='coerce')
+    parsed[series.isna()] = np.nan
+    return parsed if parsed.notna().sum() >= 0.9 * series.notna().sum() else None
+
+def _compact_column(name, series):
+    if pd.api.types.is_bool_dtype(series): return series
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast='integer')
+    if pd.api.types.is_float_dtype(series):
+        # Los float se quedan en float64: coordenadas y sumas necesitan la precisión
+        return series.replace([np.inf, -np.inf], np.nan)
+    if not _is_text(series): return series
+    if str(name).strip().lower() in COORD_NAMES:
+        coords = _as_coordinates(series)
+        if coords is not None: return coords
+    dates = _as_dates(series)
+    if dates is not None: return dates
+    n_unique = series.nunique()
+    if n_unique <= CATEGORY_MAX_RATIO * len(series):
+        try: return series.astype('category')
+        except TypeError: return series  # Tipos mezclados no ordenables
+    return series
+
+def clean_dataframe(df, report=None):
+    """Tipado compacto: enteros reducidos, texto repetitivo como category y fechas/coordenadas parseadas.
+    NaN/inf se conservan (se convierten a null al serializar). Si report es una lista,
+    se añade una entrada por columna con la memoria antes y después."""
+    cleaned = {}
+    for col in df.columns:
+        before = df[col]
+        after = _compact_column(col, before)
+        cleaned[col] = after
+        if report is not None:
+            report.append({
+                "column": col,
+                "dtype_before": str(before.dtype),
+                "dtype_after": str(after.dtype),
+                "bytes_before": int(before.memory_usage(index=False, deep=True)),
+                "bytes_after": int(after.memory_usage(index=False, deep=True))
+            })
+    return pd.DataFrame(cleaned, index=df.index)
+
+def to_number(series):
+    """Serie numérica para agregar: no numéricos cuentan como 0, enteros a int64 (sin desbordes)"""
+    values = pd.to_numeric(series, errors='coerce').fillna(0)
+    if pd.api.types.is_integer_dtype(values) and values.dtype != np.int64: values = values.astype(np.int64)
+    return values
 
 def apply_global_filters(df, filters):
-    if not filters: return df
-    df_filtered = df.copy()
-    for col, val in filters.items():
-        if col in df_filtered.columns:
-            df_filtered = df_filtered[df_filtered[col].astype(str) == str(val)]
-    return df_filtered
+    """Filtros de igualdad, IN y rangos resueltos con el índice por columna (ver filters.py)"""
+    with span('apply_global_filters'): return filter_rows(df, filters)
 
-def process_component_data(df, component):
-    try:
-        c_type = component.get('type')
-        config = component.get('config', {})
-        chart_type = component.get('chart_type') # Necesario para la lógica de Pie
+def finalize_chart(df_res, x, chart_type, limit=20):
+    """Top del resultado agregado (x, value) con selección parcial y el 'Otros' del pie"""
+    # B. Top N sin ordenar todo el resultado (keep='first': empates en orden de agregación)
+    # C. LÓGICA ESPECIAL PARA PIE CHARTS (Top 9 + Otros)
+    if chart_type == 'pie' and len(df_res) > 10:
+        top_9 = df_res.nlargest(9, 'value', keep='first')
+        others_val = df_res['value'].drop(top_9.index).sum()
         
-        # --- 1. PROCESAR KPI ---
-        if c_type == 'kpi':
-            op = config.get('operation', 'count')
-            col = config.get('column')
-            
-            val = 0
-            if op == 'count':
-                val = len(df)
-            elif col and col in df.columns:
-                numeric_series = pd.to_numeric(df[col], errors='coerce').fillna(0)
-                if op == 'sum': val = numeric_series.sum()
-                elif op == 'mean': val = numeric_series.mean()
-                elif op == 'max': val = numeric_series.max()
-                elif op == 'min': val = numeric_series.min()
-            
-            return {"value": val, "label": component.get('title')}
-
-        # --- 2. PROCESAR MAPA ---
-        elif c_type == 'map':
-            lat = config.get('lat')
-            lon = config.get('lon')
-            label = config.get('label')
-            
-            if lat in df.columns and lon in df.columns:
-                cols = [lat, lon]
-                if label and label in df.columns: cols.append(label)
-                # Convertimos a numérico para evitar errores en el front
-                df[lat] = pd.to_numeric(df[lat], errors='coerce')
-                df[lon] = pd.to_numeric(df[lon], errors='coerce')
-                return df[cols].dropna().head(1000).to_dict(orient='records')
-            return []
+        # Crear fila "Otros"
+        others_row = pd.DataFrame({x: ['Otros'], 'value': [others_val]})
+        df_res = pd.concat([top_9, others_row])
+    else:
+        # Para barras y otros, respetamos el límite numérico simple
+        df_res = df_res.nlargest(limit, 'value', keep='first')
+    
+    return {
+        "dimensions": [x, 'value'],
+        "source": df_res.to_dict(orient='records')
+    }
+
+def chart_plan(columns, components):
+    """Qué medidas se agrupan por cada x, para hacer un único groupby por dimensión"""
+    plan = {}
+    for comp in components:
+        if comp.get('type') != 'chart': continue
+        config = comp.get('config', {})
+        x, y = config.get('x'), config.get('y')
+        if not x or x not in columns: continue
+        p = plan.setdefault(x, {"measures": [], "count": False, "size": False})
+        op = config.get('operation', 'count')
+        if op == 'count': p['count'] = True
+        elif y and y in columns:
+            if y not in p['measures']: p['measures'].append(y)
+            if op == 'mean': p['size'] = True
+    return plan
+
+def timeseries_plan(columns, components):
+    """Medidas que suma cada serie temporal por su columna de fecha (parciales diarios compartidos)"""
+    plan = {}
+    for comp in components:
+        if comp.get('type') != 'timeseries': continue
+        config = comp.get('config', {})
+        x, y = config.get('x'), config.get('y')
+        if not x or x not in columns: continue
+        measures = plan.setdefault(x, [])
+        if config.get('operation', 'count') != 'count' and y and y in columns and y not in measures: measures.append(y)
+    return plan
+
+class _Batch:
+    """Trabajo compartido entre los componentes de un dashboard sobre el mismo DataFrame"""
+
+    def __init__(self, df, components):
+        self.df = df
+        self.columns = df.columns
+        self.rows = len(df)
+        self.plan = chart_plan(df.columns, components)
+        self.ts_plan = timeseries_plan(df.columns, components)
+        self._numeric = {}
+        self._groups = {}
+        self._series = {}
+
+    def numeric(self, col):
+        """Columna convertida a número una sola vez (no numéricos cuentan como 0)"""
+        if col not in self._numeric:
+            self._numeric[col] = to_number(self.df[col])
+        return self._numeric[col]
+
+    def reduce(self, col, op):
+        values = self.numeric(col)
+        if op == 'sum': return values.sum()
+        elif op == 'mean': return values.mean()
+        elif op == 'max': return values.max()
+        elif op == 'min': return values.min()
+        return 0
+
+    def groups(self, x):
+        """Agregados por x de todas las medidas del plan: {'count', 'sum', 'size'}"""
+        if x not in self._groups:
+            p = self.plan[x]
+            res = {}
+            # groupby observado (no value_counts): en columnas category no salen categorías vacías
+            if p['count']: res['count'] = self.df.groupby(x, observed=True, sort=False).size()
+            if p['measures']:
+                frame = pd.DataFrame({y: self.numeric(y) for y in p['measures']}, index=self.df.index)
+                grouped = frame.groupby(self.df[x], observed=True)
+                res['sum'] = grouped.sum()
+                if p['size']: res['size'] = grouped.size()
+            self._groups[x] = res
+        return self._groups[x]
+
+    def dates(self, col):
+        """Columna como fecha, parseada una vez y compartida con los filtros de rango (filters.py)"""
+        return get_filter_index(self.df).dates(col)
+
+    def is_date(self, col):
+        return is_date_like(self.df[col])
+
+    def timeseries(self, x):
+        """Parciales diarios (filas y sumas de las medidas del plan) indexados por día"""
+        if x not in self._series:
+            frame = pd.DataFrame({y: self.numeric(y) for y in self.ts_plan.get(x, [])}, index=self.df.index)
+            frame[ROWS] = 1
+            self._series[x] = day_partials(self.dates(x), frame)
+        return self._series[x]
+
+    def points(self, cols, lat, lon):
+        """Puntos del mapa, o clusters si no caben (sin mutar df: puede venir de la caché)"""
+        return overview(self.df, cols, lat, lon)
+
+def _merge_counts(acc, part, sort=False):
+    """Fusiona agregados parciales (Series/DataFrame indexados por grupo) sumándolos"""
+    if acc is None: return part
+    return pd.concat([acc, part]).groupby(level=0, sort=sort).sum()
+
+class _ChunkedBatch:
+    """Misma interfaz que _Batch pero alimentada por trozos: se guardan solo parciales
+    (sumas, mínimos, máximos y conteos por grupo), así que la memoria depende del
+    número de grupos y no del tamaño del fichero."""
+
+    _date_cols = None  # Estados guardados antes de existir: se da por fecha toda serie con parciales
+
+    def __init__(self, chunks, components):
+        self.columns = pd.Index([])
+        self.rows = 0
+        self.plan = {}
+        self._components = components
+        self._kpis = {}
+        self._groups = {}
+        self._series = {}
+        self._points = {}
+        self._started = False
+        self.extend(chunks)
+
+    def extend(self, chunks):
+        """Suma más filas a los parciales (p.ej. las añadidas al final del fichero de origen)"""
+        for chunk in chunks: self._add(chunk)
+
+    def _start(self, chunk):
+        self._started = True
+        self.columns = columns = chunk.columns
+        self.plan = chart_plan(columns, self._components)
+        self.ts_plan = timeseries_plan(columns, self._components)
+        # El tipo de la columna de fecha se decide con el primer trozo, como el resto del plan
+        self._date_cols = {x for x in self.ts_plan if is_date_like(chunk[x])}
+        for comp in self._components:
+            config = comp.get('config', {})
+            if comp.get('type') == 'kpi':
+                col = config.get('column')
+                if config.get('operation', 'count') != 'count' and col in columns: self._kpis[col] = None
+            elif comp.get('type') == 'map':
+                lat, lon, label = config.get('lat'), config.get('lon'), config.get('label')
+                if lat in columns and lon in columns:
+                    cols = [lat, lon] + ([label] if label and label in columns else [])
+                    self._points[tuple(cols)] = PointAggregator(cols, lat, lon)
 
-        # --- 3. PROCESAR GRÁFICO ---
-        elif c_type == 'chart':
-            x = config.get('x')
-            y = config.get('y')
-            op = config.get('operation', 'count')
-            limit = config.get('limit', 20) # Límite por defecto para barras
-            
-            if not x or x not in df.columns: return []
-
-            # A. Agrupación y Cálculo
-            if op == 'count':
-                df_res = df[x].value_counts().reset_index()
-                df_res.columns = [x, 'value']
-            
-            elif y and y in df.columns:
-                df[y] = pd.to_numeric(df[y], errors='coerce').fillna(0)
-                if op == 'sum': df_res = df.groupby(x)[y].sum().reset_index()
-                elif op == 'mean': df_res = df.groupby(x)[y].mean().reset_index()
-                else: df_res = df.groupby(x)[y].sum().reset_index()
-                df_res.columns = [x, 'value']
-            else:
-                return []
-
-            # B. Ordenar
-            df_res = df_res.sort_values(by='value', ascending=False)
-
-            # C. LÓGICA ESPECIAL PARA PIE CHARTS (Top 9 + Otros)
-            if chart_type == 'pie' and len(df_res) > 10:
-                top_9 = df_res.iloc[:9]
-                others_val = df_res.iloc[9:]['value'].sum()
-                
-                # Crear fila "Otros"
-                others_row = pd.DataFrame({x: ['Otros'], 'value': [others_val]})
-                df_res = pd.concat([top_9, others_row])
-            else:
-                # Para barras y otros, respetamos el límite numérico simple
-                df_res = df_res.head(limit)
-            
-            return {
-                "dimensions": [x, 'value'],
-                "source": df_res.to_dict(orient='records')
+    def _add(self, chunk):
+        if not self._started: self._start(chunk)
+        batch = _Batch(chunk, self._components)
+        self.rows += len(chunk)
+        for col, acc in self._kpis.items():
+            values = batch.numeric(col)
+            if values.empty: continue
+            part = {'sum': values.sum(), 'min': values.min(), 'max': values.max()}
+            self._kpis[col] = part if acc is None else {
+                'sum': acc['sum'] + part['sum'],
+                'min': min(acc['min'], part['min']),
+                'max': max(acc['max'], part['max'])
             }
-            
-        return None
-    except Exception as e:
-        print(f"Error procesando componente {component.get('id')}: {e}")
-        return None
\ No newline at end of file
+        for x in self.plan:
+            acc = self._groups.setdefault(x, {})
+            for key, part in batch.groups(x).items():
+                acc[key] = _merge_counts(acc.get(key), part)
+        for x in self.ts_plan:
+            if x in self._date_cols: self._series[x] = _merge_counts(self._series.get(x), batch.timeseries(x))
+        for cols, agg in self._points.items():
+            agg.add(numeric_points(chunk, list(cols), cols[0], cols[1]))
+
+    def reduce(self, col, op):
+        acc = self._kpis.get(col)
+        if acc is None: return np.nan if op in ('mean', 'max', 'min') else 0
+        if op == 'sum': return acc['sum']
+        elif op == 'mean': return acc['sum'] / self.rows
+        elif op == 'max': return acc['max']
+        elif op == 'min': return acc['min']
+        return 0
+
+    def groups(self, x):
+        res = dict(self._groups.get(x, {}))
+        # Como en _Batch: las medidas salen ordenadas por clave, los conteos por aparición
+        for key in ('sum', 'size'):
+            if key in res:
+                try: res[key] = res[key].sort_index()
+                except TypeError: pass
+        return res
+
+    def timeseries(self, x):
+        return self._series.get(x)
+
+    def is_date(self, col):
+        return col in (self._series if self._date_cols is None else self._date_cols)
+
+    def points(self, cols, lat, lon):
+        agg = self._points.get(tuple(cols))
+        return [] if agg is None else agg.result()
+
+def _chart_frame(x, series):
+    return pd.DataFrame({x: series.index, 'value': series.to_numpy()})
+
+def _component_data(batch, component):
+    c_type = component.get('type')
+    config = component.get('config', {})
+    chart_type = component.get('chart_type') # Necesario para la lógica de Pie
+    
+    # --- 1. PROCESAR KPI ---
+    if c_type == 'kpi':
+        op = config.get('operation', 'count')
+        col = config.get('column')
+        
+        val = 0
+        if op == 'count':
+            val = batch.rows
+        elif col and col in batch.columns:
+            val = batch.reduce(col, op)
+        
+        return {"value": val, "label": component.get('title')}
+
+    # --- 2. PROCESAR MAPA ---
+    elif c_type == 'map':
+        lat = config.get('lat')
+        lon = config.get('lon')
+        label = config.get('label')
+        
+        if lat in batch.columns and lon in batch.columns:
+            cols = [lat, lon]
+            if label and label in batch.columns: cols.append(label)
+            # Coordenadas numéricas; si hay demasiados puntos llegan agregados (spatial.py)
+            return batch.points(cols, lat, lon)
+        return []
+
+    # --- 3. PROCESAR GRÁFICO ---
+    elif c_type == 'chart':
+        x = config.get('x')
+        y = config.get('y')
+        op = config.get('operation', 'count')
+        limit = config.get('limit', 20) # Límite por defecto para barras
+        
+        if not x or x not in batch.columns: return []
+
+        # A. Agrupación y Cálculo (compartidos entre gráficos con la misma x)
+        if op == 'count':
+            df_res = _chart_frame(x, batch.groups(x)['count'])
+        elif y and y in batch.columns:
+            groups = batch.groups(x)
+            sums = groups['sum'][y]
+            df_res = _chart_frame(x, sums / groups['size'] if op == 'mean' else sums)
+        else:
+            return []
+
+        return finalize_chart(df_res, x, chart_type, limit)
+
+    # --- 4. PROCESAR SERIE TEMPORAL ---
+    elif c_type == 'timeseries':
+        x = config.get('x')
+        y = config.get('y')
+        op = config.get('operation', 'count')
+
+        if not x or x not in batch.columns or not batch.is_date(x): return []
+        if op != 'count' and (not y or y not in batch.columns): return []
+        # Buckets día/semana/mes sobre los parciales diarios y LTTB si hay demasiados puntos
+        return build_series(batch.timeseries(x), x, y, op, config.get('granularity', 'auto'))
+        
+    return None
+
+def _evaluate(batch, components):
+    results = []
+    for component in components:
+        try:
+            with span('component', type=component.get('type') or 'unknown'):
+                results.append(_component_data(batch, component))
+        except Exception as e:
+            print(f"Error procesando componente {component.get('id')}: {e}")
+            results.append(None)
+    return results
+
+def process_components(df, components):
+    """Evalúa todos los componentes en una pasada: cada columna se convierte una vez
+    y los gráficos que agrupan por la misma x comparten un único groupby.
+    Devuelve la lista de datos en el mismo orden (None si el componente falla)."""
+    return _evaluate(_Batch(df, components), components)
+
+def process_component_data(df, component):
+    return process_components(df, [component])[0]
+
+def process_components_chunked(chunks, components):
+    """Como process_components, pero consumiendo un iterador de DataFrames (modo streaming)"""
+    return _evaluate(_ChunkedBatch(chunks, components), components)
+
+def accumulate_components(chunks, components):
+    """Parciales fusionables de los componentes (los de process_components_chunked). Se guardan
+    con el dashboard y, si al fichero se le añaden filas, se amplían con state.extend(trozos nuevos)"""
+    specs = [{k: v for k, v in comp.items() if k != 'data'} for comp in components]
+    return _ChunkedBatch(chunks, specs)
+
+def process_partials(state, components):
+    """Datos de los componentes desde los parciales de accumulate_components (o desde
+    cualquier objeto con la interfaz de _Batch, p.ej. el del motor SQL de engines.py)"""
+    return _evaluate(state, components)
@@ -0,0 +1,167 @@
+import os
+import re
+import json
+import time
+import uuid
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from locking import file_lock, process_alive
+
+# --- TRABAJOS EN SEGUNDO PLANO (generación de dashboards) ---
+# La llamada al LLM (con sus reintentos) y el cálculo de componentes no se
+# hacen dentro de la petición HTTP: se encolan en un pool acotado de hilos y
+# el cliente consulta el estado (polling o SSE). Así un LLM lento no deja sin
+# workers al resto de rutas. El estado vive en la memoria del proceso y, con
+# share_state, se publica además en disco: con varios workers (gunicorn) el
+# sondeo del cliente puede llegar a un proceso distinto del que lo ejecuta.
+# Con estado compartido, el límite por usuario cuenta los trabajos activos de
+# todos los workers (sus ficheros) bajo un lock de fichero.
+
+WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+MAX_JOBS_PER_USER = int(os.getenv("GENERATION_JOBS_PER_USER", "2"))
+JOB_TTL = 3600  # Segundos que se conserva un trabajo terminado
+SHARED_POLL = 0.5  # Segundos entre lecturas al esperar un trabajo de otro worker
+JOB_ID_RE = re.compile(r'^[0-9a-f-]{36}$')
+
+QUEUED, RUNNING, DONE, ERROR = 'queued', 'running', 'done', 'error'
+FINISHED = (DONE, ERROR)
+
+
+class JobLimitError(Exception):
+    """El usuario ya tiene el máximo de trabajos activos"""
+
+
+class JobManager:
+    """Pool acotado de hilos + registro de estado por trabajo, seguro entre hilos"""
+
+    def __init__(self, workers=WORKERS, max_per_user=MAX_JOBS_PER_USER):
+        self.max_per_user = max_per_user
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self._state_dir = None
+        self._encode = None
+
+    def share_state(self, state_dir, encode=None):
+        """Publica cada cambio de estado en <state_dir>/<id>.json (encode: objeto -> bytes JSON)"""
+        os.makedirs(state_dir, exist_ok=True)
+        self._state_dir = state_dir
+        self._encode = encode or (lambda obj: json.dumps(obj).encode())
+
+    def submit(self, user_id, fn, *args, **kwargs):
+        """Encola fn(*args, **kwargs) para user_id. Devuelve el estado inicial del trabajo"""
+        with self._cond:
+            self._purge()
+            # Contar y publicar el nuevo bajo el mismo lock: dos workers no pueden colarse a la vez
+            with file_lock(self._state_dir + '.lock') if self._state_dir else nullcontext():
+                if self._active(user_id) >= self.max_per_user:
+                    raise JobLimitError(f"Máximo {self.max_per_user} generaciones simultáneas por usuario")
+                job_id = str(uuid.uuid4())
+                self._jobs[job_id] = {
+                    "id": job_id,
+                    "user": user_id,
+                    "pid": os.getpid(),
+                    "status": QUEUED,
+                    "result": None,
+                    "error": None,
+                    "created_at": time.time(),
+                    "finished_at": None,
+                    "version": 0
+                }
+                self._publish(self._jobs[job_id])
+        self._pool.submit(self._run, job_id, fn, args, kwargs)
+        return self.get(job_id, user_id)
+
+    def _active(self, user_id):
+        """Trabajos sin terminar del usuario: los de este proceso y los publicados por otros workers
+        (llamar con self._cond)"""
+        active = sum(1 for j in self._jobs.values() if j['user'] == user_id and j['status'] not in FINISHED)
+        if not self._state_dir: return active
+        for entry in os.scandir(self._state_dir):
+            job_id = entry.name[:-len('.json')]
+            if not entry.name.endswith('.json') or job_id in self._jobs: continue
+            job = self._read_shared(job_id)
+            if job is None or job['user'] != user_id or job['status'] in FINISHED: continue
+            # Los trabajos de un worker que murió (reinicio de gunicorn) ya no van a terminar
+            if process_alive(job.get('pid')): active += 1
+        return active
+
+    def _run(self, job_id, fn, args, kwargs):
+        self._update(job_id, status=RUNNING)
+        try: result = fn(*args, **kwargs)
+        except Exception as e:
+            print(f"Error en trabajo {job_id}: {e}")
+            self._update(job_id, status=ERROR, error=str(e), finished_at=time.time())
+        else:
+            self._update(job_id, status=DONE, result=result, finished_at=time.time())
+
+    def _update(self, job_id, **fields):
+        with self._cond:
+            job = self._jobs[job_id]
+            job.update(fields)
+            job['version'] += 1
+            self._publish(job)
+            self._cond.notify_all()
+
+    def _publish(self, job):
+        """Escritura atómica del estado compartido (llamar con self._cond: las versiones no se cruzan)"""
+        if not self._state_dir: return
+        target = os.path.join(self._state_dir, job['id'] + '.json')
+        tmp = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open(tmp, 'wb') as f: f.write(self._encode(job))
+            os.replace(tmp, target)
+        except (OSError, TypeError, ValueError) as e: print(f"Aviso: no se pudo publicar el trabajo {job['id']}: {e}")
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+
+    def _read_shared(self, job_id):
+        if not self._state_dir or not JOB_ID_RE.match(job_id): return None
+        try:
+            with open(os.path.join(self._state_dir, job_id + '.json')) as f: return json.load(f)
+        except (OSError, ValueError): return None
+
+    def get(self, job_id, user_id):
+        """Copia del estado (None si no existe o es de otro usuario)"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None: job = dict(job)
+        if job is None: job = self._read_shared(job_id)  # Trabajo de otro worker
+        if job is None or job['user'] != user_id: return None
+        return {k: v for k, v in job.items() if k not in ('user', 'pid')}
+
+    def counts(self):
+        """Trabajos conservados por estado (para /metrics)"""
+        with self._cond:
+            counts = dict.fromkeys((QUEUED, RUNNING, DONE, ERROR), 0)
+            for job in self._jobs.values(): counts[job['status']] += 1
+            return counts
+
+    def wait(self, job_id, user_id, version, timeout):
+        """Espera a que el trabajo cambie respecto a version (o a que venza timeout)"""
+        with self._cond:
+            local = job_id in self._jobs
+            if local: self._cond.wait_for(lambda: self._jobs.get(job_id, {}).get('version') != version, timeout)
+        if local: return self.get(job_id, user_id)
+        # De otro worker: no hay notificación entre procesos, se relee el fichero
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id, user_id)
+            if job is None or job['version'] != version or time.monotonic() >= deadline: return job
+            time.sleep(SHARED_POLL)
+
+    def _purge(self):
+        limit = time.time() - JOB_TTL
+        for job_id in [k for k, j in self._jobs.items() if j['finished_at'] and j['finished_at'] < limit]:
+            del self._jobs[job_id]
+        if not self._state_dir: return
+        # Ficheros publicados sin cambios desde hace JOB_TTL (también los de workers ya muertos)
+        for entry in os.scandir(self._state_dir):
+            try:
+                if entry.stat().st_mtime < limit: os.remove(entry.path)
+            except OSError: pass
+
+
+jobs = JobManager()
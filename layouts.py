@@ -0,0 +1,158 @@
+import os
+import re
+import copy
+import json
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+from locking import file_lock
+
+# --- CACHÉ DE LAYOUTS DEL LLM ---
+# Los exports mensuales llegan con las mismas columnas: el layout que devuelve
+# el LLM se reutiliza si coinciden la huella del esquema (nombres + tipo de
+# cada columna), la instrucción del usuario y la versión del prompt/modelo.
+# Los datos de los componentes se recalculan siempre sobre el fichero nuevo.
+# El JSON se comparte entre workers: cada lectura comprueba su mtime y cada
+# escritura relee, fusiona y escribe bajo el lock <cache>.lock.
+
+CACHE_TTL = int(float(os.getenv("LAYOUT_CACHE_TTL_DAYS", "30")) * 86400)
+CACHE_SIZE = int(os.getenv("LAYOUT_CACHE_SIZE", "500"))
+CACHE_ENABLED = os.getenv("LAYOUT_CACHE", "1") != "0"
+
+# Campos de config que referencian columnas del dataset, por tipo de componente
+COLUMN_FIELDS = {'kpi': ('column',), 'chart': ('x', 'y'), 'timeseries': ('x', 'y'), 'map': ('lat', 'lon', 'label')}
+
+
+def _norm_name(name):
+    return re.sub(r'\s+', ' ', str(name)).strip().lower()
+
+
+def _kind(dtype):
+    """Tipo lógico estable entre exports (category/str dependen de la cardinalidad de cada mes)"""
+    if pd.api.types.is_bool_dtype(dtype): return 'bool'
+    if pd.api.types.is_numeric_dtype(dtype): return 'number'
+    if pd.api.types.is_datetime64_any_dtype(dtype): return 'datetime'
+    return 'text'
+
+
+def schema_fingerprint(df):
+    """Huella de las columnas (nombre normalizado + tipo lógico), independiente del orden"""
+    schema = sorted((_norm_name(col), _kind(df[col].dtype)) for col in df.columns)
+    return hashlib.sha256(json.dumps(schema).encode()).hexdigest()
+
+
+def layout_key(df, instruction, system_prompt, model_name):
+    payload = {
+        "schema": schema_fingerprint(df),
+        "instruction": _norm_name(instruction or ''),
+        "prompt": hashlib.sha256(f"{model_name}\n{system_prompt}".encode()).hexdigest()
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def adapt_layout(layout, columns):
+    """Copia del layout con las columnas referenciadas resueltas contra las del fichero nuevo
+    (por nombre normalizado). None si alguna ya no existe: el layout no sirve."""
+    by_name = {_norm_name(c): c for c in columns}
+    layout = copy.deepcopy(layout)
+    for comp in layout.get('components', []):
+        config = comp.get('config', {})
+        for field in COLUMN_FIELDS.get(comp.get('type'), ()):
+            value = config.get(field)
+            if value in (None, ''): continue
+            if _norm_name(value) not in by_name: return None
+            config[field] = by_name[_norm_name(value)]
+    return layout
+
+
+class LayoutCache:
+    """LRU con TTL persistida en un JSON compartido entre procesos (escritura atómica bajo lock),
+    segura entre hilos"""
+
+    def __init__(self, path, max_entries=CACHE_SIZE, ttl=CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # key -> {"layout", "created_at", "used_at"}
+        self._stamp = False  # (mtime, tamaño) del JSON leído; False: aún no se ha leído
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError: return None
+
+    def _refresh(self):
+        """Recarga si otro proceso cambió el JSON. Los usos locales aún no escritos (used_at) se
+        conservan (llamar con self._lock)"""
+        stamp = self._stat()
+        if stamp == self._stamp: return
+        try:
+            with open(self.path) as f: items = json.load(f)
+        except (OSError, ValueError): items = {}
+        for key, item in items.items():
+            local = self._items.get(key)
+            if local is not None and local['created_at'] == item['created_at']:
+                item['used_at'] = max(item.get('used_at', 0), local.get('used_at', 0))
+        self._items = OrderedDict(sorted(items.items(), key=lambda kv: kv[1].get('used_at', 0)))
+        self._stamp = stamp
+
+    def _update(self, change):
+        """Aplica change(items) sobre la versión en disco y la escribe, sin pisar lo que hayan
+        escrito otros workers (llamar con self._lock)"""
+        with file_lock(self.path + '.lock'):
+            self._refresh()
+            change(self._items)
+            while len(self._items) > self.max_entries: self._items.popitem(last=False)
+            tmp = f"{self.path}.{uuid.uuid4().hex[:8]}.tmp"
+            try:
+                with open(tmp, 'w') as f: json.dump(self._items, f)
+                os.replace(tmp, self.path)
+                self._stamp = self._stat()
+            except OSError as e: print(f"Aviso: no se pudo guardar la caché de layouts: {e}")
+            finally:
+                if os.path.exists(tmp): os.remove(tmp)
+
+    def _expire(self, items, key, now):
+        # Otro worker pudo haberlo regenerado mientras tanto: solo se borra si sigue caducado
+        item = items.get(key)
+        if item is not None and now - item['created_at'] > self.ttl: del items[key]
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            self._refresh()
+            item = self._items.get(key)
+            if item is None or now - item['created_at'] > self.ttl:
+                if item is not None: self._update(lambda items: self._expire(items, key, now))
+                self.misses += 1
+                return None
+            item['used_at'] = now
+            self._items.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(item['layout'])
+
+    def put(self, key, layout):
+        now = time.time()
+        entry = {"layout": copy.deepcopy(layout), "created_at": now, "used_at": now}
+        def change(items):
+            items[key] = entry
+            items.move_to_end(key)
+        with self._lock: self._update(change)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0
+            }
@@ -0,0 +1,37 @@
+import os
+from contextlib import contextmanager
+
+try: import fcntl
+except ImportError: fcntl = None  # Windows
+try: import msvcrt
+except ImportError: msvcrt = None
+
+# --- LOCK DE FICHERO ENTRE PROCESOS ---
+# Con varios workers (gunicorn) el estado compartido en disco (usuarios,
+# trabajos, caché de layouts) se lee y reescribe bajo un lock exclusivo sobre
+# un fichero <recurso>.lock: leer, fusionar y escribir no se cruza entre procesos.
+# process_alive distingue el estado publicado por un worker vivo del de uno muerto.
+
+
+@contextmanager
+def file_lock(path):
+    with open(path, 'a+b') as f:
+        if fcntl: fcntl.flock(f, fcntl.LOCK_EX)
+        elif msvcrt:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try: yield
+        finally:
+            if fcntl: fcntl.flock(f, fcntl.LOCK_UN)
+            elif msvcrt:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def process_alive(pid):
+    if not pid: return False
+    if os.name == 'nt': return True  # En Windows os.kill(pid, 0) envía un Ctrl+C (y allí no hay gunicorn)
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except OSError: pass  # Existe pero es de otro usuario del sistema
+    return True
@@ -0,0 +1,294 @@
+import os
+import re
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+
+from locking import file_lock, process_alive
+
+# --- INSTRUMENTACIÓN ---
+# Spans con nombre (carga de fichero, limpieza, filtros, cada componente,
+# llamada al LLM, serialización...) que alimentan histogramas de latencia,
+# más latencia/en curso por ruta. /metrics lo expone en texto Prometheus y,
+# con SERVER_TIMING=1, cada respuesta lleva el desglose en Server-Timing.
+#
+# Con varios workers (SHARED_METRICS=1, lo activa wsgi.py) cada proceso vuelca
+# su estado a <dir>/<pid>.json cada FLUSH_INTERVAL segundos y render() suma los
+# de todos: el scrape cae en cualquier worker y ve el total. Los hooks de
+# gunicorn.conf.py vacían el directorio al arrancar y, al morir un worker, pasan
+# sus contadores e histogramas a dead.json para que los totales no retrocedan
+# (sus gauges se descartan).
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+TIMING_TOKEN_RE = re.compile(r'[^\w.-]')  # Server-Timing solo admite tokens como nombre
+SHARED_METRICS = os.getenv("SHARED_METRICS", "0") == "1"
+FLUSH_INTERVAL = 1.0  # Segundos entre volcados del estado de cada worker
+DEAD_FILE = 'dead.json'
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # El último es +Inf
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]: i += 1
+        self.counts[i] += 1
+        self.total += value
+        self.n += 1
+
+
+class Registry:
+    """Histogramas, contadores y gauges etiquetados, seguros entre hilos"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (nombre, etiquetas) -> Histogram
+        self._counters = {}
+        self._gauges = {}
+        self._help = {}
+        self._collectors = []  # Callables que devuelven [(nombre, etiquetas, valor)] al exportar
+        self._ratios = []  # (nombre, aciertos, fallos): se calculan después de sumar los workers
+        self._dir = None
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def share(self, directory):
+        """Agrega entre procesos a través de <directory>: este proceso y los que se forkeen después
+        (workers de gunicorn con preload_app) vuelcan cada uno su estado"""
+        os.makedirs(directory, exist_ok=True)
+        # Ficheros de procesos que ya no existen (ejecución anterior sin los hooks de gunicorn.conf.py)
+        for entry in os.scandir(directory):
+            pid = entry.name[:-len('.json')]
+            if entry.name.endswith('.json') and pid.isdigit() and not process_alive(int(pid)): os.remove(entry.path)
+        self._dir = directory
+        if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=self._forked)
+        self._start_flush()
+
+    def _forked(self):
+        # Lo heredado del master se contaría una vez por worker; el lock pudo quedar tomado en el fork
+        self._lock = threading.Lock()
+        self._histograms, self._counters, self._gauges = {}, {}, {}
+        self._start_flush()
+
+    def _start_flush(self):
+        threading.Thread(target=self._flush_loop, name='metrics', daemon=True).start()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None: hist = self._histograms[key] = Histogram()
+            hist.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge_add(self, name, amount, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: self._gauges[key] = self._gauges.get(key, 0) + amount
+
+    def register_collector(self, fn):
+        self._collectors.append(fn)
+
+    def register_ratio(self, name, hits, misses):
+        """Gauge name = hits / (hits + misses) por etiquetas, calculado sobre los valores ya agregados"""
+        self._ratios.append((name, hits, misses))
+
+    def _snapshot(self):
+        """Estado de este proceso: (histogramas {clave: [counts, total, n]}, contadores, gauges)"""
+        with self._lock:
+            histograms = {k: [list(h.counts), h.total, h.n] for k, h in self._histograms.items()}
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        for fn in self._collectors:
+            try:
+                for name, labels, value in fn(): gauges[(name, tuple(sorted(labels.items())))] = value
+            except Exception as e: print(f"Aviso: colector de métricas: {e}")
+        return histograms, counters, gauges
+
+    # --- AGREGACIÓN ENTRE WORKERS ---
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        """Vuelca el estado de este proceso a <dir>/<pid>.json (también al salir el worker)"""
+        if not self._dir: return
+        target = os.path.join(self._dir, f"{os.getpid()}.json")
+        tmp = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open(tmp, 'w') as f: json.dump(_encode(*self._snapshot()), f)
+            os.replace(tmp, target)
+        except OSError as e: print(f"Aviso: no se pudieron volcar las métricas: {e}")
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+
+    def _collect(self):
+        """Estado a exportar: el de este proceso o, compartido, la suma de todos los workers"""
+        if not self._dir: return self._snapshot()
+        own = f"{os.getpid()}.json"
+        with file_lock(self._dir + '.lock'):
+            names = [e.name for e in os.scandir(self._dir) if e.name.endswith('.json') and e.name != own]
+            states = [_read(os.path.join(self._dir, name)) for name in names]
+        return _merge(states + [self._snapshot()])
+
+    def render(self):
+        """Texto en formato de exposición Prometheus 0.0.4"""
+        lines = []
+        histograms, counters, gauges = self._collect()
+        histograms = [(k, counts, total, n) for k, (counts, total, n) in histograms.items()]
+        for name, hits, misses in self._ratios:
+            for (metric, labels), value in list(gauges.items()):
+                if metric != hits: continue
+                total = value + gauges.get((misses, labels), 0)
+                gauges[(name, labels)] = value / total if total else 0.0
+
+        def header(name, kind):
+            if name in self._help: lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        seen = set()
+        for (name, labels), counts, total, n in sorted(histograms):
+            if name not in seen:
+                header(name, 'histogram')
+                seen.add(name)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {n}")
+        for kind, values in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in sorted(values.items()):
+                if name not in seen:
+                    header(name, kind)
+                    seen.add(name)
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _read(path):
+    try:
+        with open(path) as f: return _decode(json.load(f))
+    except (OSError, ValueError): return {}, {}, {}
+
+
+def clear_shared(directory):
+    """Vacía el directorio compartido (al arrancar el servidor: los totales empiezan de cero)"""
+    if not os.path.isdir(directory): return
+    for entry in os.scandir(directory):
+        if entry.is_file(): os.remove(entry.path)
+
+
+def mark_dead(directory, pid):
+    """Worker terminado: sus contadores e histogramas se acumulan en dead.json; sus gauges se van"""
+    path = os.path.join(directory, f"{pid}.json")
+    # Volcado a medias si el worker murió escribiendo
+    for entry in os.scandir(directory):
+        if entry.name.startswith(f"{pid}.json.") and entry.name.endswith('.tmp'): os.remove(entry.path)
+    if not os.path.exists(path): return
+    with file_lock(directory + '.lock'):
+        histograms, counters, _ = _merge([_read(os.path.join(directory, DEAD_FILE)), _read(path)])
+        target = os.path.join(directory, DEAD_FILE)
+        with open(target + '.tmp', 'w') as f: json.dump(_encode(histograms, counters, {}), f)
+        os.replace(target + '.tmp', target)
+        os.remove(path)
+
+
+def _encode(histograms, counters, gauges):
+    """Estado serializable en JSON (las claves (nombre, etiquetas) pasan a listas)"""
+    def rows(values): return [[name, [list(kv) for kv in labels], value] for (name, labels), value in values.items()]
+    return {"histograms": rows(histograms), "counters": rows(counters), "gauges": rows(gauges)}
+
+
+def _decode(data):
+    def values(rows): return {(name, tuple(tuple(kv) for kv in labels)): value for name, labels, value in rows}
+    return values(data.get('histograms', [])), values(data.get('counters', [])), values(data.get('gauges', []))
+
+
+def _merge(states):
+    """Suma de varios estados (histogramas cubo a cubo)"""
+    histograms, counters, gauges = {}, {}, {}
+    for hists, counts, gauge_values in states:
+        for key, (buckets, total, n) in hists.items():
+            acc = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            acc[0] = [a + b for a, b in zip(acc[0], buckets)]
+            acc[1] += total
+            acc[2] += n
+        for target, values in ((counters, counts), (gauges, gauge_values)):
+            for key, value in values.items(): target[key] = target.get(key, 0) + value
+    return histograms, counters, gauges
+
+
+def _labels(labels):
+    if not labels: return ''
+    def esc(v): return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in labels) + '}'
+
+
+registry = Registry()
+registry.describe('span_seconds', 'Duración de las fases instrumentadas')
+registry.describe('http_request_duration_seconds', 'Latencia por ruta')
+registry.describe('http_requests_in_flight', 'Peticiones en curso por ruta')
+
+
+@contextmanager
+def span(name, **labels):
+    """Mide un bloque: histograma span_seconds y, dentro de una petición, entrada en Server-Timing"""
+    start = time.perf_counter()
+    try: yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe('span_seconds', elapsed, span=name, **labels)
+        if has_request_context():
+            key = '-'.join([name, *map(str, labels.values())])
+            timings = g.setdefault('timings', {})
+            timings[key] = timings.get(key, 0.0) + elapsed
+
+
+# --- HOOKS DE FLASK ---
+
+def _route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _before():
+    g.request_start = time.perf_counter()
+    registry.gauge_add('http_requests_in_flight', 1, route=_route())
+
+
+def _after(response):
+    g.status = response.status_code
+    if SERVER_TIMING:
+        timings = g.get('timings', {})
+        parts = [f"{TIMING_TOKEN_RE.sub('_', key)};dur={secs * 1000:.1f}" for key, secs in timings.items()]
+        parts.append(f"total;dur={(time.perf_counter() - g.request_start) * 1000:.1f}")
+        response.headers['Server-Timing'] = ', '.join(parts)
+    return response
+
+
+def _teardown(exc):
+    if 'request_start' not in g: return
+    route = _route()
+    registry.gauge_add('http_requests_in_flight', -1, route=route)
+    status = g.get('status', 500)
+    registry.observe('http_request_duration_seconds', time.perf_counter() - g.request_start,
+                     route=route, method=request.method, status=status)
+
+
+def init_app(app):
+    app.before_request(_before)
+    app.after_request(_after)
+    app.teardown_request(_teardown)
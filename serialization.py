@@ -0,0 +1,117 @@
+import gzip
+import json
+import math
+import hashlib
+import datetime
+import numpy as np
+import pandas as pd
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+from metrics import span
+
+try: import orjson
+except ImportError: orjson = None
+try: import brotli
+except ImportError: brotli = None
+
+# --- SERIALIZACIÓN JSON ---
+# Los DataFrames conservan NaN/inf y tipos numpy nativos; es aquí, al
+# serializar, donde se convierten a JSON válido (NaN/inf -> null).
+# Con orjson (si está instalado) numpy y NaN se serializan en nativo y
+# json_safe solo interviene para los tipos que orjson no conoce.
+
+ORJSON_OPTIONS = (orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS) if orjson else 0
+COMPRESS_MIN_BYTES = 1024
+
+
+def json_safe(obj):
+    """Convierte recursivamente a tipos JSON: numpy -> Python, NaN/inf -> None, fechas -> ISO"""
+    if isinstance(obj, dict): return {str(k): json_safe(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)): return [json_safe(v) for v in obj]
+    if isinstance(obj, float): return obj if math.isfinite(obj) else None
+    if isinstance(obj, (str, int, bool)) or obj is None: return obj
+    if isinstance(obj, np.bool_): return bool(obj)
+    if isinstance(obj, np.integer): return int(obj)
+    if isinstance(obj, np.floating): return json_safe(float(obj))
+    if isinstance(obj, np.ndarray): return json_safe(obj.tolist())
+    if obj is pd.NaT: return None
+    if isinstance(obj, (pd.Timestamp, datetime.datetime, datetime.date)): return obj.isoformat()
+    if isinstance(obj, (np.datetime64, np.timedelta64, pd.Timedelta)): return str(obj)
+    try:
+        if pd.isna(obj): return None
+    except (TypeError, ValueError): pass
+    return str(obj)
+
+
+def dumps(obj):
+    """JSON en bytes: orjson si está disponible, si no json + json_safe"""
+    with span('serialize'):
+        if orjson:
+            try: return orjson.dumps(obj, default=json_safe, option=ORJSON_OPTIONS)
+            except (TypeError, orjson.JSONEncodeError): pass  # p.ej. datetime64('NaT') suelto
+        return json.dumps(json_safe(obj), ensure_ascii=False, separators=(',', ':')).encode()
+
+
+class SafeJSONProvider(DefaultJSONProvider):
+    """Proveedor JSON de Flask que acepta los resultados de pandas/numpy tal cual"""
+
+    def dumps(self, obj, **kwargs):
+        # jsonify pasa separators (compacto) o indent (modo debug); solo indent va por json
+        if kwargs.get('indent'): return super().dumps(json_safe(obj), **kwargs)
+        return dumps(obj).decode()
+
+
+# --- FORMATO COLUMNAR ---
+# Lista de registros -> {"columns": [...], "data": [[valores col 1], [valores col 2], ...]}:
+# cada clave aparece una vez en vez de una por fila. El front lo deshace (rowsFromColumnar).
+
+def to_columnar(records):
+    columns = list(dict.fromkeys(k for row in records for k in row))
+    return {"columns": columns, "data": [[row.get(k) for row in records] for k in columns]}
+
+
+def columnar_components(components):
+    """Copia de los componentes con source de gráficos (y series temporales) y puntos de mapa en formato columnar"""
+    result = []
+    for comp in components:
+        data = comp.get('data')
+        if comp.get('type') in ('chart', 'timeseries') and isinstance(data, dict) and isinstance(data.get('source'), list):
+            comp = dict(comp, data=dict(data, source=to_columnar(data['source'])))
+        elif comp.get('type') == 'map' and isinstance(data, list):
+            comp = dict(comp, data=to_columnar(data))
+        result.append(comp)
+    return result
+
+
+def wants_columnar():
+    return request.args.get('format') == 'columnar'
+
+
+# --- COMPRESIÓN Y ETAG ---
+
+def finalize_json(response):
+    """after_request: ETag fuerte + 304 si el cliente ya tiene el cuerpo, y gzip/brotli.
+    El 304 vale también para POST (filtros): el front reenvía el ETag de la misma combinación."""
+    if response.mimetype != 'application/json' or response.status_code != 200 or response.direct_passthrough:
+        return response
+    body = response.get_data()
+    accept = request.accept_encodings
+    encoding = None
+    if len(body) >= COMPRESS_MIN_BYTES:
+        if brotli and accept['br']: encoding = 'br'
+        elif accept['gzip']: encoding = 'gzip'
+    # Un ETag por representación: el cuerpo comprimido es otro
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest() + (f"-{encoding}" if encoding else '')
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers.setdefault('Cache-Control', 'private, no-cache')  # Siempre se revalida
+    if etag in request.if_none_match:
+        response.set_data(b'')
+        response.status_code = 304
+        return response
+    with span('compress'):
+        if encoding == 'br': response.set_data(brotli.compress(body, quality=5))
+        elif encoding == 'gzip': response.set_data(gzip.compress(body, compresslevel=6))
+    if encoding: response.headers['Content-Encoding'] = encoding
+    return response
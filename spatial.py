@@ -0,0 +1,217 @@
+import threading
+import weakref
+import numpy as np
+import pandas as pd
+
+# --- CAPA ESPACIAL PARA MAPAS ---
+# Los puntos se proyectan una vez a coordenadas Web Mercator normalizadas
+# (0..1, las mismas teselas que usa MapLibre). Si en la vista caben pocos
+# puntos se envían tal cual; si no, se agrupan en celdas de la rejilla del
+# nivel de zoom y se envía un cluster por celda (centroide + nº de puntos).
+# El tamaño de la respuesta depende de la vista, no del dataset.
+
+MAX_POINTS = 1000  # Por encima, la vista se sirve agregada en clusters
+MAX_CLUSTERS = 1500  # Si se superan, la rejilla se hace más gruesa nivel a nivel
+CLUSTER_BITS = 3  # Celdas de cluster por tesela: 2^3 x 2^3 (~32 px)
+OVERVIEW_LEVEL = 20  # Rejilla inicial de la vista general (~40 m), se engrosa según haga falta
+MAX_LEVEL = 28
+GRID_SIZE = 256  # Rejilla del índice (sobre la extensión de los datos)
+COUNT_KEY = '_count'
+
+
+def mercator(lat, lon):
+    """lat/lon (grados) -> x, y Web Mercator normalizados en [0, 1]"""
+    lat = np.clip(lat, -85.05112878, 85.05112878)
+    x = (lon + 180.0) / 360.0
+    sin = np.sin(np.radians(lat))
+    y = 0.5 - np.log((1 + sin) / (1 - sin)) / (4 * np.pi)
+    return np.clip(x, 0.0, 1.0), np.clip(y, 0.0, 1.0)
+
+
+def valid_coords(lat, lon):
+    return np.isfinite(lat) & np.isfinite(lon) & (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+
+
+def cell_keys(mx, my, level):
+    scale = 1 << level
+    ix = np.minimum((mx * scale).astype(np.int64), scale - 1)
+    iy = np.minimum((my * scale).astype(np.int64), scale - 1)
+    return (ix << 32) | iy
+
+
+def _coarsen(keys):
+    return ((keys >> 33) << 32) | ((keys & 0xFFFFFFFF) >> 1)
+
+
+def cluster_partials(lat, lon, level):
+    """Parciales por celda (count, suma lat, suma lon) indexados por clave de celda"""
+    mx, my = mercator(lat, lon)
+    return pd.DataFrame({'count': 1, 'lat': lat, 'lon': lon}).groupby(cell_keys(mx, my, level)).sum()
+
+
+class PointAggregator:
+    """Acumula puntos válidos (por trozos o de golpe) y devuelve puntos o clusters acotados"""
+
+    def __init__(self, cols, lat, lon, level=OVERVIEW_LEVEL, max_points=MAX_POINTS, max_clusters=MAX_CLUSTERS):
+        self.cols, self.lat, self.lon = cols, lat, lon
+        self.level = level
+        self.max_points, self.max_clusters = max_points, max_clusters
+        self.total = 0
+        self._points = []
+        self._kept = 0
+        self._partials = None
+
+    def add(self, frame):
+        """frame: columnas cols con lat/lon numéricos y solo filas válidas"""
+        if frame.empty: return
+        if self._kept < self.max_points: self.add_points(frame.head(self.max_points - self._kept))
+        self.add_partials(cluster_partials(frame[self.lat].to_numpy(float), frame[self.lon].to_numpy(float), self.level))
+
+    def add_points(self, frame):
+        """Puntos en bruto (se envían tal cual si al final no se supera max_points)"""
+        self._points.append(frame)
+        self._kept += len(frame)
+
+    def add_partials(self, partials):
+        """partials: DataFrame count/lat/lon indexado por clave de celda (del nivel self.level)"""
+        if partials.empty: return
+        self.total += int(partials['count'].sum())
+        acc = partials if self._partials is None else pd.concat([self._partials, partials])
+        # Si la rejilla se dispara, se agrupa a un nivel más grueso
+        while len(acc.index.unique()) > self.max_clusters and self.level > 0:
+            acc.index = _coarsen(acc.index.to_numpy())
+            self.level -= 1
+        self._partials = acc.groupby(level=0).sum()
+
+    def result(self):
+        if self.total <= self.max_points:
+            if not self._kept: return []
+            return pd.concat(self._points)[self.cols].to_dict(orient='records')
+        p = self._partials
+        return pd.DataFrame({
+            self.lat: p['lat'].to_numpy() / p['count'].to_numpy(),
+            self.lon: p['lon'].to_numpy() / p['count'].to_numpy(),
+            COUNT_KEY: p['count'].to_numpy()
+        }).to_dict(orient='records')
+
+
+def numeric_points(df, cols, lat, lon):
+    """Columnas del mapa con lat/lon numéricos, solo filas con coordenadas válidas"""
+    frame = df[cols].assign(**{
+        lat: pd.to_numeric(df[lat], errors='coerce'),
+        lon: pd.to_numeric(df[lon], errors='coerce')
+    })
+    mask = valid_coords(frame[lat].to_numpy(float), frame[lon].to_numpy(float))
+    if len(cols) > 2: mask &= frame[cols[2:]].notna().all(axis=1).to_numpy()
+    return frame[mask]
+
+
+def overview(df, cols, lat, lon):
+    """Datos del componente mapa: todos los puntos si caben, si no clusters de la rejilla general"""
+    agg = PointAggregator(cols, lat, lon)
+    agg.add(numeric_points(df, cols, lat, lon))
+    return agg.result()
+
+
+# --- ÍNDICE DE REJILLA PARA CONSULTAS POR VISTA (bbox) ---
+
+class SpatialIndex:
+    """Rejilla GRID_SIZE x GRID_SIZE sobre la extensión de los puntos: una consulta por bbox
+    solo recorre las celdas que solapan la vista."""
+
+    def __init__(self, df, lat, lon):
+        la = pd.to_numeric(df[lat], errors='coerce').to_numpy(float)
+        lo = pd.to_numeric(df[lon], errors='coerce').to_numpy(float)
+        rows = np.flatnonzero(valid_coords(la, lo))
+        mx, my = mercator(la[rows], lo[rows])
+        if len(rows):
+            self.x0, self.y0 = float(mx.min()), float(my.min())
+            self.w, self.h = max(float(mx.max()) - self.x0, 1e-12), max(float(my.max()) - self.y0, 1e-12)
+        else:
+            self.x0 = self.y0 = 0.0
+            self.w = self.h = 1.0
+        gx, gy = self._grid(mx, my)
+        cells = gy * GRID_SIZE + gx
+        order = np.argsort(cells, kind='stable')
+        self.rows, self.lat, self.lon = rows[order], la[rows][order], lo[rows][order]
+        self.starts = np.searchsorted(cells[order], np.arange(GRID_SIZE * GRID_SIZE + 1))
+
+    def _grid(self, mx, my):
+        gx = np.clip(((mx - self.x0) / self.w * GRID_SIZE).astype(np.int64), 0, GRID_SIZE - 1)
+        gy = np.clip(((my - self.y0) / self.h * GRID_SIZE).astype(np.int64), 0, GRID_SIZE - 1)
+        return gx, gy
+
+    def candidates(self, bbox):
+        """Posiciones (en el índice) dentro de bbox = [oeste, sur, este, norte]"""
+        west, south, east, north = bbox
+        (mx0, mx1), (my1, my0) = mercator(np.array([south, north]), np.array([west, east]))
+        if mx1 < self.x0 or mx0 > self.x0 + self.w or my1 < self.y0 or my0 > self.y0 + self.h:
+            return np.empty(0, dtype=np.intp)
+        (gx0, gx1), (gy0, gy1) = self._grid(np.array([mx0, mx1]), np.array([my0, my1]))
+        segments = [np.arange(self.starts[gy * GRID_SIZE + gx0], self.starts[gy * GRID_SIZE + gx1 + 1])
+                    for gy in range(gy0, gy1 + 1)]
+        idx = np.concatenate(segments) if segments else np.empty(0, dtype=np.intp)
+        la, lo = self.lat[idx], self.lon[idx]
+        return idx[(la >= south) & (la <= north) & (lo >= west) & (lo <= east)]
+
+    def query(self, df, cols, bbox, zoom, selection=None):
+        """Puntos o clusters de la vista. selection: posiciones de fila que pasan los filtros"""
+        idx = self.candidates(bbox)
+        rows = self.rows[idx]
+        if selection is not None:
+            keep = np.isin(rows, selection, assume_unique=True)
+            idx, rows = idx[keep], rows[keep]
+        if len(cols) > 2:
+            # Como overview: sin etiqueta no hay punto
+            keep = df[cols[2:]].iloc[rows].notna().all(axis=1).to_numpy()
+            idx, rows = idx[keep], rows[keep]
+        order = np.argsort(rows, kind='stable')
+        idx, rows = idx[order], rows[order]
+        lat, lon = cols[0], cols[1]
+        level = int(np.clip(int(zoom) + CLUSTER_BITS, 0, MAX_LEVEL))
+        agg = PointAggregator(cols, lat, lon, level)
+        if len(rows) <= MAX_POINTS:
+            # Pocos puntos: se envían tal cual, con su etiqueta
+            agg.add(df.iloc[rows][cols].assign(**{lat: self.lat[idx], lon: self.lon[idx]}))
+        else:
+            agg.add_partials(cluster_partials(self.lat[idx], self.lon[idx], level))
+        return agg.result()
+
+
+def clip_bbox(bbox):
+    """[oeste, sur, este, norte] dentro de los límites válidos (MapLibre puede dar longitudes > 180)"""
+    west, south, east, north = (float(v) for v in bbox)
+    if east - west >= 360: west, east = -180.0, 180.0
+    return [max(west, -180.0), max(south, -90.0), min(east, 180.0), min(north, 90.0)]
+
+
+def query_chunks(chunks, cols, bbox, zoom):
+    """Como SpatialIndex.query pero recorriendo trozos (modo streaming)"""
+    lat, lon = cols[0], cols[1]
+    west, south, east, north = bbox
+    agg = None
+    for chunk in chunks:
+        if lat not in chunk.columns or lon not in chunk.columns: return []
+        if agg is None:
+            cols = [c for c in cols if c in chunk.columns]
+            agg = PointAggregator(cols, lat, lon, int(np.clip(int(zoom) + CLUSTER_BITS, 0, MAX_LEVEL)))
+        frame = numeric_points(chunk, cols, lat, lon)
+        agg.add(frame[frame[lat].between(south, north) & frame[lon].between(west, east)])
+    return [] if agg is None else agg.result()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_spatial_index(df, lat, lon):
+    """Índice por (DataFrame vivo, lat, lon); los DataFrames de la caché se reutilizan entre peticiones"""
+    key = (id(df), lat, lon)
+    with _indexes_lock:
+        entry = _indexes.get(key)
+        if entry is not None and entry[0]() is df: return entry[1]
+    index = SpatialIndex(df, lat, lon)
+    with _indexes_lock:
+        _indexes[key] = (weakref.ref(df), index)
+        weakref.finalize(df, _indexes.pop, key, None)
+    return index
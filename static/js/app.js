@@ -3,10 +3,12 @@
 // Variables de Estado
 let currentFileSummary = null;
 let currentFilePath = null;
+let currentSourcePath = null; // Excel original (para cambiar de hoja sin volver a subirlo)
 let currentDashId = null; 
 let activeFilters = {};   
 let mapInstances = {}; 
 let pieColorMap = {}; // Memoria para persistencia de colores
+let filterCache = {}; // Respuestas de filtros por combinación (ETag + datos) para revalidar con 304
 
 document.addEventListener('DOMContentLoaded', () => {
     if(document.getElementById("historyList")) {
@@ -32,12 +34,16 @@ if(fileInput) {
         formData.append("file", file);
         try {
             const res = await fetch("/upload_and_analyze", { method: "POST", body: formData });
-            const data = await res.json();
+            let data = await res.json();
             if (data.error) throw new Error(data.error);
+            // Los Excel se convierten en segundo plano: la respuesta es un trabajo
+            if (res.status === 202) {
+                label.textContent = "Convirtiendo Excel...";
+                data = await waitForJob(data.id);
+            }
             
-            currentFileSummary = data.summary;
-            currentFilePath = data.file_path;
-            if(data.original_name) fileInput.dataset.originalName = data.original_name;
+            applyUpload(data);
+            renderSheetPicker(data);
 
             label.textContent = "✅ " + file.name;
             label.classList.add("text-green-600");
@@ -46,6 +52,58 @@ if(fileInput) {
     });
 }
 
+function applyUpload(data) {
+    currentFileSummary = data.summary;
+    currentFilePath = data.file_path;
+    currentSourcePath = data.source_path || null;
+    if(data.original_name) fileInput.dataset.originalName = data.original_name;
+}
+
+// Excel con varias hojas: selector de hoja (cada hoja se convierte una vez en el servidor)
+function renderSheetPicker(data) {
+    const picker = document.getElementById("sheetPicker");
+    if (!picker) return;
+    const sheets = data.sheets || [];
+    picker.classList.toggle("hidden", sheets.length < 2);
+    const select = document.getElementById("sheetSelect");
+    select.innerHTML = "";
+    sheets.forEach(name => {
+        const opt = document.createElement("option");
+        opt.value = name;
+        opt.textContent = name;
+        opt.selected = name === data.sheet;
+        select.appendChild(opt);
+    });
+}
+
+const sheetSelect = document.getElementById("sheetSelect");
+if(sheetSelect) {
+    sheetSelect.addEventListener("change", async () => {
+        const prompt = document.getElementById("promptContainer");
+        prompt.classList.add("opacity-50", "pointer-events-none");
+        sheetSelect.disabled = true;
+        try {
+            const res = await fetch("/api/uploads/sheet", {
+                method: "POST",
+                headers: { "Content-Type": "application/json" },
+                body: JSON.stringify({
+                    source_path: currentSourcePath,
+                    sheet: sheetSelect.value,
+                    original_name: fileInput.dataset.originalName
+                })
+            });
+            let data = await res.json();
+            if (data.error) throw new Error(data.error);
+            if (res.status === 202) data = await waitForJob(data.id);
+            applyUpload(data);
+        } catch (err) { alert(err.message); }
+        finally {
+            sheetSelect.disabled = false;
+            prompt.classList.remove("opacity-50", "pointer-events-none");
+        }
+    });
+}
+
 // --- GENERACIÓN ---
 async function generate() {
     const instruction = document.getElementById("prompt").value;
@@ -66,12 +124,14 @@ async function generate() {
                 original_name: originalName
             })
         });
-        const config = await res.json();
-        if (config.error) throw new Error(config.error);
+        const job = await res.json();
+        if (job.error) throw new Error(job.error);
+
+        // La generación corre en segundo plano: esperamos a que el trabajo termine
+        const result = await waitForJob(job.id);
 
         await loadHistory();
-        const firstItem = document.querySelector("#historyList > div > div");
-        if(firstItem) firstItem.click(); 
+        loadDashboard(result.dashboard_id);
 
     } catch (e) {
         alert("Error: " + e.message);
@@ -80,15 +140,46 @@ async function generate() {
     }
 }
 
+// --- TRABAJOS EN SEGUNDO PLANO ---
+// Polling corto de /api/jobs/<id>: cada consulta libera enseguida el hilo del servidor
+// (un stream SSE abierto durante toda la generación lo ocuparía y dejaría sin hilos a los filtros)
+function waitForJob(jobId) {
+    return new Promise((resolve, reject) => {
+        const finish = (job) => {
+            if (job.status === 'done') resolve(job.result);
+            else reject(new Error(job.error || "Error en el trabajo"));
+        };
+        pollJob(jobId, finish, reject);
+    });
+}
+
+async function pollJob(jobId, finish, reject) {
+    try {
+        while (true) {
+            const res = await fetch(`/api/jobs/${jobId}`);
+            const job = await res.json();
+            if (job.error && !job.status) throw new Error(job.error);
+            if (job.status === 'done' || job.status === 'error') return finish(job);
+            await new Promise(r => setTimeout(r, 1500));
+        }
+    } catch (e) { reject(e); }
+}
+
 // --- HISTORIAL ---
-async function loadHistory() {
+// Paginado: se piden HISTORY_PAGE dashboards y el resto con "Ver más"
+const HISTORY_PAGE = 50;
+
+async function loadHistory(offset = 0) {
     const list = document.getElementById("historyList");
     if (!list) return;
     try {
-        const res = await fetch("/api/dashboards");
+        const res = await fetch(`/api/dashboards?limit=${HISTORY_PAGE}&offset=${offset}`);
         const items = await res.json();
-        list.innerHTML = "";
-        if (items.length === 0) {
+        const total = parseInt(res.headers.get("X-Total-Count") || items.length, 10);
+        if (offset === 0) list.innerHTML = "";
+        const more = document.getElementById("historyMore");
+        if (more) more.remove();
+        if (items.length === 0 && offset === 0) {
             list.innerHTML = '<p class="text-xs text-slate-500 text-center mt-4">Sin historial</p>';
             return;
         }
@@ -108,6 +199,14 @@ async function loadHistory() {
             `;
             list.appendChild(div);
         });
+        if (offset + items.length < total) {
+            const btn = document.createElement("button");
+            btn.id = "historyMore";
+            btn.className = "w-full text-xs text-slate-400 hover:text-white py-2";
+            btn.textContent = "Ver más";
+            btn.onclick = () => loadHistory(offset + items.length);
+            list.appendChild(btn);
+        }
     } catch(e) { console.error(e); }
 }
 
@@ -137,9 +236,10 @@ async function loadDashboard(id) {
     }
 
     try {
-        const res = await fetch(`/api/dashboards/${id}`);
+        const res = await fetch(`/api/dashboards/${id}?format=columnar`);
         const config = await res.json();
         if (config.error) throw new Error(config.error);
+        config.components = decodeComponents(config.components);
         renderDashboard(config);
     } catch(e) { alert("Error: " + e.message); } 
     finally {
@@ -175,19 +275,45 @@ async function applyFilter(column, value) {
 
     if (activeFilters[column] === value) delete activeFilters[column]; 
     else activeFilters[column] = value; 
+    await refreshFilters();
+}
+
+// Rango de fechas (series temporales): {from, to} inclusive, en formato YYYY-MM-DD
+async function applyDateRange(column, from, to) {
+    if (!currentDashId) return;
+    activeFilters[column] = { from: from, to: to };
+    await refreshFilters();
+}
 
+async function removeFilter(column) {
+    if (!currentDashId) return;
+    delete activeFilters[column];
+    await refreshFilters();
+}
+
+async function refreshFilters() {
     const grid = document.getElementById("dashboardGrid");
     grid.style.opacity = "0.7";
 
     try {
-        const res = await fetch(`/api/dashboards/${currentDashId}/filter`, {
+        // Misma combinación de filtros: el servidor responde 304 si el resultado no ha cambiado
+        const key = currentDashId + JSON.stringify(Object.keys(activeFilters).sort().map(k => [k, activeFilters[k]]));
+        const cached = filterCache[key];
+        const headers = { "Content-Type": "application/json" };
+        if (cached) headers["If-None-Match"] = cached.etag;
+        const res = await fetch(`/api/dashboards/${currentDashId}/filter?format=columnar`, {
             method: "POST",
-            headers: { "Content-Type": "application/json" },
+            headers: headers,
             body: JSON.stringify({ filters: activeFilters })
         });
         
-        const data = await res.json();
-        updateComponentsData(data.components);
+        let data;
+        if (res.status === 304 && cached) data = cached.data;
+        else {
+            data = await res.json();
+            if (res.headers.get("ETag")) filterCache[key] = { etag: res.headers.get("ETag"), data: data };
+        }
+        updateComponentsData(decodeComponents(data.components));
         renderFilterTags();
 
     } catch(e) {
@@ -212,7 +338,8 @@ function renderFilterTags() {
     Object.entries(activeFilters).forEach(([col, val]) => {
         const tag = document.createElement("span");
         tag.className = "bg-indigo-600 text-white text-xs font-bold px-3 py-1 rounded-full flex items-center gap-2 shadow-sm animate-pulse";
-        tag.innerHTML = `${col}: ${val} <button onclick="applyFilter('${col}', '${val}')" class="hover:text-indigo-200">✕</button>`;
+        const label = (val && typeof val === 'object') ? `${val.from || '…'} → ${val.to || '…'}` : val;
+        tag.innerHTML = `${col}: ${label} <button onclick="removeFilter('${col}')" class="hover:text-indigo-200">✕</button>`;
         tagContainer.appendChild(tag);
     });
 }
@@ -231,7 +358,7 @@ function renderDashboard(config) {
     // 1. Separar componentes
     const maps = config.components.filter(c => c.type === 'map');
     const kpis = config.components.filter(c => c.type === 'kpi');
-    const charts = config.components.filter(c => c.type === 'chart');
+    const charts = config.components.filter(c => c.type === 'chart' || c.type === 'timeseries');
 
     // 2. RENDERIZAR PARTE SUPERIOR (Map + KPIs)
     if (maps.length > 0) {
@@ -284,6 +411,7 @@ function renderDashboard(config) {
         charts.forEach((comp, idx) => {
             const card = document.createElement("div");
             card.className = "bg-white p-6 rounded-2xl shadow-sm border border-slate-200 h-[400px] flex flex-col relative";
+            if (comp.type === 'timeseries') card.classList.add("lg:col-span-2"); // Ancho completo: eje temporal largo
             const headerHtml = `<div class="mb-2"><h3 class="font-bold text-slate-800 text-lg leading-tight">${comp.title}</h3></div>`;
             const chartId = "chart_" + comp.id;
             card.innerHTML = headerHtml + `<div id="${chartId}" class="flex-grow w-full h-full"></div>`;
@@ -291,7 +419,7 @@ function renderDashboard(config) {
             if(activeFilters[comp.config.x]) card.classList.add("ring-2", "ring-indigo-500");
             
             chartGrid.appendChild(card);
-            setTimeout(() => initChart(chartId, comp, idx), 50);
+            setTimeout(() => comp.type === 'timeseries' ? initTimeseries(chartId, comp, idx) : initChart(chartId, comp, idx), 50);
         });
         mainContainer.appendChild(chartGrid);
     }
@@ -316,7 +444,7 @@ function createKpiCard(comp) {
 // --- ACTUALIZACIÓN DE DATOS ---
 function updateComponentsData(components) {
     components.forEach(comp => {
-        if (comp.type === 'chart') {
+        if (comp.type === 'chart' || comp.type === 'timeseries') {
             const chartInstance = echarts.getInstanceByDom(document.getElementById("chart_" + comp.id));
             if (chartInstance) {
                 chartInstance.setOption({ dataset: { source: comp.data.source } });
@@ -330,6 +458,7 @@ function updateComponentsData(components) {
              if (map && map.getSource('points')) {
                  const newGeoJSON = createGeoJSON(comp.data, comp.config);
                  map.getSource('points').setData(newGeoJSON);
+                 refreshMapViewport(map, comp);
              } else {
                  const mapId = "map_" + comp.id;
                  const mapContainer = document.getElementById(mapId);
@@ -344,6 +473,29 @@ function updateComponentsData(components) {
 
 // --- HELPERS ---
 
+// Formato columnar del servidor ({columns, data: [valores por columna]}) -> lista de registros
+function rowsFromColumnar(c) {
+    if (!c || !c.columns) return c;
+    const n = c.data.length ? c.data[0].length : 0;
+    const rows = new Array(n);
+    for (let i = 0; i < n; i++) {
+        const row = {};
+        c.columns.forEach((k, j) => { row[k] = c.data[j][i]; });
+        rows[i] = row;
+    }
+    return rows;
+}
+
+function decodeComponents(components) {
+    return components.map(comp => {
+        if (comp.type === 'map') return { ...comp, data: rowsFromColumnar(comp.data) };
+        if ((comp.type === 'chart' || comp.type === 'timeseries') && comp.data && comp.data.source) {
+            return { ...comp, data: { ...comp.data, source: rowsFromColumnar(comp.data.source) } };
+        }
+        return comp;
+    });
+}
+
 function createGeoJSON(data, config) {
     const latCol = config.lat;
     const lonCol = config.lon;
@@ -353,8 +505,11 @@ function createGeoJSON(data, config) {
         const lon = parseFloat(row[lonCol]);
         if (isNaN(lat) || isNaN(lon)) return null;
 
+        // Cluster agregado en el servidor: trae '_count' en vez de las columnas del punto
+        const count = row._count || 1;
         let popupContent = `<div class="p-1">`;
-        Object.entries(row).forEach(([k, v]) => {
+        if (row._count) popupContent += `<span class="text-xs text-slate-600"><b>${formatNumber(count)}</b> puntos</span>`;
+        else Object.entries(row).forEach(([k, v]) => {
             if(k !== latCol && k !== lonCol) popupContent += `<span class="text-xs text-slate-600"><b>${k}:</b> ${v}</span><br/>`;
         });
         popupContent += "</div>";
@@ -362,7 +517,7 @@ function createGeoJSON(data, config) {
         return {
             type: 'Feature',
             geometry: { type: 'Point', coordinates: [lon, lat] },
-            properties: { description: popupContent }
+            properties: { description: popupContent, count: count }
         };
     }).filter(f => f !== null);
 
@@ -453,6 +608,60 @@ function initChart(domId, comp, idx) {
     myChart.getZr().setCursorStyle('pointer');
 }
 
+// --- SERIE TEMPORAL ---
+// Línea sobre eje de tiempo (el servidor ya agrupa por día/semana/mes y reduce puntos).
+// Seleccionar un tramo con el pincel filtra el dashboard por ese rango de fechas.
+function localDate(ms) {
+    const d = new Date(ms);
+    const pad = n => String(n).padStart(2, '0');
+    return `${d.getFullYear()}-${pad(d.getMonth() + 1)}-${pad(d.getDate())}`;
+}
+
+function initTimeseries(domId, comp, idx) {
+    const dom = document.getElementById(domId);
+    if (!dom) return;
+    const myChart = echarts.init(dom);
+    const colors = ['#6366f1', '#10b981', '#f59e0b', '#ec4899', '#3b82f6', '#8b5cf6'];
+    const themeColor = colors[idx % colors.length];
+    const column = comp.config && comp.config.x;
+
+    myChart.setOption({
+        color: [themeColor],
+        tooltip: {
+            trigger: 'axis',
+            backgroundColor: 'rgba(255,255,255,0.95)',
+            padding: 12,
+            textStyle: { color: '#1e293b' },
+            valueFormatter: (value) => formatNumber(value)
+        },
+        grid: { left: '3%', right: '4%', bottom: '10%', top: '15%', containLabel: true },
+        toolbox: { right: 10, feature: { brush: { type: ['lineX', 'clear'], title: { lineX: 'Filtrar periodo', clear: 'Quitar filtro' } } } },
+        brush: { xAxisIndex: 0, brushMode: 'single', brushStyle: { color: 'rgba(99,102,241,0.15)', borderColor: themeColor } },
+        dataset: { dimensions: comp.data.dimensions, source: comp.data.source },
+        xAxis: { type: 'time', axisLabel: { fontSize: 11, color: '#64748b' } },
+        yAxis: { type: 'value', splitLine: { lineStyle: { type: 'dashed', color: '#f1f5f9' } } },
+        series: [{
+            type: 'line',
+            showSymbol: false,
+            smooth: false,
+            lineStyle: { width: 2 },
+            areaStyle: { opacity: 0.08 },
+            encode: { x: comp.data.dimensions[0], y: 'value' }
+        }]
+    });
+    window.addEventListener("resize", () => myChart.resize());
+
+    myChart.on('brushEnd', function(params) {
+        const area = params.areas && params.areas[0];
+        if (!column || !area) return;
+        const [start, end] = area.coordRange;
+        applyDateRange(column, localDate(start), localDate(end));
+    });
+    myChart.on('brush', function(params) {
+        if (params.command === 'clear' && column && activeFilters[column]) removeFilter(column);
+    });
+}
+
 // --- INIT MAPA (Instantáneo) ---
 function initMap(domId, comp) {
     const dom = document.getElementById(domId);
@@ -502,8 +711,9 @@ function initMap(domId, comp) {
             type: 'circle',
             source: 'points',
             paint: {
-                'circle-radius': 6,
-                'circle-color': '#4f46e5',
+                // Radio según el nº de puntos del cluster (1 = punto suelto)
+                'circle-radius': ['interpolate', ['linear'], ['sqrt', ['get', 'count']], 1, 6, 100, 30],
+                'circle-color': ['case', ['>', ['get', 'count'], 1], '#f59e0b', '#4f46e5'],
                 'circle-stroke-width': 2,
                 'circle-stroke-color': '#ffffff',
                 'circle-opacity': 0.8
@@ -524,5 +734,36 @@ function initMap(domId, comp) {
 
         map.on('mouseenter', 'points-layer', () => map.getCanvas().style.cursor = 'pointer');
         map.on('mouseleave', 'points-layer', () => map.getCanvas().style.cursor = '');
+
+        // Al mover/zoom se piden al servidor los puntos (o clusters) de la vista
+        map.on('moveend', () => refreshMapViewport(map, comp));
     });
+}
+
+// --- MAPA POR VISTA (bbox + zoom) ---
+let mapViewportSeq = {};
+
+async function refreshMapViewport(map, comp) {
+    if (!currentDashId) return;
+    const seq = (mapViewportSeq[comp.id] || 0) + 1;
+    mapViewportSeq[comp.id] = seq;
+    const b = map.getBounds();
+    try {
+        const res = await fetch(`/api/dashboards/${currentDashId}/map/${encodeURIComponent(comp.id)}?format=columnar`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({
+                bbox: [b.getWest(), b.getSouth(), b.getEast(), b.getNorth()],
+                zoom: map.getZoom(),
+                filters: activeFilters
+            })
+        });
+        if (!res.ok) return;
+        const data = await res.json();
+        // Descarta respuestas de vistas anteriores
+        if (mapViewportSeq[comp.id] !== seq || !map.getSource('points')) return;
+        map.getSource('points').setData(createGeoJSON(rowsFromColumnar(data.data), comp.config));
+    } catch(e) {
+        console.error(e);
+    }
 }
\ No newline at end of file
@@ -0,0 +1,97 @@
+import numpy as np
+
+# --- SERIES TEMPORALES ---
+# El componente 'timeseries' agrega una medida por día/semana/mes. Se calcula
+# en dos pasos: parciales diarios (filas y sumas por día, fusionables entre
+# trozos en modo streaming) y después el reagrupado al bucket pedido, con los
+# huecos rellenos para que el eje sea continuo. Si salen demasiados puntos se
+# reducen con LTTB (Largest Triangle Three Buckets), que conserva la forma.
+
+ROWS = '__rows'
+GRANULARITIES = ('day', 'week', 'month')
+MAX_TIMESERIES_POINTS = 500
+MAX_BUCKETS = 100_000  # Fechas aberrantes (años 1900/2200) no deben generar millones de días
+
+
+def day_partials(dates, frame):
+    """Suma por día de las columnas de frame (incluida ROWS). dates: Series datetime64 alineada"""
+    days = dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]')
+    valid = ~np.isnat(days)
+    return frame[valid].groupby(days[valid]).sum()
+
+
+def choose_granularity(first, last):
+    span = int((last - first).astype(np.int64))
+    if span <= 92: return 'day'
+    if span <= 731: return 'week'
+    return 'month'
+
+
+def bucket_days(days, granularity):
+    """Inicio del bucket de cada día (semanas ISO: lunes)"""
+    if granularity == 'week':
+        d = days.astype(np.int64)
+        return (d - (d + 3) % 7).astype('datetime64[D]')  # 1970-01-01 fue jueves
+    if granularity == 'month': return days.astype('datetime64[M]').astype('datetime64[D]')
+    return days
+
+
+def bucket_range(first, last, granularity):
+    """Todos los buckets entre first y last (ya alineados), para rellenar huecos"""
+    if granularity == 'month':
+        return np.arange(first.astype('datetime64[M]'), last.astype('datetime64[M]') + 1).astype('datetime64[D]')
+    return np.arange(first, last + 1, 7 if granularity == 'week' else 1)
+
+
+def lttb(x, y, n_out):
+    """Índices de los n_out puntos que conserva LTTB (siempre el primero y el último)"""
+    n = len(x)
+    if n_out >= n or n_out < 3: return np.arange(n)
+    x = x.astype(np.float64)
+    y = np.nan_to_num(y.astype(np.float64))
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Vértice C: media del bucket siguiente (o el último punto)
+        if i + 2 < len(edges):
+            nxt = slice(edges[i + 1], edges[i + 2])
+            cx, cy = x[nxt].mean(), y[nxt].mean()
+        else: cx, cy = x[n - 1], y[n - 1]
+        area = np.abs((x[a] - cx) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (cy - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def build_series(partials, x, y, op, granularity='auto', max_points=MAX_TIMESERIES_POINTS):
+    """Datos del componente desde los parciales diarios: {dimensions, source, granularity}"""
+    if partials is None or partials.empty:
+        return {"dimensions": [x, 'value'], "source": [], "granularity": granularity}
+    days = partials.index.to_numpy(dtype='datetime64[D]')
+    if granularity not in GRANULARITIES: granularity = choose_granularity(days.min(), days.max())
+    while True:
+        grouped = partials.groupby(bucket_days(days, granularity)).sum()
+        keys = grouped.index.to_numpy(dtype='datetime64[D]')  # groupby ordena: primero y último
+        buckets = bucket_range(keys[0], keys[-1], granularity)
+        if len(buckets) <= MAX_BUCKETS or granularity == 'month': break
+        granularity = GRANULARITIES[GRANULARITIES.index(granularity) + 1]
+    grouped = grouped.reindex(buckets, fill_value=0)
+
+    if op == 'count': values = grouped[ROWS].to_numpy(np.float64)
+    elif op == 'mean':
+        rows = grouped[ROWS].to_numpy(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'): values = np.where(rows > 0, grouped[y].to_numpy(np.float64) / rows, np.nan)
+    else: values = grouped[y].to_numpy(np.float64)
+
+    if len(buckets) > max_points:
+        keep = lttb(buckets.astype(np.int64), values, max_points)
+        buckets, values = buckets[keep], values[keep]
+    labels = np.datetime_as_string(buckets, unit='D')
+    return {
+        "dimensions": [x, 'value'],
+        "source": [{x: label, 'value': value} for label, value in zip(labels.tolist(), values.tolist())],
+        "granularity": granularity
+    }
@@ -0,0 +1,132 @@
+import os
+import glob
+import time
+import uuid
+import hashlib
+import sqlite3
+from contextlib import closing
+
+from datasets import dataframe_cache, HASH_BLOCK
+
+# --- ALMACÉN DE UPLOADS DIRECCIONADO POR CONTENIDO ---
+# Cada fichero se guarda una sola vez en blobs/<ab>/<sha256><ext>, con el hash
+# calculado mientras se vuelca el cuerpo de la petición a disco. Un upload
+# repetido apunta al mismo blob y reutiliza sus artefactos (caché Parquet,
+# perfil del resumen). Las referencias por usuario viven en SQLite:
+#   - 'upload': subida aún sin dashboard (caduca a PENDING_TTL)
+#   - 'dashboard': un dashboard generado a partir del blob
+# Un blob sin referencias se borra junto con sus ficheros asociados.
+
+BLOB_DIR = 'blobs'
+PENDING_TTL = 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blob_refs (
+    blob TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    ref_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (kind, ref_id)
+);
+CREATE INDEX IF NOT EXISTS idx_blob_refs_blob ON blob_refs (blob);
+CREATE INDEX IF NOT EXISTS idx_blob_refs_user ON blob_refs (user_id, blob);
+"""
+
+
+def is_blob(rel_path):
+    return rel_path.replace('\\', '/').startswith(BLOB_DIR + '/')
+
+
+class UploadStore:
+    """Blobs en <root>/blobs + referencias en SQLite (las transacciones serializan altas y GC)"""
+
+    def __init__(self, root, db_path):
+        self.root = root
+        self.db_path = db_path
+        os.makedirs(os.path.join(root, BLOB_DIR), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        # isolation_level=None: las transacciones se abren a mano con BEGIN IMMEDIATE
+        return sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+
+    def save(self, user_id, stream, original_name):
+        """Vuelca stream a disco calculando el SHA-256 y lo registra como upload del usuario.
+        Devuelve la ruta relativa del blob (igual para contenidos idénticos)"""
+        ext = os.path.splitext(original_name)[1].lower()
+        tmp = os.path.join(self.root, BLOB_DIR, f"tmp-{uuid.uuid4().hex}{ext}")
+        h = hashlib.sha256()
+        try:
+            with open(tmp, 'wb') as f:
+                for block in iter(lambda: stream.read(HASH_BLOCK), b''):
+                    h.update(block)
+                    f.write(block)
+            digest = h.hexdigest()
+            rel_path = f"{BLOB_DIR}/{digest[:2]}/{digest}{ext}"
+            target = os.path.join(self.root, rel_path)
+            with closing(self._connect()) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if not os.path.exists(target):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(tmp, target)
+                self._add_upload(conn, user_id, rel_path)
+                conn.execute("COMMIT")
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+        return rel_path
+
+    def _add_upload(self, conn, user_id, rel_path):
+        conn.execute("INSERT INTO blob_refs VALUES (?, ?, 'upload', ?, ?)", (rel_path, user_id, uuid.uuid4().hex, time.time()))
+
+    def register(self, user_id, rel_path):
+        """Nueva subida pendiente de un blob ya existente (p.ej. una hoja de Excel convertida antes).
+        False si el blob ya no está (lo recogió el GC)"""
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")  # El GC no puede borrarlo entre la comprobación y el alta
+            exists = os.path.exists(os.path.join(self.root, rel_path))
+            if exists: self._add_upload(conn, user_id, rel_path)
+            conn.execute("COMMIT")
+        return exists
+
+    def owns(self, user_id, rel_path):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT 1 FROM blob_refs WHERE user_id = ? AND blob = ? LIMIT 1", (user_id, rel_path)).fetchone()
+        return row is not None
+
+    def attach(self, user_id, rel_path, dash_id):
+        """El dashboard pasa a referenciar el blob y consume una subida pendiente del usuario"""
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR REPLACE INTO blob_refs VALUES (?, ?, 'dashboard', ?, ?)", (rel_path, user_id, dash_id, time.time()))
+            conn.execute(
+                "DELETE FROM blob_refs WHERE rowid = (SELECT rowid FROM blob_refs WHERE kind = 'upload' AND user_id = ? AND blob = ? ORDER BY created_at LIMIT 1)",
+                (user_id, rel_path)
+            )
+            conn.execute("COMMIT")
+
+    def release(self, user_id, dash_id):
+        """Suelta la referencia del dashboard y recoge los blobs que queden huérfanos"""
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM blob_refs WHERE kind = 'dashboard' AND ref_id = ? AND user_id = ?", (dash_id, user_id))
+        return self.gc()
+
+    def gc(self):
+        """Caduca subidas pendientes antiguas y borra los blobs sin referencias. Devuelve los borrados"""
+        removed = []
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM blob_refs WHERE kind = 'upload' AND created_at < ?", (time.time() - PENDING_TTL,))
+            # Hash de cada blob referenciado: cubre el blob y sus artefactos (<blob>.parquet, .meta.json...)
+            referenced = {r[0].split('.')[0] for r in conn.execute("SELECT DISTINCT blob FROM blob_refs")}
+            for path in glob.glob(os.path.join(self.root, BLOB_DIR, '*', '*')):
+                rel_path = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if rel_path.split('.')[0] in referenced: continue
+                os.remove(path)
+                dataframe_cache.invalidate(path)
+                removed.append(rel_path)
+            conn.execute("COMMIT")
+        if removed: print(f"Uploads: {len(removed)} ficheros sin referencias eliminados")
+        return removed
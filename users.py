@@ -0,0 +1,84 @@
+import os
+import json
+import uuid
+import threading
+
+from locking import file_lock
+
+# --- REPOSITORIO DE USUARIOS ---
+# data/users.json ({uid: {email, password}}) se lee una vez y se mantiene en
+# memoria con un índice email -> uid. Cada acceso solo hace un os.stat: si el
+# fichero cambió (otro worker, crear_usuario.py) se recarga. Las escrituras
+# bloquean el fichero <users>.lock entre procesos y son atómicas (tmp + rename).
+
+
+class UserRepository:
+    """Usuarios en memoria con índice por email, sincronizados con el JSON por mtime"""
+
+    def __init__(self, path):
+        self.path = path
+        self._users = {}
+        self._by_email = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            with file_lock(path + '.lock'):
+                if not os.path.exists(path): self._write({})
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError: return None
+
+    def _load(self):
+        stamp = self._stat()
+        with open(self.path) as f: users = json.load(f)
+        self._users = users
+        self._by_email = {u['email']: uid for uid, u in users.items()}
+        self._stamp = stamp
+
+    def _refresh(self):
+        """Recarga si el fichero cambió desde la última lectura (llamar con self._lock)"""
+        if self._stat() == self._stamp: return
+        try: self._load()
+        except (OSError, ValueError) as e:
+            # Fichero editado a mano y roto: seguimos con la copia en memoria
+            print(f"Aviso: no se pudo leer {self.path}: {e}")
+
+    def _write(self, users):
+        tmp = f"{self.path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open(tmp, 'w') as f: json.dump(users, f)
+            os.replace(tmp, self.path)
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+
+    def get(self, uid):
+        """(uid, {email, password}) o None"""
+        with self._lock:
+            self._refresh()
+            user = self._users.get(uid)
+        return (uid, user) if user else None
+
+    def get_by_email(self, email):
+        with self._lock:
+            self._refresh()
+            uid = self._by_email.get(email)
+            return (uid, self._users[uid]) if uid else None
+
+    def create(self, email, password_hash):
+        """Alta atómica. Devuelve ((uid, datos), creado); si el email ya existe, el usuario existente"""
+        with self._lock, file_lock(self.path + '.lock'):
+            # Bajo el lock de fichero: releemos por si otro proceso escribió (si falla, no se escribe)
+            self._load()
+            uid = self._by_email.get(email)
+            if uid: return (uid, self._users[uid]), False
+            uid = str(uuid.uuid4())
+            users = dict(self._users)
+            users[uid] = {'email': email, 'password': password_hash}
+            self._write(users)
+            self._users = users
+            self._by_email[email] = uid
+            self._stamp = self._stat()
+            return (uid, users[uid]), True
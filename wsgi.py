@@ -0,0 +1,15 @@
+"""Punto de entrada WSGI para producción.
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+Activa los datasets compartidos (SHARED_DATASETS=1, ver datasets.py): cada
+DataFrame limpio se vuelca una vez a <upload>.arrow y todos los workers lo
+mapean en memoria en vez de cargar su propia copia. Y las métricas sumadas
+entre workers (SHARED_METRICS=1, ver metrics.py): /metrics ve el total.
+"""
+import os
+
+os.environ.setdefault("SHARED_DATASETS", "1")
+os.environ.setdefault("SHARED_METRICS", "1")
+
+from app import app as application  # noqa: E402